@@ -4,7 +4,9 @@
 # from dataops.colors import ycbcr_to_rgb, yuv_to_rgb
 
 import os  # , glob
+import json
 import random
+from collections import OrderedDict
 
 import cv2
 import dataops.augmennt.augmennt as transforms
@@ -17,6 +19,80 @@ from dataops.debug import describe_numpy, describe_tensor, tmp_vis
 from torch.utils.data.dataset import Dataset
 
 
+def build_clip_index(data_type, root_HR, root_LR=None, video_list=None):
+    """List the frames of each clip once.
+    :param video_list: the clip directories names, or None if the
+        roots are already the directories of a single clip.
+    Returns a list with the clip 'name', the 'HR' and 'LR' frame
+    paths ('LR' is None if root_LR is not provided) and the number
+    of 'frames' of each clip.
+    """
+    clips = []
+    for video_dir in (video_list if video_list is not None else [""]):
+        paths_HR = util.get_image_paths(data_type, os.path.join(root_HR, video_dir))
+        paths_LR = None
+        if root_LR:
+            paths_LR = util.get_image_paths(data_type, os.path.join(root_LR, video_dir))
+        clips.append({'name': video_dir, 'HR': paths_HR, 'LR': paths_LR,
+                      'frames': len(paths_HR)})
+    return clips
+
+
+def frames_manifest(paths):
+    """Paths, sizes and modification times of the frames of a clip,
+    to check if a packed store is still valid."""
+    manifest = []
+    for path in paths:
+        stat = os.stat(path)
+        manifest.append([path, stat.st_size, stat.st_mtime_ns])
+    return manifest
+
+
+def pack_frames(paths, store_path, out_nc=3):
+    """Pack the frames of a clip in a single [T,H,W,C] .npy file,
+    that can be memory-mapped to read temporal windows as one
+    slice. Frames are stored as read (BGR, original dtype).
+    An existing store is reused if its manifest (saved next to it)
+    matches the current frames, else it's packed again.
+    Returns the store path, or None if the frames sizes differ.
+    """
+    manifest_path = f'{store_path}.json'
+    manifest = frames_manifest(paths)
+    if os.path.isfile(store_path) and os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path, 'r') as f:
+                if json.load(f) == manifest:
+                    return store_path
+        except (OSError, ValueError):
+            pass
+
+    # per process temporary files, so concurrent DDP ranks and
+    # dataloader workers packing the same clip don't collide. The
+    # store is replaced before the manifest, a reader in between
+    # finds them mismatched and packs again
+    tmp_path = f'{store_path}.{os.getpid()}.tmp'
+    tmp_manifest = f'{manifest_path}.{os.getpid()}.tmp'
+    store = None
+    for t, path in enumerate(paths):
+        img = util.read_img(None, path, out_nc=out_nc)
+        if store is None:
+            store = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=img.dtype,
+                shape=(len(paths),) + img.shape)
+        elif img.shape != store.shape[1:]:
+            del store
+            os.remove(tmp_path)
+            return None
+        store[t] = img
+    store.flush()
+    del store
+    with open(tmp_manifest, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, store_path)
+    os.replace(tmp_manifest, manifest_path)
+    return store_path
+
+
 class VidTrainsetLoader(Dataset):
     def __init__(self, opt):
         super(VidTrainsetLoader).__init__()
@@ -56,7 +132,45 @@ class VidTrainsetLoader(Dataset):
         self.paths_LR = opt.get('dataroot_LR', None)
         if self.paths_LR and not self.paths_HR:
             self.video_list = os.listdir(self.paths_LR)
-        
+
+        # index the frames of the clips once
+        # (if not training, paths_LR/paths_HR is already the video dir)
+        self.clips = build_clip_index(
+            self.opt['data_type'], self.paths_HR, self.paths_LR,
+            self.video_list if self.opt['phase'] == 'train' else None)
+
+        # optionally pack the frames of each clip in memory-mapped
+        # [T,H,W,C] arrays, to read windows as a single slice
+        self.stores = {}
+        self.store_paths = {}
+        frame_store = opt.get('frame_store', None)
+        if frame_store:
+            os.makedirs(frame_store, exist_ok=True)
+            for i, clip in enumerate(self.clips):
+                for kind in ('HR', 'LR'):
+                    if not clip[kind]:
+                        continue
+                    name = clip['name'] or os.path.basename(os.path.normpath(
+                        self.paths_HR if kind == 'HR' else self.paths_LR))
+                    self.store_paths[(i, kind)] = pack_frames(
+                        clip[kind], os.path.join(
+                            frame_store, f'{name}_{kind}_c{self.image_channels}.npy'),
+                        out_nc=self.image_channels)
+
+    def read_window(self, idx_clip, kind, start, frameskip=1):
+        """Read the `num_frames` frames of a temporal window of a
+        clip, from the packed frame store if available."""
+        stop = start + (self.num_frames - 1) * frameskip + 1
+        store_path = self.store_paths.get((idx_clip, kind))
+        if store_path:
+            # opened lazily, once per worker
+            store = self.stores.get(store_path)
+            if store is None:
+                store = np.load(store_path, mmap_mode='r')
+                self.stores[store_path] = store
+            return list(np.array(store[start:stop:frameskip]))
+        return [util.read_img(None, path, out_nc=self.image_channels)
+                for path in self.clips[idx_clip][kind][start:stop:frameskip]]
 
     def __getitem__(self, idx):
         scale = self.opt.get('scale', 4)
@@ -74,17 +188,14 @@ class VidTrainsetLoader(Dataset):
                 ds_kernel = self.ds_kernels #KernelDownscale(scale, self.kernel_paths, self.num_kernel)
 
             # get a random video directory
-            idx_video = random.randint(0, len(self.video_list)-1)
-            video_dir = self.video_list[idx_video]
-            # print(video_dir)
+            idx_video = random.randint(0, len(self.clips)-1)
         else:
             # only one video and paths_LR/paths_HR is already the video dir
-            video_dir = ""
+            idx_video = 0
+        video_dir = self.clips[idx_video]['name']
         
-        # list the frames in the directory 
-        # hr_dir = self.trainset_dir + '/' + video_dir + '/hr'
-        paths_HR = util.get_image_paths(self.opt['data_type'], os.path.join(self.paths_HR, video_dir))
-        # print(paths_HR)
+        # the frames in the directory, from the clips index
+        paths_HR = self.clips[idx_video]['HR']
 
         if self.opt['phase'] == 'train':
             # random reverse augmentation
@@ -113,10 +224,7 @@ class VidTrainsetLoader(Dataset):
         '''
         List based frames loading
         '''
-        if self.paths_LR:
-            paths_LR = util.get_image_paths(self.opt['data_type'], os.path.join(self.paths_LR, video_dir))
-        else:
-            paths_LR = paths_HR
+        if not self.paths_LR:
             ds_algo = 777 # default to matlab-like bicubic downscale
             if self.opt.get('lr_downscale', None): # if manually set and scale algorithms are provided, then:
                 ds_algo  = self.opt.get('lr_downscale_types', 777)
@@ -132,11 +240,13 @@ class VidTrainsetLoader(Dataset):
         LR_bicubic = None
         HR_center = None
 
-        # print('len(paths_HR)', len(paths_HR))
+        # read the temporal windows at once
+        HR_frames = self.read_window(idx_video, 'HR', int(idx_frame), frameskip)
+        if self.paths_LR:
+            LR_frames = self.read_window(idx_video, 'LR', int(idx_frame), frameskip)
+
         for i_frame in range(self.num_frames):
-            # print('frame path:', paths_HR[int(idx_frame)+(frameskip*i_frame)])
-            HR_img = util.read_img(None, paths_HR[int(idx_frame)+(frameskip*i_frame)], out_nc=self.image_channels)
-            HR_img = util.modcrop(HR_img, scale)
+            HR_img = util.modcrop(HR_frames[i_frame], scale)
 
             if self.opt['phase'] == 'train':
                 '''
@@ -154,7 +264,7 @@ class VidTrainsetLoader(Dataset):
 
             if self.paths_LR:
                 # LR images are provided at the correct scale
-                LR_img = util.read_img(None, paths_LR[int(idx_frame)+(frameskip*i_frame)], out_nc=self.image_channels)
+                LR_img = LR_frames[i_frame]
                 if scale != 1 and LR_img.shape == HR_img.shape:
                     LR_img, resize_type = Scale(img=HR_img, scale=scale, algo=ds_algo, ds_kernel=ds_kernel, resize_type=resize_type)
             else:
@@ -305,6 +415,37 @@ class VidTrainsetLoader(Dataset):
         # return len(self.paths_HR)
 
 
+class FrameWindowReader:
+    """Read the frames of a clip for sliding windows. The last
+    decoded (and pre-processed with `load_fn`) frames are kept in
+    a ring buffer of `size` frames, so walking the clip in order
+    decodes each frame only once. Out of order access also works,
+    frames no longer in the buffer are decoded again.
+    Windows near the end of the clip repeat the last frame.
+    """
+    def __init__(self, paths, size, load_fn):
+        self.paths = paths
+        self.size = size
+        self.load_fn = load_fn
+        self.frames = OrderedDict()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get(self, idx):
+        frame = self.frames.get(idx)
+        if frame is None:
+            frame = self.load_fn(self.paths[idx])
+            self.frames[idx] = frame
+            while len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+        return frame
+
+    def window(self, start, num_frames):
+        last = len(self.paths) - 1
+        return [self.get(min(start + i, last)) for i in range(num_frames)]
+
+
 class VidTestsetLoader(Dataset):
     def __init__(self, opt):
         super(VidTestsetLoader).__init__()
@@ -328,6 +469,29 @@ class VidTestsetLoader(Dataset):
         if self.paths_LR and not self.paths_HR:
             self.video_list = os.listdir(self.paths_LR)
 
+        # list the frames once and decode each one only once
+        # for the sliding windows
+        # only one video and paths_LR/paths_HR is already the video dir
+        video_dir = ""
+        paths_LR = util.get_image_paths(
+            self.opt['data_type'], os.path.join(self.paths_LR, video_dir))
+        assert self.num_frames <= len(paths_LR), (
+            f'num_frame must be smaller than the number of frames per video, check {video_dir}')
+        self.reader = FrameWindowReader(
+            paths_LR, size=self.num_frames, load_fn=self.load_frame)
+
+    def load_frame(self, path):
+        """Read a frame and return it (modcropped) with its
+        network input version (the Y channel if `y_only`)."""
+        LR_img = util.read_img(None, path, out_nc=self.image_channels)
+        #TODO: check if this is necessary
+        LR_img = util.modcrop(LR_img, self.opt.get('scale', 4))
+        if self.y_only:
+            # extract Y channel from frames and expand Y images
+            # to add the channel dimension
+            return LR_img, util.fix_img_channels(
+                util.bgr2ycbcr(LR_img, only_y=True), 1)
+        return LR_img, LR_img
 
     def __getitem__(self, idx):
         scale = self.opt.get('scale', 4)
@@ -339,47 +503,20 @@ class VidTestsetLoader(Dataset):
         # Alternative: tensor will be z-normalized to the [-1,1] range
         znorm  = self.opt.get('znorm', False)
 
-        # only one video and paths_LR/paths_HR is already the video dir
-        video_dir = ""
-        
-        # list the frames in the directory 
-        # hr_dir = self.trainset_dir + '/' + video_dir + '/hr'
-
         '''
         List based frames loading
         '''
-        paths_LR = util.get_image_paths(self.opt['data_type'], os.path.join(self.paths_LR, video_dir))
-
-        assert self.num_frames <= len(paths_LR), (
-            f'num_frame must be smaller than the number of frames per video, check {video_dir}')
-
+        paths_LR = self.reader.paths
         idx_frame = idx
-        LR_name = paths_LR[idx_frame + 1] # center frame
-        # print(LR_name)
-        # print(len(self.video_list))
+        LR_name = paths_LR[min(idx_frame + idx_center, len(paths_LR) - 1)] # center frame
 
-        # read LR frames
+        # read LR frames (from the frames window buffer)
         # HR_list = []
         LR_list = []
         resize_type = None
         LR_bicubic = None
-        for i_frame in range(self.num_frames):
-            if idx_frame == len(self.video_list)-2 and self.num_frames == 3:
-                # print("second to last frame:", i_frame)
-                if i_frame == 0:
-                    LR_img = util.read_img(None, paths_LR[int(idx_frame)], out_nc=self.image_channels)
-                else:
-                    LR_img = util.read_img(None, paths_LR[int(idx_frame)+1], out_nc=self.image_channels)
-            elif idx_frame == len(self.video_list)-1 and self.num_frames == 3:
-                # print("last frame:", i_frame)
-                LR_img = util.read_img(None, paths_LR[int(idx_frame)], out_nc=self.image_channels)
-            # every other internal frame
-            else:
-                # print("normal frame:", idx_frame)
-                LR_img = util.read_img(None, paths_LR[int(idx_frame)+(i_frame)], out_nc=self.image_channels)
-            #TODO: check if this is necessary
-            LR_img = util.modcrop(LR_img, scale)
-
+        frames = self.reader.window(idx_frame, self.num_frames)
+        for i_frame, (LR_img, LR_in) in enumerate(frames):
             # get the bicubic upscale of the center frame to concatenate for SR
             if not self.y_only and self.srcolors and i_frame == idx_center:
                 if self.opt.get('denoise_LRbic', False):
@@ -391,23 +528,11 @@ class VidTestsetLoader(Dataset):
                 # HR_center = HR_img
                 # tmp_vis(LR_bicubic, False)
                 # tmp_vis(HR_center, False)
-            
-            if self.y_only:
-                # extract Y channel from frames
-                # normal path, only Y for both
-                LR_img = util.bgr2ycbcr(LR_img, only_y=True)
 
-                # expand Y images to add the channel dimension
-                # normal path, only Y for both
-                LR_img = util.fix_img_channels(LR_img, 1)
-                
-                # print("HR_img.shape: ", HR_img.shape)
-                # print("LR_img.shape", LR_img.shape)
-
-            LR_list.append(LR_img) # h, w, c
+            LR_list.append(LR_in) # h, w, c
             
             if not self.y_only and (not h_LR or not w_LR):
-                h_LR, w_LR, c = LR_img.shape
+                h_LR, w_LR, c = LR_in.shape
         
         if not self.y_only:
             t = self.num_frames
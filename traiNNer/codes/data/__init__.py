@@ -1,20 +1,44 @@
 """Create dataset and dataloader"""
 import logging
 
+import torch
 from torch.utils.data import Dataset, DataLoader, ConcatDataset
+from torch.utils.data.distributed import DistributedSampler
 from .samplers import MultiSampler
+from utils.dist_util import get_dist_info
 
 
 def create_dataloader(dataset: Dataset,
-    dataset_opt: dict, gpu_ids=None) -> DataLoader:
+    dataset_opt: dict, gpu_ids=None, dist: bool = False) -> DataLoader:
     """
     Create Dataloader.
     :param dataset: Dataset to use
     :param dataset_opt: Dataset configuration from opt file
+    :param dist: if using distributed training, each process
+        will load a shard of the dataset with a DistributedSampler
+        and 'batch_size' will be split between the processes.
     """
     if gpu_ids is None: gpu_ids = []
+    if dist:
+        rank, world_size = get_dist_info()
     if dataset_opt.get('phase', 'test') == 'train':
-        if "concat_" in dataset_opt['mode'].lower():
+        if dist:
+            if "concat_" in dataset_opt['mode'].lower():
+                raise NotImplementedError(
+                    'Concatenated datasets are not supported in '
+                    'distributed training.')
+            batch_size = dataset_opt['batch_size']
+            assert batch_size % world_size == 0, \
+                f'batch_size ({batch_size}) must be a multiple of the number of processes ({world_size})'
+            dl_params = {
+                "batch_size": batch_size // world_size,
+                "sampler": DistributedSampler(
+                    dataset, num_replicas=world_size, rank=rank,
+                    shuffle=dataset_opt['use_shuffle']),
+                "num_workers": dataset_opt['n_workers'],
+                "drop_last": True
+            }
+        elif "concat_" in dataset_opt['mode'].lower():
             ds_indices = dataset.cumulative_sizes
             dl_params = {
                 "batch_sampler": MultiSampler(
@@ -38,10 +62,17 @@ def create_dataloader(dataset: Dataset,
             "num_workers": 1,
             "drop_last": False
         }
+        if dist:
+            # each process validates a shard, the metrics are reduced
+            del dl_params["shuffle"]
+            dl_params["sampler"] = DistributedSampler(
+                dataset, num_replicas=world_size, rank=rank, shuffle=False)
 
+    # pinned batches (also for the test loaders) make the
+    # non_blocking copies to the GPU asynchronous
     return DataLoader(
         dataset,
-        pin_memory=True,
+        pin_memory=torch.cuda.is_available(),
         **dl_params
     )
 
@@ -3,6 +3,7 @@ from data.base_dataset import BaseDataset, get_dataroots_paths, read_imgs_from_p
 from dataops.augmentations import (generate_A_fn, image_type, get_default_imethod, dim_change_fn,
                     shape_change_fn, random_downscale_B, paired_imgs_check,
                     get_unpaired_params, get_augmentations, get_totensor_params, get_totensor,
+                    CompiledAugmentations, get_sample_key,
                     set_transforms, get_ds_kernels, get_noise_patches,
                     get_params, image_size, image_channels, scale_params, scale_opt, get_transform,
                     Scale, modcrop)
@@ -46,8 +47,20 @@ class AlignedDataset(BaseDataset):
                 self.A_env = _init_lmdb(self.opt.get(f'dataroot_{self.keys_ds[0]}'))
                 self.B_env = _init_lmdb(self.opt.get(f'dataroot_{self.keys_ds[1]}'))
 
-        # get reusable totensor params
+        # get reusable totensor transform
         self.totensor_params = get_totensor_params(self.opt)
+        self.tensor_transform = get_totensor(self.opt,
+                params=self.totensor_params, toTensor=True, grayscale=False)
+
+        # optionally reuse the unpaired augmentations between samples
+        self.compiled_augs = None
+        if self.opt.get('compiled_augs', False) and self.opt['phase'] == 'train':
+            self.compiled_augs = CompiledAugmentations(self.opt,
+                noise_patches=self.noise_patches, ds_kernels=self.ds_kernels)
+
+        # identify HR samples for the model feature targets cache
+        self.target_cache = (self.opt.get('target_cache', 0)
+            and self.opt['phase'] == 'train' and self.vars != 'AB')
 
     def __getitem__(self, index):
         """Return a data point and its metadata information.
@@ -62,6 +75,7 @@ class AlignedDataset(BaseDataset):
                 using single images)
         """
         scale = self.opt.get('scale')
+        hr_key = ''
 
         # Read the images
         if self.AB_paths:
@@ -128,9 +142,10 @@ class AlignedDataset(BaseDataset):
                 transform_params,
                 # grayscale=(input_nc == 1),
                 method=default_int_method)
+            B_params = scale_params(transform_params, pre_scale)
             B_transform = get_transform(
                 self.opt,
-                scale_params(transform_params, pre_scale),
+                B_params,
                 # grayscale=(output_nc == 1),
                 method=default_int_method)
             img_A = A_transform(img_A)
@@ -141,21 +156,31 @@ class AlignedDataset(BaseDataset):
             # get and apply the unpaired transformations below
             a_aug_params, b_aug_params = get_unpaired_params(self.opt)
 
-            a_augmentations = get_augmentations(
-                self.opt, 
-                params=a_aug_params,
-                noise_patches=self.noise_patches,
-                ds_kernels=self.ds_kernels,
-                img_size=img_A_size,
-                )
-            b_augmentations = get_augmentations(
-                self.opt, 
-                params=b_aug_params,
-                noise_patches=self.noise_patches,
-                )
-
-            img_A = a_augmentations(img_A)
-            img_B = b_augmentations(img_B)
+            # random HR augmentations make the sample unique
+            if (self.target_cache and not b_aug_params
+                    and not self.opt.get('hr_downscale')):
+                hr_key = get_sample_key(B_path, self.opt, B_params)
+
+            if self.compiled_augs:
+                img_A = self.compiled_augs(
+                    img_A, params=a_aug_params, img_size=img_A_size)
+                img_B = self.compiled_augs(img_B, params=b_aug_params)
+            else:
+                a_augmentations = get_augmentations(
+                    self.opt, 
+                    params=a_aug_params,
+                    noise_patches=self.noise_patches,
+                    ds_kernels=self.ds_kernels,
+                    img_size=img_A_size,
+                    )
+                b_augmentations = get_augmentations(
+                    self.opt, 
+                    params=b_aug_params,
+                    noise_patches=self.noise_patches,
+                    )
+
+                img_A = a_augmentations(img_A)
+                img_B = b_augmentations(img_B)
 
         # Alternative position for changing the colorspace of A/LR.
         # color_A = self.opt.get('color', None) or self.opt.get('color_A', None)
@@ -163,15 +188,16 @@ class AlignedDataset(BaseDataset):
         #     img_A = channel_convert(image_channels(img_A), color_A, [img_A])[0]
 
         # convert images to PyTorch Tensors
-        tensor_transform = get_totensor(
-            self.opt, params=self.totensor_params, toTensor=True, grayscale=False)
-        img_A = tensor_transform(img_A)
-        img_B = tensor_transform(img_B)
+        img_A = self.tensor_transform(img_A)
+        img_B = self.tensor_transform(img_B)
 
         if A_path is None:
             A_path = B_path
         if self.vars == 'AB':
             return {'A': img_A, 'B': img_B, 'A_path': A_path, 'B_path': B_path}
+        if self.target_cache:
+            return {'LR': img_A, 'HR': img_B, 'LR_path': A_path,
+                    'HR_path': B_path, 'HR_key': hr_key}
         return {'LR': img_A, 'HR': img_B, 'LR_path': A_path, 'HR_path': B_path}
 
     def __len__(self):
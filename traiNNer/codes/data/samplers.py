@@ -1,4 +1,3 @@
-import random
 import numpy as np
 
 from torch.utils.data import BatchSampler, Dataset
@@ -13,7 +12,9 @@ class MultiSampler(BatchSampler):
     Notes:
         Currently will drop the last batch, only returns batches of
             size `batch_size`, similar to `drop_last`.
-        Needs optimization, the lists processing is slow.
+        Each dataset's indices are shuffled once per epoch and the
+            datasets for all the batches are drawn up front, so an
+            epoch is O(n).
     Args:
         dataset: concatenated Dataset to use.
         boundaries (list): the datasets `boundaries` that result from
@@ -34,8 +35,6 @@ class MultiSampler(BatchSampler):
         if len(weights) != len(boundaries):
             raise ValueError("the length of 'weights' and 'boundaries' "
                              "must match when using MultiSampler.")
-        bd_idx = np.arange(0, boundaries[-1])
-        self.bd_idx = bd_idx
         self.boundaries = boundaries
         self.batch_size = batch_size
         self.weights = weights
@@ -55,67 +54,48 @@ class MultiSampler(BatchSampler):
             self.n_batches = int((1+add_frac)*len_main // batch_size)
 
     def _get_batches(self):
-        idx = self.bd_idx.copy()
-        boundaries = self.boundaries.copy()
-        weights = self.weights.copy()
-        n_batches = self.n_batches
-
-        batches = []
-        while len(idx) >= self.batch_size and len(batches) <= n_batches:
-            r_bd = random.choices(
-                boundaries, weights=weights, k=1)[0]
-
-            bd_idx = boundaries.index(r_bd)
-            if bd_idx == 0:
-                l_bd = 0
-            else:
-                l_bd = boundaries[bd_idx-1]
-
-            idx_sampler = idx[l_bd:r_bd]
-            rng = np.random.default_rng()
-            rng.shuffle(idx_sampler)
-
-            diff = len(idx_sampler) - self.batch_size
-            if diff < 0:
-                weights[bd_idx] = 0
-                w_nd = np.array(weights)
-                if not np.any(w_nd):
-                    break
-                continue
-
-            if r_bd-l_bd < self.batch_size:
-                continue
-
-            sampler_idx_list = idx_sampler[:self.batch_size].tolist()
-            sampler_idx_set = set(sampler_idx_list)  # faster
-            idx_list = idx.tolist()
-            res_idx = set(idx_list)
-
-            rem_idx = []
-            for rid in idx:
-                if ((rid < l_bd or rid >= r_bd)
-                    and rid in res_idx 
-                    and rid not in sampler_idx_set):
-                    rem_idx.append(rid)
-            
-            new_idx_list = []
-            for i, x in enumerate(idx_list):
-                if i not in sampler_idx_set and i in res_idx:
-                    new_idx_list.append(i)
-
-            idx = np.unique(np.sort(np.array(new_idx_list+rem_idx)))
-            batches.append(sampler_idx_list)
-
-            for ibnd, bnd in enumerate(boundaries):
-                if ibnd >= bd_idx:
-                    boundaries[ibnd] = boundaries[ibnd] - self.batch_size
+        rng = np.random.default_rng()
+        batch_size = self.batch_size
+        starts = np.array([0] + list(self.boundaries[:-1]))
+        sizes = np.array(self.boundaries) - starts
+        # number of full batches available in each dataset
+        avail = sizes // batch_size
+        weights = np.array(self.weights, dtype=np.float64)
+        weights[avail == 0] = 0
+
+        n_batches = int(min(self.n_batches, avail[weights > 0].sum()))
+        if n_batches == 0:
+            return np.empty((0, batch_size), dtype=np.int64)
+
+        # draw the dataset of every batch up front. Draws that go over
+        # the batches available in a dataset are drawn again from the
+        # remaining datasets, same as zeroing its weight once exhausted
+        choices = rng.choice(len(weights), size=n_batches, p=weights / weights.sum())
+        while True:
+            onehot = np.zeros((n_batches, len(weights)), dtype=np.int64)
+            onehot[np.arange(n_batches), choices] = 1
+            count = np.cumsum(onehot, axis=0)[np.arange(n_batches), choices]
+            over = count > avail[choices]
+            if not over.any():
+                break
+            weights[np.unique(choices[over])] = 0
+            choices[over] = rng.choice(
+                len(weights), size=int(over.sum()), p=weights / weights.sum())
+
+        # slice each dataset's shuffled indices into its batches
+        batches = np.empty((n_batches, batch_size), dtype=np.int64)
+        for d in np.unique(choices):
+            rows = choices == d
+            n_d = int(rows.sum())
+            perm = rng.permutation(sizes[d])[:n_d*batch_size] + starts[d]
+            batches[rows] = perm.reshape(n_d, batch_size)
 
         return batches
-    
+
     def __iter__(self):
         batches = self._get_batches()
-        for b in batches: 
-            yield b
+        for b in batches:
+            yield b.tolist()
     
     def __len__(self):
         return self.n_batches
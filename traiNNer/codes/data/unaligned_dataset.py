@@ -53,8 +53,10 @@ class UnalignedDataset(BaseDataset):
         # # get the number of channels of output image
         # output_nc = self.opt.get('input_nc') if BtoA else self.opt.get('output_nc')
 
-        # get reusable totensor params
+        # get reusable totensor transform
         self.totensor_params = get_totensor_params(self.opt)
+        self.tensor_transform = get_totensor(self.opt,
+                params=self.totensor_params, toTensor=True, grayscale=False)
 
     def __getitem__(self, index):
         """Return a data point and its metadata information.
@@ -128,10 +130,8 @@ class UnalignedDataset(BaseDataset):
 
         ######## Convert images to PyTorch Tensors ########
 
-        tensor_transform = get_totensor(
-            self.opt, params=self.totensor_params, toTensor=True, grayscale=False)        
-        img_A = tensor_transform(img_A)
-        img_B = tensor_transform(img_B)
+        img_A = self.tensor_transform(img_A)
+        img_B = self.tensor_transform(img_B)
 
         if self.vars == 'AB':
             return {'A': img_A, 'B': img_B, 'A_path': A_path, 'B_path': B_path}
@@ -2,6 +2,10 @@
 from os import environ as os_env
 os_env['FOR_DISABLE_CONSOLE_CTRL_HANDLER'] = 'T'
 
+import hashlib
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import cv2
 
@@ -74,67 +78,149 @@ def label2rgb(label_field, image, kind='mix', bg_label=-1,
     Returns:
         out (array, same shape and type as `image`): The output visualization.
     """
-    # test check, may not be needed
-    # min_value = 0
-    # max_value = MAX_VALUES_BY_DTYPE[image.dtype]
-
     # paste labels on new empty image or paste them on the original image
-    out = (np.zeros_like(image) if (len(replace_samples)==1 and
+    out = (np.zeros_like(image, order='C') if (len(replace_samples)==1 and
         replace_samples[0]) else image.copy())
-    labels = np.unique(label_field)
-    bg = (labels == bg_label)
-    if bg.any():
-        labels = labels[labels != bg_label]
-        mask = (label_field == bg_label).nonzero()
-        out[mask] = bg_color
-    rgb_labels = []
+    labels, inv = np.unique(label_field, return_inverse=True)
+    inv = inv.reshape(-1)
+    out_flat = out.reshape(inv.size, -1)
+
+    # index of each label among the non-background labels
+    fg = labels != bg_label
+    fg_idx = np.cumsum(fg) - 1
+    if not fg.all():
+        out_flat[~fg[inv]] = bg_color
 
     if isinstance(reduced_colors, np.ndarray):
-        for idx, label in enumerate(labels):
-            mask = (label_field == label).nonzero()
-            out[mask] = reduced_colors[idx]
+        sel = fg[inv]
+        out_flat[sel] = reduced_colors[fg_idx[inv[sel]]]
         return out
 
-    for idx, label in enumerate(labels):
-        if replace_samples[idx % len(replace_samples)]:
-            mask = (label_field == label).nonzero()
-            if kind == 'avg':  # original _label2rgb_avg
-                color = image[mask].mean(axis=0)
-            elif kind == 'median':  # modification to use median
-                color = np.median(image[mask], axis=0)
-            elif kind == 'mix':  # adaptive coloring
-                std = np.std(image[mask])
-                if std < 20:
-                    color = image[mask].mean(axis=0)
-                elif 20 < std < 40:
-                    mean = image[mask].mean(axis=0)
-                    median = np.median(image[mask], axis=0)
-                    color = 0.5*mean + 0.5*median
-                elif 40 < std:
-                    color = np.median(image[mask], axis=0)
-
-            # test check, may not be needed
-            # if image.dtype.kind in ["i", "u", "b"]:
-            #     # After rounding the value can end up slightly
-            #     # outside of the value_range. clip via min(max(...))
-            #     # instead of np.clip because the latter one does not seem
-            #     # to keep dtypes for dtypes with large itemsizes (e.g. uint64).
-            #     # color = int(np.round(color))
-            #     # color[color < min_value] = min_value
-            #     # color[color > max_value] = max_value
-
-            out[mask] = color
-            rgb_labels.append(color)
+    replace_samples = np.asarray(replace_samples, dtype=bool)
+    replace = fg & replace_samples[fg_idx % len(replace_samples)]
+    colors = region_colors(inv, image, labels.size, kind=kind,
+        regions=replace)
+
+    sel = replace[inv]
+    out_flat[sel] = colors[inv[sel]].astype(out.dtype)
 
     if ret_rbg_labels:
-        return out, rgb_labels
+        return out, list(colors[replace])
     return out
 
 
+def region_colors(inv, image, n_labels, kind='mix', regions=None):
+    """ Vectorized per region aggregate colors.
+    Args:
+        inv: flat array with the index (in [0, n_labels)) of the
+            region of each pixel, as returned by np.unique with
+            `return_inverse`.
+        image: the image to take colors from, same number of
+            pixels as `inv`.
+        n_labels: number of regions.
+        kind: 'avg', 'median' or 'mix' (see `label2rgb`).
+        regions: optional boolean mask of the regions that are
+            needed, to skip the median computation if possible.
+    Returns:
+        array of shape [n_labels, C] with the color of each region.
+    """
+    img = image.reshape(inv.size, -1).astype(np.float64)
+    channels = img.shape[1]
+    counts = np.bincount(inv, minlength=n_labels)
+    counts_n = np.maximum(counts, 1)[:, None]
+
+    sums = np.stack([np.bincount(inv, weights=img[:, ch],
+        minlength=n_labels) for ch in range(channels)], axis=1)
+    mean = sums / counts_n
+
+    if kind == 'avg':
+        return mean
+
+    if kind == 'mix':
+        # std of all the values (all channels) in each region
+        sumsq = np.bincount(inv, weights=(img**2).sum(axis=1),
+            minlength=n_labels)
+        n_values = counts_n[:, 0] * channels
+        var = sumsq / n_values - (sums.sum(axis=1) / n_values)**2
+        std = np.sqrt(np.maximum(var, 0))
+        need_median = std >= 20
+        if regions is not None:
+            need_median &= regions
+        if not need_median.any():
+            return mean
+
+    # medians: sort values by region, then by value, and pick
+    # the middle elements of each region
+    starts = np.cumsum(counts) - counts
+    lo = starts + np.maximum(counts - 1, 0) // 2
+    hi = starts + counts // 2
+    median = np.empty_like(mean)
+    for ch in range(channels):
+        srt = img[np.lexsort((img[:, ch], inv)), ch]
+        median[:, ch] = (srt[np.minimum(lo, inv.size - 1)]
+            + srt[np.minimum(hi, inv.size - 1)]) / 2
+
+    if kind == 'median':
+        return median
+
+    # adaptive coloring
+    std = std[:, None]
+    return np.where(std < 20, mean,
+        np.where(std <= 40, 0.5*mean + 0.5*median, median))
+
+
+class SegmentationCache:
+    """ Thread-safe LRU cache of superpixel segmentations, keyed
+    by the content of the image that was segmented and the
+    segmentation parameters. Segmentation algorithms (and the
+    'selective' and 'rag' reductions) are deterministic, so when
+    the same source image is seen again (i.e. across epochs) the
+    cached labels can be reused instead of running the algorithms.
+    Args:
+        max_items: maximum number of segmentations to keep.
+    """
+    def __init__(self, max_items: int=512):
+        self.max_items = max_items
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(img, *params):
+        digest = hashlib.blake2b(
+            np.ascontiguousarray(img).tobytes(), digest_size=16).digest()
+        return (digest, img.shape, str(img.dtype)) + tuple(params)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_items:
+                self._cache.popitem(last=False)
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def resize_labels(labels, shape):
+    """Nearest neighbor resize of a label map to `shape` (h, w)."""
+    h, w = labels.shape[:2]
+    rows = (np.arange(shape[0]) * h // shape[0]).astype(np.intp)
+    cols = (np.arange(shape[1]) * w // shape[1]).astype(np.intp)
+    return labels[rows[:, None], cols]
+
+
 @preserve_shape
 def superpixels(img=None, n_segments: int=200, cs=None, n_iters: int=10,
     algo: str='slic', kind: str='mix', reduction=None,
-    replace_samples=(True,), max_size=None, interpolation='BILINEAR') -> np.ndarray:
+    replace_samples=(True,), max_size=None, interpolation='BILINEAR',
+    seg_max_size=None, cache=None) -> np.ndarray:
     """
     Superpixel segmentation algorithms. Can use either cv2 (default)
     or skimage algorithms if available.
@@ -151,6 +237,12 @@ def superpixels(img=None, n_segments: int=200, cs=None, n_iters: int=10,
         reduction: additional color reduction strategies. May be required
             for algorithms that produce more segments than what is
             defined in 'n_segments', particularly 'sk_felzenszwalb'
+        seg_max_size: if set, the segmentation (and reduction) is
+            computed on a copy downscaled so the longest side matches
+            `seg_max_size`, the labels are upscaled with nearest
+            neighbor and the colors are aggregated at full resolution.
+        cache: optional `SegmentationCache` to reuse the labels of
+            images that were already segmented with the same parameters.
     """
     if not np.any(replace_samples):
         return img
@@ -169,6 +261,66 @@ def superpixels(img=None, n_segments: int=200, cs=None, n_iters: int=10,
             )
             img = resize_fn(img)
 
+    img_seg = img
+    size = max(img.shape[:2])
+    if seg_max_size is not None and size > seg_max_size:
+        scale = seg_max_size / size
+        height, width = img.shape[:2]
+        img_seg = cv2.resize(img, (int(width * scale), int(height * scale)),
+            interpolation=cv2.INTER_AREA)
+
+    entry = None
+    if cache is not None:
+        key = cache.make_key(img_seg, n_segments, cs, n_iters, algo,
+            kind, reduction)
+        entry = cache.get(key)
+
+    if entry is None:
+        labels = segment(img_seg, n_segments, cs, n_iters, algo)
+        reduced = None
+        if len(np.unique(labels)) > n_segments and reduction:
+            if reduction in ('selective', 'rag'):
+                # deterministic reductions, the merged labels can be reused
+                labels = reduce_labels(
+                    img_seg, labels, n_segments, reduction, kind, cs='lab')
+                reduced = True
+            else:
+                reduced = reduction
+        entry = (labels, reduced)
+        if cache is not None:
+            cache.put(key, entry)
+
+    labels, reduced = entry
+    if labels.shape[:2] != img.shape[:2]:
+        labels = resize_labels(labels, img.shape[:2])
+
+    if reduced is True:
+        # aggregate colors in each of the merged labels
+        rgbmap = label2rgb(labels, img, kind=kind)
+    elif reduced:
+        # reduce segments/colors and aggregate colors
+        rgbmap = segmentation_reduction(img, labels, n_segments, reduced, kind, cs='lab')
+    else:
+        # aggregate (average/mix) colors in each of the labels and output
+        rgbmap = label2rgb(
+            labels, img, kind=kind, bg_label=-1, bg_color=(0, 0, 0), replace_samples=replace_samples)
+
+    if orig_shape and orig_shape != rgbmap.shape:
+        resize_fn = _maybe_process_in_chunks(
+            cv2.resize, dsize=(orig_shape[1], orig_shape[0]),
+            interpolation=_cv2_str2interpolation[interpolation]
+        )
+        rgbmap = resize_fn(rgbmap)
+
+    return rgbmap
+
+
+def segment(img, n_segments: int=200, cs=None, n_iters: int=10,
+    algo: str='slic') -> np.ndarray:
+    """ Computes the superpixel segmentation labels of an image
+    with the selected algorithm. See `superpixels` for the
+    arguments.
+    """
     img_sp = img.copy()
 
     if 'sk' not in algo:
@@ -243,30 +395,14 @@ def superpixels(img=None, n_segments: int=200, cs=None, n_iters: int=10,
         # retrieve the segmentation result
         labels = ss.getLabels()
 
-    # img_sp = np.copy(img_sp)
-    # if img_sp.ndim == 2:  # TODO: test with single channel images
-    #     img_sp = img_sp.reshape(*img_sp.shape, 1)
+    return labels
 
-    if len(np.unique(labels)) > n_segments and reduction:
-        # reduce segments/colors and aggregate colors
-        rgbmap = segmentation_reduction(img, labels, n_segments, reduction, kind, cs='lab')
-    else:
-        # aggregate (average/mix) colors in each of the labels and output
-        rgbmap = label2rgb(
-            labels, img, kind=kind, bg_label=-1, bg_color=(0, 0, 0), replace_samples=replace_samples)
-
-    if orig_shape and orig_shape != rgbmap.shape:
-        resize_fn = _maybe_process_in_chunks(
-            cv2.resize, dsize=(orig_shape[1], orig_shape[0]),
-            interpolation=_cv2_str2interpolation[interpolation]
-        )
-        rgbmap = resize_fn(rgbmap)
-
-    return rgbmap
-
-
-def segmentation_reduction(img, labels, n_segments, reduction=None, kind='mix', cs=None):
 
+def reduce_labels(img, labels, n_segments, reduction=None, kind='mix', cs=None):
+    """ Merges segments with the deterministic label reductions
+    ('selective' or 'rag') and returns the merged labels. Other
+    reductions return the labels unchanged.
+    """
     if reduction == 'selective':
         # selective search
         img_cvtcolor = label2rgb(labels, img, kind=kind, bg_label=-1, bg_color=(0, 0, 0))
@@ -276,9 +412,22 @@ def segmentation_reduction(img, labels, n_segments, reduction=None, kind='mix',
         elif cs == 'hsv':
             img_cvtcolor = cv2.cvtColor(img_cvtcolor, cv2.COLOR_BGR2HSV)
 
-        merged_labels = selective_search(img_cvtcolor, labels,
+        return selective_search(img_cvtcolor, labels,
             seg_num=n_segments, sim_strategy='CTSF')
-        rgbmap = label2rgb(merged_labels, img, kind=kind)
+    elif reduction == 'rag':
+        # Region Adjacency Graph (RAG)
+        g = rag_mean_color(img, labels)
+        return merge_hierarchical(labels, g, thresh=35,
+            rag_copy=False, in_place_merge=True, merge_func=merge_mean_color,
+            weight_func=_weight_mean_color)
+    return labels
+
+
+def segmentation_reduction(img, labels, n_segments, reduction=None, kind='mix', cs=None):
+
+    if reduction in ('selective', 'rag'):
+        merged_labels = reduce_labels(img, labels, n_segments, reduction, kind, cs)
+        rgbmap = label2rgb(merged_labels, img, kind=kind, bg_label=-1, bg_color=(0, 0, 0))
     elif reduction == 'cluster':
         # aggregate colors in each of the labels and output
         _, rbg_labels = label2rgb(
@@ -288,13 +437,6 @@ def segmentation_reduction(img, labels, n_segments, reduction=None, kind='mix',
             np.array(rbg_labels, dtype=np.float32), n_segments)
         reduced_colors = centroids[klabels.flatten()]
         rgbmap = label2rgb(labels, img, reduced_colors=reduced_colors)
-    elif reduction == 'rag':
-        # Region Adjacency Graph (RAG)
-        g = rag_mean_color(img, labels)
-        merged_labels = merge_hierarchical(labels, g, thresh=35,
-            rag_copy=False, in_place_merge=True, merge_func=merge_mean_color,
-            weight_func=_weight_mean_color)
-        rgbmap = label2rgb(merged_labels, img, kind=kind, bg_label=-1, bg_color=(0, 0, 0))
     else:
         rgbmap = img
 
@@ -361,21 +503,27 @@ class HierarchicalGrouping:
     def build_regions(self):
         self.regions = {}
         lbp_img = generate_lbp_image(self.img)
-        for label in self.labels:
-            size = (self.img_seg == 1).sum()
-            region_slice = find_objects(self.img_seg == label)[0]
+
+        # region index of each pixel, all statistics are computed
+        # for all the regions at once
+        _, inv = np.unique(self.img_seg, return_inverse=True)
+        inv = inv.reshape(self.img_seg.shape[:2])
+        n_labels = len(self.labels)
+        sizes = np.bincount(inv.ravel(), minlength=n_labels)
+        slices = find_objects(inv + 1)
+        color_hists = calculate_color_hists(inv, self.img, n_labels)
+        texture_hists = calculate_texture_hists(inv, lbp_img, n_labels)
+
+        for idx, label in enumerate(self.labels):
+            region_slice = slices[idx]
             box = tuple([region_slice[i].start for i in (1, 0)] +
                         [region_slice[i].stop for i in (1, 0)])
 
-            mask = self.img_seg == label
-            color_hist = calculate_color_hist(mask, self.img)
-            texture_hist = calculate_texture_hist(mask, lbp_img)
-
             self.regions[label] = {
-                'size': size,
+                'size': sizes[idx],
                 'box': box,
-                'color_hist': color_hist,
-                'texture_hist': texture_hist
+                'color_hist': color_hists[idx],
+                'texture_hist': texture_hists[idx]
             }
 
     def build_region_pairs(self):
@@ -396,12 +544,19 @@ class HierarchicalGrouping:
         Returns:
             neighbors (list): list of labels of neighbors
         """
-        boundary = find_boundaries(self.img_seg == label, mode='outer')
-        neighbors = np.unique(self.img_seg[boundary]).tolist()
+        # the outer boundary is contained in the region box
+        # extended by one pixel
+        x0, y0, x1, y1 = self.regions[label]['box']
+        h, w = self.img_seg.shape[:2]
+        seg = self.img_seg[max(y0 - 1, 0):min(y1 + 1, h),
+                           max(x0 - 1, 0):min(x1 + 1, w)]
+        boundary = find_boundaries(seg == label, mode='outer')
+        neighbors = np.unique(seg[boundary]).tolist()
         return neighbors
 
     def get_highest_similarity(self):
-        return sorted(self.s.items(), key=lambda i: i[1])[-1][0]
+        # last pair with the highest similarity, as a stable sort would
+        return max(reversed(list(self.s.items())), key=lambda i: i[1])[0]
 
     def merge_region(self, i, j):
         # generate a unique label and put in the label list
@@ -429,9 +584,9 @@ class HierarchicalGrouping:
 
         self.regions[new_label] = value
 
-        # update segmentation mask
-        self.img_seg[self.img_seg == i] = new_label
-        self.img_seg[self.img_seg == j] = new_label
+        # update segmentation mask, only inside the merged box
+        seg = self.img_seg[new_box[1]:new_box[3], new_box[0]:new_box[2]]
+        seg[(seg == i) | (seg == j)] = new_label
 
     def remove_similarities(self, i, j):
         # mark keys for region pairs to be removed
@@ -467,12 +622,12 @@ class HierarchicalGrouping:
 
 def _calculate_color_sim(ri, rj):
     """Calculate color similarity using histogram intersection"""
-    return sum([min(a, b) for a, b in zip(ri["color_hist"], rj["color_hist"])])
+    return np.minimum(ri["color_hist"], rj["color_hist"]).sum()
 
 
 def _calculate_texture_sim(ri, rj):
     """Calculate texture similarity using histogram intersection"""
-    return sum([min(a, b) for a, b in zip(ri["texture_hist"], rj["texture_hist"])])
+    return np.minimum(ri["texture_hist"], rj["texture_hist"]).sum()
 
 
 def _calculate_size_sim(ri, rj, imsize):
@@ -493,26 +648,59 @@ def _calculate_fill_sim(ri, rj, imsize):
     return 1.0 - (bbsize - ri['size'] - rj['size']) / imsize
 
 
-def calculate_color_hist(mask, img):
-    """ Calculate colour histogram for the region.
-        The output will be an array with n_BINS * n_color_channels.
-        The number of channel is varied because of different
-        colour spaces.
+def region_histograms(inv, img, bins, n_labels):
+    """ Calculate the histograms of all the regions at once, using
+        `bincount` over (region, bin) indices. As with `np.histogram`
+        without an explicit range, the bins of each region span the
+        min and max values of that region.
+    Args:
+        inv: array with the region index (in [0, n_labels)) of
+            each pixel.
+        img: image to compute the histograms of.
+        bins: number of bins per channel.
+        n_labels: number of regions.
+    Returns:
+        array of shape [n_labels, bins * n_channels], with the
+        L1 normalized histogram of each region.
     """
-    BINS = 25
     if len(img.shape) == 2:
         img = img.reshape(img.shape[0], img.shape[1], 1)
 
-    channel_nums = img.shape[2]
-    hist = np.array([])
+    flat_inv = inv.ravel()
+    order = np.argsort(flat_inv, kind='stable')
+    counts = np.bincount(flat_inv, minlength=n_labels)
+    starts = np.cumsum(counts) - counts
+
+    hists = []
+    for channel in range(img.shape[2]):
+        layer = img[:, :, channel].ravel().astype(np.float64)
+        srt = layer[order]
+        first = np.minimum.reduceat(srt, starts)
+        last = np.maximum.reduceat(srt, starts)
+        # same as np.histogram for regions with a single value
+        flat = first == last
+        first = np.where(flat, first - 0.5, first)
+        last = np.where(flat, last + 0.5, last)
+
+        norm = bins / (last - first)
+        idx = ((layer - first[flat_inv]) * norm[flat_inv]).astype(np.intp)
+        idx = np.clip(idx, 0, bins - 1)
+        hists.append(np.bincount(flat_inv * bins + idx,
+            minlength=n_labels * bins).reshape(n_labels, bins))
+
+    hist = np.concatenate(hists, axis=1).astype(np.float64)
+    # L1 normalize
+    return hist / hist.sum(axis=1, keepdims=True)
 
-    for channel in range(channel_nums):
-        layer = img[:, :, channel][mask]
-        hist = np.concatenate([hist] + [np.histogram(layer, BINS)[0]])
 
-    # L1 normalize
-    hist = hist / np.sum(hist)
-    return hist
+def calculate_color_hists(inv, img, n_labels):
+    """ Calculate colour histograms for all regions.
+        The output will be an array with n_BINS * n_color_channels
+        per region. The number of channel is varied because of
+        different colour spaces.
+    """
+    BINS = 25
+    return region_histograms(inv, img, BINS, n_labels)
 
 
 def generate_lbp_image(img):
@@ -527,21 +715,12 @@ def generate_lbp_image(img):
     return lbp_img
 
 
-def calculate_texture_hist(mask, lbp_img):
+def calculate_texture_hists(inv, lbp_img, n_labels):
     """ Uses LBP like AlpacaDB's implementation.
         Original paper uses to Gaussian derivatives.
     """
     BINS = 10
-    channel_nums = lbp_img.shape[2]
-    hist = np.array([])
-
-    for channel in range(channel_nums):
-        layer = lbp_img[:, :, channel][mask]
-        hist = np.concatenate([hist] + [np.histogram(layer, BINS)[0]])
-
-    # L1 normalize
-    hist = hist / np.sum(hist)
-    return hist
+    return region_histograms(inv, lbp_img, BINS, n_labels)
 
 
 def calculate_sim(ri, rj, imsize, sim_strategy):
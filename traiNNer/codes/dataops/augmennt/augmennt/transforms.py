@@ -2757,6 +2757,13 @@ class Superpixels(RandomBase):
             Use ``None`` to apply no down-/upscaling.
         interpolation (OpenCV flag): flag that is used to specify the interpolation algorithm.
             Should be one of: 'NEAREST', 'BILINEAR', 'AREA', 'BICUBIC', 'LANCZOS'. Default: 'BILINEAR'.
+        seg_max_size (int or None): Maximum image size at which only the segmentation
+            is computed. Labels are upscaled with nearest neighbor and segments are
+            filled with colors from the (``max_size``) image, so the output is not
+            blurred by the down-/upscaling. Use ``None`` to segment at full size.
+        cache_size (int): Number of segmentations to keep in a LRU cache, keyed by
+            image content, to reuse them when the same images are seen again
+            (i.e. across epochs). Use ``0`` to disable the cache.
         p (float): probability of applying the transform. Default: 0.5.
     """
 
@@ -2771,6 +2778,8 @@ class Superpixels(RandomBase):
         reduction=None,
         max_size=128,
         interpolation: str='BILINEAR',
+        seg_max_size=None,
+        cache_size: int=0,
         p: float=0.5,
     ):
         super(Superpixels, self).__init__(p)
@@ -2778,6 +2787,8 @@ class Superpixels(RandomBase):
         self.n_segments = to_tuple(n_segments, n_segments)
         self.max_size = max_size
         self.interpolation = interpolation
+        self.seg_max_size = seg_max_size
+        self.cache = SP.SegmentationCache(cache_size) if cache_size else None
         self.cs = cs
         self.n_iters = n_iters
 
@@ -2814,7 +2825,8 @@ class Superpixels(RandomBase):
         algo='slic', kind='mix', reduction=None, **kwargs):
         return SP.superpixels(
             img, n_segments, self.cs, self.n_iters, algo, kind, reduction,
-            replace_samples, self.max_size, self.interpolation)
+            replace_samples, self.max_size, self.interpolation,
+            self.seg_max_size, self.cache)
 
     def __call__(self, image):
         if random.random() < self.p:
@@ -1,15 +1,21 @@
 import random
+import os
+import json
 
 from os import path as osp
 import glob
 
 import numpy as np
+import torch
 import dataops.common as util
 from dataops.common import fix_img_channels, get_image_paths, read_img, np2tensor
 from dataops.debug import *
 from dataops.imresize import resize as imresize  # resize # imresize_np
 
 from dataops.augmennt.augmennt.common import wrap_cv2_function, wrap_pil_function, _cv2_interpolation2str
+import dataops.augmennt.augmennt as augmennt
+from dataops.augmennt.augmennt import extra_functional as EF
+from dataops.augmennt.augmennt import spadd as SCIP
 from torch.utils.data.dataset import Dataset  # TODO TMP, move NoisePatches to a separate dataloader
 
 
@@ -115,6 +121,21 @@ class Scale_class:
         algo=None, ds_kernel=None, resize_type=None,
         img_type=None, res_config=None):
 
+        self.size = size
+        self.ds_kernel = ds_kernel
+        self.img_type = img_type
+        # resize functions already built, reused by set_params()
+        self.resize_fns = {}
+
+        self.set_params(scale=scale, algo=algo,
+            resize_type=resize_type, res_config=res_config)
+
+    def set_params(self, scale=None, algo=None,
+        resize_type=None, res_config=None):
+        """ (Re)sample the random scale and resize type. The
+        resize functions are only built the first time each
+        resize type is selected and are reused afterwards.
+        """
         if res_config:  # and scale !=1:
             algo = None
             scale, resize_type = adj_scale_config(
@@ -125,11 +146,11 @@ class Scale_class:
             algo = [777, 773, cv2.INTER_AREA]
 
         self.scale = scale
-        self.size = size
 
         self.resize_fn, self.resize_type = get_resize(
-            size=size, scale=scale, ds_algo=algo, ds_kernel=ds_kernel,
-            resize_type=resize_type, img_type=img_type)
+            size=self.size, scale=scale, ds_algo=algo,
+            ds_kernel=self.ds_kernel, resize_type=resize_type,
+            img_type=self.img_type, cache=self.resize_fns)
 
     def get_resize_type(self):
         return self.resize_type
@@ -219,7 +240,11 @@ class MLResize:
 
 
 def get_resize(size=None, scale=None, ds_algo=None,
-    ds_kernel=None, resize_type=None, img_type=None):
+    ds_kernel=None, resize_type=None, img_type=None, cache=None):
+    """ Get the resize function for the selected resize type.
+    If a 'cache' dictionary is provided, the functions are stored
+    there and reused in later calls, only updating the scale.
+    """
     resize_fn = None
 
     if not resize_type:
@@ -242,6 +267,14 @@ def get_resize(size=None, scale=None, ds_algo=None,
         # TODO: pil images will only use default method, not 'algo' yet
         resize_type = -1
 
+    # nearest_aligned kernels depend on the scale
+    cache_key = (resize_type, scale) if resize_type == 997 else resize_type
+    if cache is not None and cache_key in cache:
+        resize_fn = cache[cache_key]
+        if isinstance(resize_fn, MLResize):
+            resize_fn.scale = scale
+        return resize_fn, resize_type
+
     if resize_type in set(custom_ktypes.keys()):
         # use custom scaling methods
         resize_fn = MLResize(
@@ -264,6 +297,9 @@ def get_resize(size=None, scale=None, ds_algo=None,
             size=size, scale=scale,
             interpolation=interpolation, kind='transforms')
 
+    if cache is not None and resize_fn is not None:
+        cache[cache_key] = resize_fn
+
     return resize_fn, resize_type
 
 
@@ -413,6 +449,138 @@ class NoisePatches(Dataset):
         return len(self.noise_imgs)
 
 
+class NoisePatchBank(Dataset):
+    """
+    Alternative to NoisePatches that loads all the noise patches
+    once and keeps them in a single contiguous (shared memory)
+    array, normalized to zero mean, instead of reading, cropping
+    and normalizing an image file on every access. The random
+    crops and flips are returned as views of the bank array.
+    Note that the mean is subtracted over the whole stored patch
+    instead of over each random crop and that all patches are
+    cropped to the smallest patch dimensions found.
+    Args:
+        dataset: path to the directory with the noise patches.
+        size: size of the random crops to return.
+        permute: randomly shuffle the order of the patches.
+        grayscale: store the Y channel of the patches.
+    """
+    def __init__(self, dataset=None, size=32, permute=True, grayscale=False):
+        super(NoisePatchBank, self).__init__()
+        assert osp.exists(dataset)
+
+        self.grayscale = grayscale
+        self.size = size
+        self.noise_imgs = sorted(glob.glob(dataset + '*.png'))
+        assert self.noise_imgs, f'No noise patches found in {dataset}'
+        if permute:
+            np.random.shuffle(self.noise_imgs)
+
+        patches = [util.read_img(None, path, 3) for path in self.noise_imgs]
+        h = min(p.shape[0] for p in patches)
+        w = min(p.shape[1] for p in patches)
+        c = 1 if grayscale else 3
+
+        bank = np.empty((len(patches), h, w, c), dtype=np.float32)
+        for i, patch in enumerate(patches):
+            patch = patch[:h, :w, :]
+            norm_noise = (patch - np.mean(
+                patch, axis=(0, 1), keepdims=True, dtype=np.float32))
+            if grayscale:
+                norm_noise = util.bgr2ycbcr(norm_noise, only_y=True)[..., None]
+            bank[i] = norm_noise
+
+        # shared between the dataloader workers
+        self.bank = torch.from_numpy(bank).share_memory_()
+        self.device_banks = {}
+
+    def random_view(self, index, size=None):
+        """Get a random crop of patch 'index' with random flips
+        as a view of the bank (no copies are made)."""
+        size = size if size else self.size
+        patch = self.bank.numpy()[index]
+        h, w = patch.shape[0:2]
+        th, tw = min(size, h), min(size, w)
+        i = random.randint(0, h - th)
+        j = random.randint(0, w - tw)
+        patch = patch[i:i+th, j:j+tw, :]
+        if random.random() < 0.5:
+            patch = patch[:, ::-1, :]
+        if random.random() < 0.5:
+            patch = patch[::-1, :, :]
+        return patch
+
+    def __getitem__(self, index, out_nc=3):
+        return self.random_view(index)
+
+    def __len__(self):
+        return self.bank.shape[0]
+
+    def get_bank(self, device):
+        """Get the bank in CHW (RGB) format on 'device' (only copied once)."""
+        key = str(device)
+        if key not in self.device_banks:
+            bank = self.bank.permute(0, 3, 1, 2)
+            if bank.shape[1] == 3:
+                bank = bank.flip(1)  # BGR to RGB
+            self.device_banks[key] = bank.contiguous().to(device)
+        return self.device_banks[key]
+
+    def add_noise_batch(self, imgs, noise_amp:float=1.0, p:float=1.0,
+        znorm:bool=False):
+        """Add noise from the patches to a batch of images on the
+        batch device, with one random patch, offset and flips per
+        image gathered in a single indexing operation. Patches smaller
+        than the images are extended with reflection.
+        Args:
+            imgs: tensor batch of images (B, C, H, W), in range [0, 1]
+                or [-1, 1] if 'znorm'.
+            noise_amp: noise amplitude multiplier.
+            p: probability of adding noise to each image.
+            znorm: if the images are in the [-1, 1] range.
+        """
+        bank = self.get_bank(imgs.device)
+        b, _, h, w = imgs.shape
+        n, _, nh, nw = bank.shape
+        device = imgs.device
+
+        idx = torch.randint(0, n, (b,), device=device)
+        y0 = torch.randint(0, max(nh - h, 0) + 1, (b,), device=device)
+        x0 = torch.randint(0, max(nw - w, 0) + 1, (b,), device=device)
+        rows = y0[:, None] + torch.arange(h, device=device)[None, :]
+        cols = x0[:, None] + torch.arange(w, device=device)[None, :]
+        # random flips by reversing the gathered indices
+        vflip = torch.rand(b, device=device) < 0.5
+        hflip = torch.rand(b, device=device) < 0.5
+        rows = torch.where(vflip[:, None], rows.flip(1), rows)
+        cols = torch.where(hflip[:, None], cols.flip(1), cols)
+        rows = reflect_idx(rows, nh)
+        cols = reflect_idx(cols, nw)
+
+        # (B, H, W, C) -> (B, C, H, W)
+        noise = bank.permute(0, 2, 3, 1)[
+            idx[:, None, None], rows[:, :, None], cols[:, None, :]]
+        noise = noise.permute(0, 3, 1, 2)
+
+        scale = noise_amp / 255.
+        if znorm:
+            scale *= 2.
+        mask = (torch.rand(b, 1, 1, 1, device=device) < p).to(imgs.dtype)
+        out = imgs + scale * mask * noise.to(imgs.dtype)
+        low = -1. if znorm else 0.
+        return torch.clamp(out, low, 1.)
+
+
+def reflect_idx(idx, n:int):
+    """Map indices out of [0, n) back into range with reflection
+    (same as 'reflect' padding, the edge is not repeated)."""
+    if n == 1:
+        return torch.zeros_like(idx)
+    period = 2 * (n - 1)
+    idx = torch.remainder(idx, period)
+    return torch.where(idx >= n, period - idx, idx)
+
+
 class RandomNoisePatches():
     def __init__(self, noise_patches, noise_amp:float=1.0, p:float=1.0):
         self.noise_patches = noise_patches
@@ -436,7 +604,8 @@ class RandomNoisePatches():
             j = random.randint(0, w - n_w)
             # top, bottom, left, right borders
             noise = transforms.Pad(
-                padding=(i, h-(i+n_h), j, w-(j+n_w)), padding_mode='reflect')(noise)
+                padding=(i, h-(i+n_h), j, w-(j+n_w)), padding_mode='reflect')(
+                    np.ascontiguousarray(noise))
         elif n_h > h or n_w > w:
             # crop noise patch to image size if larger
             noise = transforms.RandomCrop(size=(w,h))(noise)
@@ -647,6 +816,27 @@ def get_transform(opt, params=None, grayscale=False, method=None,
     return transforms.Compose(transform_list)
 
 
+def get_sample_key(path:str, opt:dict, params:dict=None) -> str:
+    """ Builds an identifier of a sample after the paired
+    transformations of `get_transform()`, using only the
+    parameters that are active with the current options.
+    """
+    preprocess_mode = opt.get('preprocess') or 'none'
+    key = [path]
+    if params:
+        if 'resize' in preprocess_mode or 'scale_' in preprocess_mode:
+            key.append(params['load_size'])
+        if preprocess_mode == 'crop' or 'and_crop' in preprocess_mode:
+            key.append(params['crop_pos'])
+        if opt.get('use_flip'):
+            key.append(params['flip'])
+        if opt.get('use_hrrot') and params.get('hrrot'):
+            key.append(('hrrot', params['angle']))
+        elif opt.get('use_rot'):
+            key.append((params['rot'], params['rot'] and params['vflip']))
+    return '|'.join(str(k) for k in key)
+
+
 def resize(img, w, h, method=None):
     if not method:
         method = get_default_imethod(image_type(img))
@@ -1323,6 +1513,164 @@ def final_shapes_check(img_A, img_B, opt, scale, default_int_method,
     return img_A, img_B
 
 
+class KernelBank:
+    """ Alternative to transforms.ApplyKernel for the realistic
+    (kernelGAN, etc) downscaling kernels. All the kernels are
+    cropped, normalized and stacked in a single array once, which
+    is saved next to the kernels and memory-mapped in later runs,
+    instead of loading a kernel file for every image.
+    Kernels that are separable (rank 1) are applied with two 1D
+    filters, the rest with cv2.filter2D (which already switches to
+    DFT-based convolution for large kernels).
+    A batched tensor path (apply_batch()) applies a different
+    kernel to each image of a batch in one grouped convolution.
+    Args:
+        scale: the kernels scale and downsampling factor.
+        kernels_path: path to the kernels directories.
+        pattern: the kernels file structure pattern.
+        size: size to center crop the kernels to (receptive field).
+        permute: randomly shuffle the order of the kernels.
+        center: use the center pixel when subsampling.
+        sep_tol: relative tolerance of the second singular value
+            to consider a kernel separable.
+    """
+    def __init__(self, scale:int=1, kernels_path=None,
+        pattern:str='kernelgan', size:int=13, permute:bool=True,
+        center:bool=False, sep_tol:float=1e-3):
+        self.scale = scale
+        self.center = center
+
+        kernels_files = sorted(augmennt.common.fetch_kernels(
+            kernels_path=kernels_path, pattern=pattern, scale=scale))
+        assert kernels_files, "No kernels found for scale {} in path {}.".format(scale, kernels_path)
+
+        self.kernels = self.load_bank(kernels_files, kernels_path, scale, size)
+        self.num_kernel = self.kernels.shape[0]
+        self.order = np.arange(self.num_kernel)
+        if permute:
+            np.random.shuffle(self.order)
+
+        # precompute the separable kernels decomposition
+        u, s, vh = np.linalg.svd(self.kernels.astype(np.float64))
+        self.separable = s[:, 1] <= sep_tol * s[:, 0]
+        self.kernels_y = (u[:, :, 0] * np.sqrt(s[:, 0:1])).astype(np.float32)
+        self.kernels_x = (vh[:, 0, :] * np.sqrt(s[:, 0:1])).astype(np.float32)
+        self.device_kernels = {}
+
+    @staticmethod
+    def load_bank(kernels_files, kernels_path, scale, size):
+        """Load the stacked kernels array, memory-mapped if it was
+        previously saved from the same kernel files (names, sizes
+        and modification times, stored in a manifest next to the
+        bank), else build it from the kernel files."""
+        bank_path = osp.join(kernels_path, f'kernel_bank_x{scale}_{size}.npy')
+        manifest_path = osp.join(kernels_path, f'kernel_bank_x{scale}_{size}.json')
+        manifest = []
+        for kernel_path in kernels_files:
+            stat = os.stat(kernel_path)
+            manifest.append([osp.relpath(kernel_path, kernels_path),
+                             stat.st_size, stat.st_mtime_ns])
+
+        if osp.exists(bank_path) and osp.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r') as f:
+                    saved_manifest = json.load(f)
+            except (OSError, ValueError):
+                saved_manifest = None
+            if saved_manifest == manifest:
+                return np.load(bank_path, mmap_mode='r')
+
+        pre_process = augmennt.CenterCrop(size)
+        kernels = np.empty((len(kernels_files), size, size), dtype=np.float32)
+        for i, kernel_path in enumerate(kernels_files):
+            with open(kernel_path, 'rb') as f:
+                kernel = np.load(f)
+            # making sure the kernel size (receptive field) is 13x13
+            # and normalize to make cropped kernel sum 1 again
+            kernels[i] = EF.norm_kernel(pre_process(kernel))
+
+        # write to temporary files and rename, so concurrent processes
+        # (i.e. distributed training ranks) never read a partial bank.
+        # The bank is replaced before the manifest, a reader in between
+        # finds them mismatched and rebuilds
+        tmp_bank = f'{bank_path}.{os.getpid()}.tmp'
+        tmp_manifest = f'{manifest_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_bank, 'wb') as f:
+                np.save(f, kernels)
+            with open(tmp_manifest, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_bank, bank_path)
+            os.replace(tmp_manifest, manifest_path)
+        except OSError:
+            # read-only kernels directory, keep in memory
+            for tmp_path in (tmp_bank, tmp_manifest):
+                if osp.exists(tmp_path):
+                    os.remove(tmp_path)
+        return kernels
+
+    def __len__(self):
+        return self.num_kernel
+
+    def __call__(self, img, index=None):
+        if index is None:
+            index = self.order[np.random.randint(0, self.num_kernel)]
+
+        if self.separable[index]:
+            out_im = cv2.sepFilter2D(img, -1,
+                kernelX=self.kernels_x[index], kernelY=self.kernels_y[index],
+                borderType=cv2.BORDER_REFLECT_101)
+        else:
+            out_im = augmennt.common.convolve(
+                img, np.ascontiguousarray(self.kernels[index]))
+
+        if self.scale > 1:
+            # downsample according to scale
+            out_im = augmennt.common.sample(
+                out_im, scale=self.scale, center=self.center)
+        return out_im
+
+    def get_kernels(self, device):
+        """Get the kernels as a tensor on 'device' (only copied once)."""
+        key = str(device)
+        if key not in self.device_kernels:
+            self.device_kernels[key] = torch.from_numpy(
+                np.array(self.kernels, dtype=np.float32)).to(device)
+        return self.device_kernels[key]
+
+    def apply_batch(self, imgs, idx=None):
+        """Convolve each image in a tensor batch (B, C, H, W) with a
+        different random kernel and downsample, all in a single
+        grouped convolution.
+        Args:
+            imgs: the batch of images.
+            idx: optional tensor with the kernel index for each image.
+        """
+        b, c, h, w = imgs.shape
+        kernels = self.get_kernels(imgs.device)
+        if idx is None:
+            idx = torch.randint(0, self.num_kernel, (b,), device=imgs.device)
+        k = kernels.shape[-1]
+
+        # (B, k, k) -> (B*C, 1, k, k), one kernel per image channel
+        weight = kernels[idx].to(imgs.dtype)
+        weight = weight[:, None, :, :].repeat_interleave(c, dim=0)
+
+        pad = k // 2
+        x = torch.nn.functional.pad(
+            imgs.reshape(1, b * c, h, w), (pad, pad, pad, pad), mode='reflect')
+        stride = int(self.scale) if self.scale > 1 else 1
+        if self.center and stride > 1:
+            st = (stride - 1) // 2
+            x = x[..., st:, st:]
+        out = torch.nn.functional.conv2d(x, weight, stride=stride, groups=b * c)
+        return out.reshape(b, c, out.shape[-2], out.shape[-1])
+
+    def __repr__(self):
+        return (self.__class__.__name__ +
+                f'(scale={self.scale}, kernels={self.num_kernel})')
+
+
 def get_ds_kernels(opt):
     """ 
     Use the previously extracted realistic estimated kernels 
@@ -1345,9 +1693,11 @@ def get_ds_kernels(opt):
             scale=opt.get('scale', 4)
 
     if types:
-        # TODO: could make this class into a pytorch dataloader,
-        # as an iterator can load all the kernels in init
-        if kernels_path:
+        if kernels_path and opt.get('kernel_bank', False):
+            # load all the kernels once in a memory-mapped bank
+            ds_kernels = KernelBank(
+                scale=scale, kernels_path=kernels_path, pattern='kernelgan')
+        elif kernels_path:
             ds_kernels = transforms.ApplyKernel(
                 scale=scale, kernels_path=kernels_path, pattern='kernelgan')
         else:
@@ -1363,7 +1713,10 @@ def get_noise_patches(opt):
     if opt['phase'] == 'train' and opt.get('lr_noise_types', 3) and "patches" in opt.get('lr_noise_types', {}):
         assert opt['noise_data']
         # noise_patches = NoisePatches(opt['noise_data'], opt.get('HR_size', 128)/opt.get('scale', 4))
-        noise_patches = NoisePatches(opt['noise_data'], opt.get('noise_data_size', 256))
+        if opt.get('noise_data_bank', False):
+            noise_patches = NoisePatchBank(opt['noise_data'], opt.get('noise_data_size', 256))
+        else:
+            noise_patches = NoisePatches(opt['noise_data'], opt.get('noise_data_size', 256))
     else:
         noise_patches = None
 
@@ -1636,6 +1989,20 @@ def get_unpaired_params(opt:dict):
     return lr_augs, hr_augs
 
 
+def aug_crop_size(opt:dict, params:dict=None, img_size:int=None):
+    """ Get the crop size for the augmentations 'kind' and
+    if adaptive scale is needed for in-pipeline resizing. """
+    scale = opt.get('scale', 1)
+    crop_size = opt.get('crop_size')
+    if params and params['kind'] == 'lr':
+        crop_size = crop_size // scale
+    ada_scale = False
+    if (img_size and -4 < (min(img_size) - crop_size) <= 4
+        and scale > 1):
+        ada_scale = True
+    return crop_size, ada_scale
+
+
 def get_augmentations(opt:dict, params:dict=None,
     noise_patches=None, ds_kernels=None, img_size:int=None):
     """ unpaired augmentations
@@ -1647,13 +2014,7 @@ def get_augmentations(opt:dict, params:dict=None,
     loader = set_transforms.loader_type
     set_transforms(loader_type='cv2')
     scale = opt.get('scale', 1)
-    crop_size = opt.get('crop_size')
-    if params and params['kind'] == 'lr':
-        crop_size = crop_size // scale
-    ada_scale = False
-    if (img_size and -4 < (min(img_size) - crop_size) <= 4
-        and scale > 1):
-        ada_scale = True
+    crop_size, ada_scale = aug_crop_size(opt, params, img_size)
 
     transform_list = aug_pipeline(
         params=params, noise_patches=noise_patches,
@@ -1663,16 +2024,72 @@ def get_augmentations(opt:dict, params:dict=None,
     return transforms.Compose(transform_list)
 
 
+# noise types that draw random parameters on initialization
+# that can't be sampled again, must always be rebuilt
+uncached_types = ('quantize', 'som_quantize')
+
+
+def refresh_params(transform):
+    """ Sample new random parameters for a reused transform.
+    Some transforms only draw their parameters on initialization
+    (noise levels, compression quality, blur kernels, etc), this
+    draws them again as if the transform had been recreated.
+    """
+    if transform is None or isinstance(transform, augmennt.AlignedDownsample):
+        return
+    if isinstance(transform, augmennt.RandomAnIsoBlur):
+        transform.kernel = EF.get_gaussian_kernel(**transform.get_params())
+    elif isinstance(transform, augmennt.RandomSincBlur):
+        transform.kernel = SCIP.get_sinc_kernel(**transform.get_params())
+    elif isinstance(getattr(transform, 'params', None), dict) and transform.params:
+        transform.params = transform.get_params()
+
+
+def cached_transform(cache:dict, key, build_fn):
+    """ Build a transform with 'build_fn' or, if a 'cache' is used,
+    reuse the transform previously built for the same 'key' with
+    new random parameters.
+    """
+    if cache is None or key[-1] in uncached_types:
+        return build_fn()
+    if key not in cache:
+        cache[key] = build_fn()
+    else:
+        refresh_params(cache[key])
+    return cache[key]
+
+
+def cached_scale(cache:dict, key, scale=None, ds_kernels=None,
+    resize_type=None, res_config=None):
+    """ Same as cached_transform(), for the in-pipeline Scale_class. """
+    if cache is None:
+        return Scale_class(scale=scale, ds_kernel=ds_kernels,
+                resize_type=resize_type, img_type='cv2', res_config=res_config)
+    if key not in cache:
+        cache[key] = Scale_class(scale=scale, ds_kernel=ds_kernels,
+                resize_type=resize_type, img_type='cv2', res_config=res_config)
+    else:
+        cache[key].set_params(scale=scale, resize_type=resize_type,
+                res_config=res_config)
+    return cache[key]
+
+
 def aug_pipeline(params:dict=None, noise_patches=None,
     scale=None, ds_kernels=None, crop_size:int=None,
-    ada_scale:bool=False):
+    ada_scale:bool=False, cache:dict=None):
+    """ Create the list of unpaired augmentations from the sampled
+    'params'. If a 'cache' dictionary is provided, the transforms
+    are reused from it (see: CompiledAugmentations).
+    """
 
+    kind = params.get('kind')
     transform_list = []
     # blur1
     if 'blur' in params:
         aug = list(params['blur'].keys())
         conf = list(params['blur'].values())[0]
-        blur_func = get_blur(aug, conf)
+        blur_func = cached_transform(cache, (kind, 'blur', aug[0]),
+            lambda: get_blur(aug, conf))
         if blur_func:
             transform_list.append(blur_func)
 
@@ -1682,8 +2099,9 @@ def aug_pipeline(params:dict=None, noise_patches=None,
         conf = params['resize'].get('add_conf').copy()
         if ada_scale:
             conf['ada_scale'] = ada_scale
-        res_func = Scale_class(scale=scale, ds_kernel=ds_kernels,
-                resize_type=algo, img_type='cv2', res_config=conf)
+        res_func = cached_scale(cache, (kind, 'resize', algo),
+                scale=scale, ds_kernels=ds_kernels,
+                resize_type=algo, res_config=conf)
         if res_func:
             transform_list.append(res_func)
 
@@ -1691,7 +2109,8 @@ def aug_pipeline(params:dict=None, noise_patches=None,
     if 'noise' in params:
         aug = list(params['noise'].keys())
         conf = list(params['noise'].values())[0]
-        noise_func = get_noise(aug, noise_patches, conf)
+        noise_func = cached_transform(cache, (kind, 'noise', aug[0]),
+            lambda: get_noise(aug, noise_patches, conf))
         if noise_func:
             transform_list.append(noise_func)
 
@@ -1699,30 +2118,35 @@ def aug_pipeline(params:dict=None, noise_patches=None,
     if 'compression' in params:
         aug = list(params['compression'].keys())
         conf = list(params['compression'].values())[0]
-        noise_func = get_noise(aug, noise_patches, conf)
+        noise_func = cached_transform(cache, (kind, 'compression', aug[0]),
+            lambda: get_noise(aug, noise_patches, conf))
         if noise_func:
             transform_list.append(noise_func)
 
     # auto levels / color balance
     if 'auto_levels' in params:
-        transform_list.append(transforms.FilterColorBalance(
-            **params['auto_levels']))
+        transform_list.append(cached_transform(
+            cache, (kind, 'auto_levels'),
+            lambda: transforms.FilterColorBalance(**params['auto_levels'])))
 
     # unsharpening mask
     if 'unsharp' in params:
-        transform_list.append(transforms.FilterUnsharp(
-            **params['unsharp']))
+        transform_list.append(cached_transform(
+            cache, (kind, 'unsharp'),
+            lambda: transforms.FilterUnsharp(**params['unsharp'])))
 
     # color fringes
     if 'fringes' in params:
-        transform_list.append(transforms.RandomChromaticAberration(
-            **params['fringes']))
+        transform_list.append(cached_transform(
+            cache, (kind, 'fringes'),
+            lambda: transforms.RandomChromaticAberration(**params['fringes'])))
 
     # blur2
     if 'blur2' in params:
         aug = list(params['blur2'].keys())
         conf = list(params['blur2'].values())[0]
-        blur_func = get_blur(aug, conf)
+        blur_func = cached_transform(cache, (kind, 'blur2', aug[0]),
+            lambda: get_blur(aug, conf))
         if blur_func:
             transform_list.append(blur_func)
 
@@ -1732,8 +2156,9 @@ def aug_pipeline(params:dict=None, noise_patches=None,
         conf = params['resize2'].get('add_conf').copy()
         if ada_scale:
             conf['ada_scale'] = ada_scale
-        res_func = Scale_class(scale=scale, ds_kernel=ds_kernels,
-                resize_type=algo, img_type='cv2', res_config=conf)
+        res_func = cached_scale(cache, (kind, 'resize2', algo),
+                scale=scale, ds_kernels=ds_kernels,
+                resize_type=algo, res_config=conf)
         if res_func:
             transform_list.append(res_func)
 
@@ -1741,7 +2166,8 @@ def aug_pipeline(params:dict=None, noise_patches=None,
     if 'noise2' in params:
         aug = list(params['noise2'].keys())
         conf = list(params['noise2'].values())[0]
-        noise_func = get_noise(aug, noise_patches, conf)
+        noise_func = cached_transform(cache, (kind, 'noise2', aug[0]),
+            lambda: get_noise(aug, noise_patches, conf))
         if noise_func:
             transform_list.append(noise_func)
 
@@ -1754,7 +2180,8 @@ def aug_pipeline(params:dict=None, noise_patches=None,
     if 'final_compression' in params:
         aug = list(params['final_compression'].keys())
         conf = list(params['final_compression'].values())[0]
-        noise_func = get_noise(aug, noise_patches, conf)
+        noise_func = cached_transform(cache, (kind, 'final_compression', aug[0]),
+            lambda: get_noise(aug, noise_patches, conf))
         if noise_func:
             final_compression_transform.append(noise_func)
 
@@ -1762,10 +2189,12 @@ def aug_pipeline(params:dict=None, noise_patches=None,
     final_resize_transform = []
     if 'final_scale' in params:
         algo = params['final_scale'][0]
-        res_func = Scale_class(
-            # size=(crop_size, crop_size, 3), resize_type=algo,
-            size=(crop_size, crop_size), resize_type=algo,
-            img_type='cv2')
+        # the final resize has no random parameters
+        res_func = cached_transform(cache, (kind, 'final_scale', crop_size, algo),
+            lambda: Scale_class(
+                # size=(crop_size, crop_size, 3), resize_type=algo,
+                size=(crop_size, crop_size), resize_type=algo,
+                img_type='cv2'))
         if res_func:
             final_resize_transform.append(res_func)
 
@@ -1773,7 +2202,8 @@ def aug_pipeline(params:dict=None, noise_patches=None,
         if 'final_blur' in params:
             aug = list(params['final_blur'].keys())
             conf = list(params['final_blur'].values())[0]
-            blur_func = get_blur(aug, conf)
+            blur_func = cached_transform(cache, (kind, 'final_blur', aug[0]),
+                lambda: get_blur(aug, conf))
             if blur_func:
                 final_resize_transform.append(blur_func)
 
@@ -1788,19 +2218,67 @@ def aug_pipeline(params:dict=None, noise_patches=None,
     # TODO: update and test cutout and erasing
     # cutout
     if 'cutout' in params:
-        transform_list.append(transforms.Cutout(
-            p=params['cutout'], mask_size=crop_size//2))
+        transform_list.append(cached_transform(
+            cache, (kind, 'cutout', crop_size),
+            lambda: transforms.Cutout(
+                p=params['cutout'], mask_size=crop_size//2)))
 
     # random erasing
     if 'erasing' in params:
         # transform_list.append(transforms.RandomErasing(p=params['erasing']))  # mode=[3]. With lambda?
-        transform_list.append(transforms.Lambda(
+        erasing_p = params['erasing']
+        transform_list.append(cached_transform(
+            cache, (kind, 'erasing'),
+            lambda: transforms.Lambda(
                 lambda img: transforms.RandomErasing(
-                    p=params['erasing'])(img, mode=[3])))
+                    p=erasing_p)(img, mode=[3]))))
 
     return transform_list
 
 
+class CompiledAugmentations:
+    """ Unpaired augmentations pipeline that reuses the transforms
+    between samples, instead of creating them again for every
+    image like get_augmentations() does.
+    Each transform is built the first time it is selected (this
+    happens independently in every dataloader worker) and for
+    later samples only its random parameters are sampled again.
+    The sampled augmentations 'params' (get_unpaired_params())
+    and the order of the pipeline remain the same.
+    Args:
+        opt: the dataset options dictionary.
+        noise_patches: NoisePatches dataset, if used.
+        ds_kernels: the realistic downscaling kernels, if used.
+    """
+    def __init__(self, opt:dict, noise_patches=None, ds_kernels=None):
+        # the augmentations always use the cv2 backend
+        set_transforms(loader_type='cv2')
+        self.opt = opt
+        self.scale = opt.get('scale', 1)
+        self.noise_patches = noise_patches
+        self.ds_kernels = ds_kernels
+        self.cache = {}
+
+    def __call__(self, img, params:dict=None, img_size:int=None):
+        if not params:
+            return img
+
+        crop_size, ada_scale = aug_crop_size(self.opt, params, img_size)
+        transform_list = aug_pipeline(
+            params=params, noise_patches=self.noise_patches,
+            scale=self.scale, ds_kernels=self.ds_kernels,
+            crop_size=crop_size, ada_scale=ada_scale,
+            cache=self.cache)
+
+        for t in transform_list:
+            img = t(img)
+        return img
+
+    def __repr__(self):
+        return (self.__class__.__name__ +
+                f'(cached={len(self.cache)})')
+
+
 # TODO: these don't change, can be fixed from the dataloader init
 def get_totensor_params(opt):
     params = {}
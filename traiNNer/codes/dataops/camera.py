@@ -0,0 +1,429 @@
+"""Batched torch implementation of the unprocess/process camera
+RAW noise pipeline.
+
+Mirrors the numpy functions in ``augmennt/camera.py`` (used by
+``extra_functional.camera_noise()``), but operates on [B, C, H, W]
+RGB tensors in the [0, 1] range and samples independent metadata
+(CCMs, gains and noise levels) for every image in the batch, so
+it can run on the training device instead of in the dataloader
+workers.
+
+Ref:
+    Brooks, T., Mildenhall, B., Xue, T., Chen, J., Sharlet, D., &
+    Barron, J. T. (2019). Unprocessing Images for Learned Raw
+    Denoising. https://arxiv.org/abs/1811.11127
+"""
+
+import math
+
+import torch
+from torch.nn import functional as F
+
+
+######################
+# Unprocess
+######################
+
+
+_xyz2cams = [[[1.0234, -0.2969, -0.2266],
+              [-0.5625, 1.6328, -0.0469],
+              [-0.0703, 0.2188, 0.6406]],
+             [[0.4913, -0.0541, -0.0202],
+              [-0.613, 1.3513, 0.2906],
+              [-0.1564, 0.2151, 0.7183]],
+             [[0.838, -0.263, -0.0639],
+              [-0.2887, 1.0725, 0.2496],
+              [-0.0627, 0.1427, 0.5438]],
+             [[0.6596, -0.2079, -0.0562],
+              [-0.4782, 1.3016, 0.1933],
+              [-0.097, 0.1581, 0.5181]]]
+
+_rgb2xyz = {
+    'D50': [[0.4360747, 0.3850649, 0.1430804],
+            [0.2225045, 0.7168786, 0.0606169],
+            [0.0139322, 0.0971045, 0.7141733]],
+    'D65a': [[0.412391, 0.357584, 0.180481],
+             [0.212639, 0.715169, 0.072192],
+             [0.019331, 0.119195, 0.950532]],
+    'D65': [[0.4124564, 0.3575761, 0.1804375],
+            [0.2126729, 0.7151522, 0.0721750],
+            [0.0193339, 0.1191920, 0.9503041]],
+}
+
+
+def random_ccm(batch:int=1, xyz_arr:str='D65',
+    device=None) -> torch.Tensor:
+    """Generates a batch of random RGB -> Camera color
+    correction matrices, of shape [B, 3, 3].
+    Ref:
+        https://doi.org/10.1117/1.OE.59.11.110801
+    """
+    # takes a random convex combination of XYZ -> Camera CCMs
+    xyz2cams = torch.tensor(
+        _xyz2cams, dtype=torch.float64, device=device)
+    weights = torch.empty(
+        (batch, xyz2cams.shape[0], 1, 1), dtype=torch.float64,
+        device=device).uniform_(1e-8, 1e8)
+    xyz2cam = ((xyz2cams.unsqueeze(0) * weights).sum(dim=1)
+        / weights.sum(dim=1))
+
+    # multiplies with RGB -> XYZ to get RGB -> Camera CCM
+    rgb2xyz = torch.tensor(_rgb2xyz.get(xyz_arr, _rgb2xyz['D65']),
+        dtype=torch.float64, device=device)
+    rgb2cam = torch.matmul(xyz2cam, rgb2xyz)
+
+    # normalizes each row
+    rgb2cam = rgb2cam / rgb2cam.sum(dim=-1, keepdim=True)
+    return rgb2cam
+
+
+def random_gains(batch:int=1, rg_range=(1.9, 2.4),
+    bg_range=(1.5, 1.9), device=None) -> tuple:
+    """Generates random gains for brightening and white balance,
+    each of shape [B]."""
+    # RGB gain represents brightening
+    rgb_gain = 1.0 / torch.empty(batch, device=device).normal_(0.8, 0.1)
+
+    # red and blue gains represent white balance
+    red_gain = torch.empty(batch, device=device).uniform_(*rg_range)
+    blue_gain = torch.empty(batch, device=device).uniform_(*bg_range)
+    return rgb_gain, red_gain, blue_gain
+
+
+def inverse_smoothstep(image:torch.Tensor) -> torch.Tensor:
+    """Approximately inverts a global tone mapping curve."""
+    image = image.clamp(0.0, 1.0)
+    return 0.5 - torch.sin(torch.asin(1.0 - 2.0 * image) / 3.0)
+
+
+def gamma_expansion(image:torch.Tensor) -> torch.Tensor:
+    """Converts from gamma to linear space."""
+    # clamps to prevent numerical instability of gradients near zero
+    return image.clamp(min=1e-8) ** 2.2
+
+
+def apply_ccm(image:torch.Tensor, ccm:torch.Tensor) -> torch.Tensor:
+    """Applies a batch of color correction matrices ([B, 3, 3])
+    to a batch of images ([B, 3, H, W])."""
+    return torch.einsum('bij,bjhw->bihw', ccm.to(image.dtype), image)
+
+
+def safe_invert_gains(image:torch.Tensor, rgb_gain:torch.Tensor,
+    red_gain:torch.Tensor, blue_gain:torch.Tensor) -> torch.Tensor:
+    """Inverts gains while safely handling saturated pixels."""
+    gains = torch.stack(
+        [1.0 / red_gain, torch.ones_like(red_gain), 1.0 / blue_gain],
+        dim=1) / rgb_gain.unsqueeze(1)
+    gains = gains[:, :, None, None]
+
+    # prevents dimming of saturated pixels by smoothly masking gains near white
+    gray = image.mean(dim=1, keepdim=True)
+    inflection = 0.9
+    mask = ((gray - inflection).clamp(min=0.0) / (1.0 - inflection)) ** 2.0
+    safe_gains = torch.max(mask + (1.0 - mask) * gains, gains)
+    return image * safe_gains
+
+
+def mosaic(image:torch.Tensor) -> torch.Tensor:
+    """Extracts RGGB Bayer planes from a batch of RGB images
+    ([B, 3, H, W]) as a [B, 4, H/2, W/2] tensor with the
+    [R, Gr, Gb, B] planes on separate channels. H and W must
+    be even."""
+    red = image[:, 0, 0::2, 0::2]
+    green_red = image[:, 1, 0::2, 1::2]
+    green_blue = image[:, 1, 1::2, 0::2]
+    blue = image[:, 2, 1::2, 1::2]
+    return torch.stack([red, green_red, green_blue, blue], dim=1)
+
+
+def unprocess(image:torch.Tensor, xyz_arr:str='D50',
+    rg_range:tuple=(1.2, 2.4), bg_range:tuple=(1.2, 2.4)) -> tuple:
+    """Unprocesses a batch of images from sRGB to realistic raw
+    data. Metadata is sampled independently for each image."""
+    batch = image.shape[0]
+    device = image.device
+
+    # randomly creates image metadata
+    rgb2cam = random_ccm(batch, xyz_arr=xyz_arr, device=device)
+    cam2rgb = torch.inverse(rgb2cam)
+    rgb_gain, red_gain, blue_gain = random_gains(
+        batch, rg_range, bg_range, device=device)
+
+    # approximately inverts global tone mapping
+    image = inverse_smoothstep(image)
+    # inverts gamma compression
+    image = gamma_expansion(image)
+    # inverts color correction
+    image = apply_ccm(image, rgb2cam)
+    # approximately inverts white balance and brightening
+    image = safe_invert_gains(image, rgb_gain, red_gain, blue_gain)
+    # clips saturated pixels
+    image = image.clamp(0.0, 1.0)
+    # applies a Bayer mosaic
+    image = mosaic(image)
+
+    metadata = {
+        'cam2rgb': cam2rgb,
+        'rgb_gain': rgb_gain,
+        'red_gain': red_gain,
+        'blue_gain': blue_gain,
+    }
+    return image, metadata
+
+
+def random_noise_levels(batch:int=1, device=None) -> tuple:
+    """ Generates random noise levels from a log-log
+        linear distribution, each of shape [B].
+    """
+    log_min_shot_noise = math.log(0.0001)
+    log_max_shot_noise = math.log(0.012)
+    log_shot_noise = torch.empty(batch, device=device).uniform_(
+        log_min_shot_noise, log_max_shot_noise)
+    shot_noise = torch.exp(log_shot_noise)
+
+    line = lambda x: 2.18 * x + 1.20
+    log_read_noise = line(log_shot_noise) + torch.empty(
+        batch, device=device).normal_(0.0, 0.26)
+    read_noise = torch.exp(log_read_noise)
+    return shot_noise, read_noise
+
+
+def add_noise(image:torch.Tensor, shot_noise:torch.Tensor,
+    read_noise:torch.Tensor) -> torch.Tensor:
+    """ Adds random shot (proportional to image) and read
+        (independent) noise, with per image levels.
+    """
+    variance = (image * shot_noise[:, None, None, None]
+        + read_noise[:, None, None, None])
+    noise = torch.randn_like(image) * torch.sqrt(variance.clamp(min=0.0))
+    return image + noise
+
+
+######################
+# Demosaic
+######################
+
+
+def _malvar_kernels() -> torch.Tensor:
+    """Returns the Malvar (2004) 5x5 filters stacked as
+    [GR_GB, Rg_RB_Bg_BR, Rg_BR_Bg_RB, Rb_BB_Br_RR]."""
+    GR_GB = torch.tensor(
+        [[0, 0, -1, 0, 0],
+         [0, 0, 2, 0, 0],
+         [-1, 2, 4, 2, -1],
+         [0, 0, 2, 0, 0],
+         [0, 0, -1, 0, 0]], dtype=torch.float32) / 8
+
+    Rg_RB_Bg_BR = torch.tensor(
+        [[0, 0, 0.5, 0, 0],
+         [0, -1, 0, -1, 0],
+         [-1, 4, 5, 4, - 1],
+         [0, -1, 0, -1, 0],
+         [0, 0, 0.5, 0, 0]], dtype=torch.float32) / 8
+
+    Rg_BR_Bg_RB = Rg_RB_Bg_BR.t()
+
+    Rb_BB_Br_RR = torch.tensor(
+        [[0, 0, -1.5, 0, 0],
+         [0, 2, 0, 2, 0],
+         [-1.5, 0, 6, 0, -1.5],
+         [0, 2, 0, 2, 0],
+         [0, 0, -1.5, 0, 0]], dtype=torch.float32) / 8
+
+    return torch.stack(
+        [GR_GB, Rg_RB_Bg_BR, Rg_BR_Bg_RB, Rb_BB_Br_RR]).unsqueeze(1)
+
+
+def demosaic_malvar(bayer_images:torch.Tensor) -> torch.Tensor:
+    """ Demosaics a batch of RGGB Bayer planes ([B, 4, H/2, W/2])
+        into RGB images ([B, 3, H, W]) using the *Malvar (2004)*
+        algorithm. All four filters are evaluated with a single
+        convolution over the full resolution CFA, and the results
+        are picked per Bayer position on the half resolution grid.
+    References
+        Malvar, H. S., He, L.-W., Cutler, R., & Way, O. M. (2004).
+        High-Quality Linear Interpolation for Demosaicing of
+        Bayer-Patterned Color Images.
+        International Conference of Acoustic, Speech and Signal Processing, 5-8.
+    """
+    # [R, Gr, Gb, B] planes to single channel RGGB CFA
+    cfa = F.pixel_shuffle(bayer_images, 2)
+    kernels = _malvar_kernels().to(
+        device=cfa.device, dtype=cfa.dtype)
+    filtered = F.conv2d(F.pad(cfa, (2, 2, 2, 2), mode='reflect'), kernels)
+
+    # back to the half resolution grid, one [B, 4, H/2, W/2]
+    # tensor per Bayer position, with the filters on the channels
+    at_r = filtered[:, :, 0::2, 0::2]
+    at_gr = filtered[:, :, 0::2, 1::2]  # green in red rows
+    at_gb = filtered[:, :, 1::2, 0::2]  # green in blue rows
+    at_b = filtered[:, :, 1::2, 1::2]
+    r, gr, gb, b = bayer_images.unbind(dim=1)
+
+    red = torch.stack(
+        [r, at_gr[:, 1], at_gb[:, 2], at_b[:, 3]], dim=1)
+    green = torch.stack(
+        [at_r[:, 0], gr, gb, at_b[:, 0]], dim=1)
+    blue = torch.stack(
+        [at_r[:, 3], at_gr[:, 2], at_gb[:, 1], b], dim=1)
+
+    return torch.cat([F.pixel_shuffle(red, 2),
+        F.pixel_shuffle(green, 2), F.pixel_shuffle(blue, 2)], dim=1)
+
+
+def demosaic_bilinear(bayer_images:torch.Tensor) -> torch.Tensor:
+    """ Demosaics a batch of RGGB Bayer planes ([B, 4, H/2, W/2])
+        into RGB images ([B, 3, H, W]) using bilinear interpolation.
+    """
+    b, _, h, w = bayer_images.shape
+    zeros = torch.zeros((b, h, w), dtype=bayer_images.dtype,
+        device=bayer_images.device)
+    r, gr, gb, bl = bayer_images.unbind(dim=1)
+    masked = torch.cat([
+        F.pixel_shuffle(torch.stack([r, zeros, zeros, zeros], dim=1), 2),
+        F.pixel_shuffle(torch.stack([zeros, gr, gb, zeros], dim=1), 2),
+        F.pixel_shuffle(torch.stack([zeros, zeros, zeros, bl], dim=1), 2),
+        ], dim=1)
+
+    H_G = torch.tensor(
+        [[0, 1, 0],
+         [1, 4, 1],
+         [0, 1, 0]], dtype=masked.dtype, device=masked.device) / 4
+    H_RB = torch.tensor(
+        [[1, 2, 1],
+         [2, 4, 2],
+         [1, 2, 1]], dtype=masked.dtype, device=masked.device) / 4
+    kernels = torch.stack([H_RB, H_G, H_RB]).unsqueeze(1)
+    return F.conv2d(
+        F.pad(masked, (1, 1, 1, 1), mode='reflect'), kernels, groups=3)
+
+
+def demosaic(bayer_images:torch.Tensor, dmscfn:str='malvar') -> torch.Tensor:
+    """Demosaic method selector."""
+    if dmscfn == 'bilinear':
+        return demosaic_bilinear(bayer_images)
+    elif dmscfn == 'pixelshuffle':
+        # simple nearest fill, as in augmennt's demosaic_pixelshuffle
+        r, gr, gb, b = bayer_images.unbind(dim=1)
+        g = (gr + gb) / 2
+        rgb = torch.stack([r, g, b], dim=1)
+        return F.interpolate(rgb, scale_factor=2, mode='nearest')
+    # 'menon' is not vectorized, fall back to malvar
+    return demosaic_malvar(bayer_images)
+
+
+######################
+# Process
+######################
+
+
+def apply_gains(bayer_images:torch.Tensor, red_gains:torch.Tensor,
+    blue_gains:torch.Tensor) -> torch.Tensor:
+    """Applies white balance gains to a batch of Bayer images."""
+    green_gains = torch.ones_like(red_gains)
+    gains = torch.stack(
+        [red_gains, green_gains, green_gains, blue_gains], dim=1)
+    return bayer_images * gains[:, :, None, None]
+
+
+def gamma_compression(images:torch.Tensor, gamma:float=2.2) -> torch.Tensor:
+    """Converts from linear to gamma space."""
+    # clamps to prevent numerical instability of gradients near zero
+    return images.clamp(min=1e-8) ** (1.0 / gamma)
+
+
+def smoothstep(image:torch.Tensor) -> torch.Tensor:
+    """A global tone mapping curve."""
+    image = image.clamp(0.0, 1.0)
+    return 3.0 * image**2 - 2.0 * image**3
+
+
+def process(bayer_images:torch.Tensor, red_gains:torch.Tensor,
+    blue_gains:torch.Tensor, cam2rgbs:torch.Tensor,
+    dmscfn:str='malvar') -> torch.Tensor:
+    """Processes a batch of Bayer RGGB images into sRGB images."""
+    # white balance
+    bayer_images = apply_gains(bayer_images, red_gains, blue_gains)
+    # demosaic
+    bayer_images = bayer_images.clamp(0.0, 1.0)
+    images = demosaic(bayer_images, dmscfn)
+    # color correction
+    images = apply_ccm(images, cam2rgbs)
+    # gamma compression
+    images = images.clamp(0.0, 1.0)
+    images = gamma_compression(images)
+    images = smoothstep(images)
+    return images
+
+
+def camera_noise(images:torch.Tensor, xyz_arr:str='D50',
+    dmscfn:str='malvar', rg_range:tuple=(1.2, 2.4),
+    bg_range:tuple=(1.2, 2.4)) -> torch.Tensor:
+    """ Batched equivalent of ``extra_functional.camera_noise()``.
+    Applies the unprocess/process pipeline to a batch of RGB
+    images ([B, 3, H, W], range [0, 1]) to add realistic RAW
+    camera noise. Odd sized images are reflect padded to even
+    dimensions and cropped back afterwards.
+    """
+    input_dtype = images.dtype
+    h, w = images.shape[-2:]
+    pad_h, pad_w = h % 2, w % 2
+    if pad_h or pad_w:
+        images = F.pad(images, (0, pad_w, 0, pad_h), mode='reflect')
+    images = images.float()
+
+    # unprocess images
+    deg_imgs, metadata = unprocess(images, xyz_arr=xyz_arr,
+        rg_range=rg_range, bg_range=bg_range)
+
+    # add noise
+    shot_noise, read_noise = random_noise_levels(
+        images.shape[0], device=images.device)
+    deg_imgs = add_noise(deg_imgs, shot_noise, read_noise)
+
+    # process images
+    deg_imgs = process(deg_imgs, metadata['red_gain'],
+        metadata['blue_gain'], metadata['cam2rgb'], dmscfn=dmscfn)
+
+    # match the uint8 rounding of the per image pipeline
+    deg_imgs = torch.round(deg_imgs.clamp(0, 1) * 255) / 255
+    return deg_imgs[..., :h, :w].to(input_dtype)
+
+
+class BatchCameraNoise:
+    """Applies the batched camera noise pipeline to the LR images
+    of a training batch, with probability `camera_noise_p` per
+    image.
+    Args:
+        train_opt: the training options, reads `camera_noise_xyz`,
+            `camera_noise_dmscfn` and `camera_noise_p`.
+        znorm: if the images are in the [-1, 1] range.
+    """
+    def __init__(self, train_opt, znorm=False):
+        self.xyz_arr = train_opt.get("camera_noise_xyz", "D50")
+        self.dmscfn = train_opt.get("camera_noise_dmscfn", "malvar")
+        self.p = train_opt.get("camera_noise_p", 1.0)
+        self.znorm = znorm
+
+    def __call__(self, img):
+        if self.p < 1.0:
+            mask = torch.rand(img.shape[0], device=img.device) < self.p
+            if not mask.any():
+                return img
+        else:
+            mask = None
+
+        if self.znorm:
+            img = (img + 1.0) / 2.0
+
+        sel = img[mask] if mask is not None else img
+        noisy = camera_noise(sel, xyz_arr=self.xyz_arr, dmscfn=self.dmscfn)
+        if mask is not None:
+            img = img.clone()
+            img[mask] = noisy
+        else:
+            img = noisy
+
+        if self.znorm:
+            img = img * 2.0 - 1.0
+        return img
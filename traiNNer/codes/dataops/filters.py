@@ -786,9 +786,38 @@ def grad_orientation(grad_y, grad_x):
     return go
 
 
+def box_filter(x: torch.Tensor, r: int) -> torch.Tensor:
+    """ Mean filter with a (2*r)+1 window, using cumulative sums,
+    so the cost per pixel doesn't depend on the window size. The
+    borders are reflect padded, like filter2D() with a box kernel.
+    Arguments:
+        x: input tensor with shape [b, c, h, w].
+        r (int): radius of the window.
+    Returns:
+        the filtered tensor, with the same shape as the input.
+    """
+    ks = (2*r)+1
+    dtype = x.dtype
+    if dtype in (torch.float16, torch.bfloat16):
+        x = x.float()
+
+    # remove the per channel mean to reduce the cumsum precision loss
+    offset = x.mean(dim=(-2, -1), keepdim=True)
+    x = F.pad(x - offset, [r, r, r, r], mode='reflect')
+
+    # vertical and horizontal window sums (difference of cumsums)
+    x = F.pad(x.cumsum(dim=-2), [0, 0, 1, 0])
+    x = x[..., ks:, :] - x[..., :-ks, :]
+    x = F.pad(x.cumsum(dim=-1), [1, 0, 0, 0])
+    x = x[..., ks:] - x[..., :-ks]
+
+    return (x / (ks*ks) + offset).to(dtype)
+
+
 def guided_filter(x: torch.Tensor, y: torch.Tensor,
     x_HR: torch.Tensor = None, ks=None, r=None, eps:float=1e-2,
-    box_kernel=None, mode:str='regular', conv_a=None) -> torch.Tensor:
+    box_kernel=None, mode:str='regular', conv_a=None,
+    fused:bool=True) -> torch.Tensor:
     """ Guided filter / FastGuidedFilter function.
     This is a kind of edge-preserving smoothing filter that can
     filter out noise or texture while retaining sharp edges. One
@@ -809,6 +838,9 @@ def guided_filter(x: torch.Tensor, y: torch.Tensor,
             'conv' mode to calculate the 'A' parameter.
         eps: regularization ε, penalizing large A values.
             eps = 1e-8 in the original paper.
+        fused: use the cumsum box_filter() on the stacked inputs,
+            instead of one filter2D() convolution per statistic.
+            Only for uniform box kernels of odd size.
     Returns:
         output: filtered image
 
@@ -829,6 +861,12 @@ def guided_filter(x: torch.Tensor, y: torch.Tensor,
         # mean filter. The window size is defined by the kernel size.
         box_kernel = get_box_kernel(kernel_size = ks)
 
+    if fused and box_kernel.shape[-1] == box_kernel.shape[-2] \
+            and box_kernel.shape[-1] % 2 == 1 \
+            and torch.allclose(box_kernel, box_kernel.mean()):
+        return _guided_filter_fused(x, y, x_HR, r=box_kernel.shape[-1]//2,
+            eps=eps, mode=mode, conv_a=conv_a)
+
     x_shape = x.shape
     # y_shape = y.shape
     if isinstance(x_HR, torch.Tensor):
@@ -870,13 +908,79 @@ def guided_filter(x: torch.Tensor, y: torch.Tensor,
     return output
 
 
+def _guided_filter_fused(x: torch.Tensor, y: torch.Tensor,
+    x_HR: torch.Tensor = None, r:int=1, eps:float=1e-2,
+    mode:str='regular', conv_a=None) -> torch.Tensor:
+    """ guided_filter() calculating the mean, variance and
+    covariance with a single box_filter() pass over the stacked
+    [x, y, x*y, x*x] channels, and mean_A, mean_b with another.
+    """
+    c = y.shape[1]
+    if x.shape[1] != c:
+        # single channel guidance
+        x = x.expand_as(y)
+
+    means = box_filter(torch.cat([x, y, x*y, x*x], dim=1), r)
+    mean_x, mean_y, mean_xy, mean_xx = torch.split(means, c, dim=1)
+    cov_xy = mean_xy - mean_x*mean_y
+    var_x = mean_xx - mean_x*mean_x
+
+    # linear coefficients A, b
+    if mode == 'conv':
+        A = conv_a(torch.cat([cov_xy, var_x], dim=1))
+    else:
+        A = cov_xy / (var_x + eps)
+    b = mean_y - A * mean_x
+
+    if mode == 'fast' or mode == 'conv':
+        Ab = F.interpolate(
+            torch.cat([A, b], dim=1), x_HR.shape[-2:],
+            mode='bilinear', align_corners=True)
+        guide = x_HR
+    else:
+        Ab = box_filter(torch.cat([A, b], dim=1), r)
+        guide = x
+    mean_A, mean_b = torch.split(Ab, A.shape[1], dim=1)
+    return mean_A * guide + mean_b
+
+
+def fast_guided_filter(x: torch.Tensor, y: torch.Tensor,
+    r:int=1, eps:float=1e-2, s:int=4) -> torch.Tensor:
+    """ Fast guided filter for large images. The linear coefficients
+    are calculated on the inputs subsampled by a factor 's' (with a
+    r/s window) and bilinearly upsampled to apply them to the full
+    resolution guidance image, reducing the cost by ~s^2.
+    ref: https://arxiv.org/abs/1505.00996
+    """
+    h, w = x.shape[-2:]
+    size = (max(h // s, 1), max(w // s, 1))
+    x_lr = F.interpolate(x, size, mode='bilinear', align_corners=False)
+    y_lr = F.interpolate(y, size, mode='bilinear', align_corners=False)
+    r_lr = max(round(r / s), 1)
+
+    c = y.shape[1]
+    if x.shape[1] != c:
+        x, x_lr = x.expand_as(y), x_lr.expand_as(y_lr)
+
+    means = box_filter(torch.cat([x_lr, y_lr, x_lr*y_lr, x_lr*x_lr], dim=1), r_lr)
+    mean_x, mean_y, mean_xy, mean_xx = torch.split(means, c, dim=1)
+    A = (mean_xy - mean_x*mean_y) / (mean_xx - mean_x*mean_x + eps)
+    b = mean_y - A * mean_x
+
+    Ab = F.interpolate(box_filter(torch.cat([A, b], dim=1), r_lr),
+        (h, w), mode='bilinear', align_corners=False)
+    mean_A, mean_b = torch.split(Ab, c, dim=1)
+    return mean_A * x + mean_b
+
+
 class GuidedFilter(nn.Module):
     """Differentiable GuidedFilter module."""
     def __init__(self, ks=None, r=None, eps:float=1e-2,
-        mode:str='regular', norm=nn.BatchNorm2d): #eps=1e-8
+        mode:str='regular', norm=nn.BatchNorm2d, fused:bool=True): #eps=1e-8
         super(GuidedFilter, self).__init__()
         self.eps = eps
         self.mode = mode
+        self.fused = fused
 
         if not ks and not r:
             raise ValueError("Either kernel size (ks) or radius (r) "
@@ -915,5 +1019,6 @@ class GuidedFilter(nn.Module):
             assert c_x == c_hrx
 
         return guided_filter(x, y, x_HR, box_kernel=self.box_kernel,
-                                eps=self.eps, mode=self.mode, conv_a=self.conv_a)
+                                eps=self.eps, mode=self.mode, conv_a=self.conv_a,
+                                fused=self.fused)
 
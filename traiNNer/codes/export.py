@@ -0,0 +1,97 @@
+"""Export a generator to TorchScript and/or ONNX with dynamic
+spatial axes, check the parity of the exported models against
+the eager model on random inputs and optionally compare their
+CPU latency. The `compact` format saves the weights in the compact
+checkpoint format (fp16/bf16, keys already converted for the
+architecture), that loads memory-mapped with `pretrain_model_G`.
+Uses the same options file as test.py, the model is loaded from
+`pretrain_model_G`. Example:
+    python export.py -opt options/sr/test_sr.yml -benchmark 20
+"""
+
+import copy
+import os
+import sys
+import time
+
+import torch
+
+from models import create_model
+from models import export
+from train import parse_options, dir_check, configure_loggers
+from utils import util
+from utils.checkpoint import atomic_save, compact_state, load_checkpoint
+
+
+def main():
+    # parse options, using the test options file
+    opt = parse_options(is_train=False)
+    dir_check(opt)
+    configure_loggers(opt)
+    logger = util.get_root_logger()
+
+    export_opt = opt.get('export', None) or {}
+    formats = export_opt.get('format', 'torchscript,onnx')
+    formats = [f.strip().lower() for f in formats.split(',')]
+    tolerance = export_opt.get('tolerance', 1e-4)
+    sizes = [tuple(s) for s in export_opt.get('parity_sizes', [[32, 32], [48, 64]])]
+    save_dir = export_opt.get('save_dir', None) or opt['path']['results_root']
+    util.mkdir(save_dir)
+
+    model = create_model(opt)
+    net = export.bare_model(model.netG)
+    in_nc = opt['network_G'].get('in_nc', 3)
+    example = torch.rand(1, in_nc, *sizes[0])
+
+    failed = {}
+    for fmt in formats:
+        fmt_tolerance = tolerance
+        if fmt == 'compact':
+            dtype = export_opt.get('compact_dtype', 'fp16')
+            save_path = os.path.join(save_dir, f"{opt['name']}_{dtype}.pth")
+            atomic_save(compact_state(net.state_dict(), dtype), save_path)
+            logger.info(f'Compact model saved to [{save_path:s}]')
+            start = time.perf_counter()
+            exported = copy.deepcopy(net)
+            exported.load_state_dict(load_checkpoint(save_path)['state_dict'])
+            logger.info(f'[{fmt}] load time: {(time.perf_counter() - start) * 1000:.1f} ms')
+            # reduced precision weights
+            fmt_tolerance = export_opt.get('compact_tolerance', 1e-2)
+        elif fmt == 'torchscript':
+            save_path = os.path.join(save_dir, f"{opt['name']}.pt")
+            exported = export.export_torchscript(net, example, save_path)
+        elif fmt == 'onnx':
+            save_path = os.path.join(save_dir, f"{opt['name']}.onnx")
+            exported = export.export_onnx(
+                net, example, save_path, opset=export_opt.get('opset', 13))
+            if exported is None:
+                continue
+        else:
+            raise NotImplementedError(f'Export format [{fmt:s}] not recognized.')
+
+        # parity test
+        errors = export.check_parity(net, exported, in_nc=in_nc, sizes=sizes)
+        for (h, w), err in errors.items():
+            status = 'OK' if err <= fmt_tolerance else 'FAILED'
+            logger.info(f'[{fmt}] parity {h}x{w}: max error {err:.3e} ({status})')
+            if err > fmt_tolerance:
+                failed[fmt] = fmt_tolerance
+
+        # latency benchmark
+        if opt.get('benchmark_iters'):
+            bench_size = export_opt.get('benchmark_size', [64, 64])
+            latency = export.benchmark(
+                net, exported, torch.rand(1, in_nc, *bench_size),
+                n_iters=opt['benchmark_iters'])
+            logger.info(f"[{fmt}] CPU latency: eager {latency['eager']:.2f} ms, "
+                        f"exported {latency['exported']:.2f} ms, "
+                        f"speedup: {latency['eager'] / latency['exported']:.2f}x")
+
+    if failed:
+        logger.error('Exported model outputs differ more than the tolerance: ' + ', '.join(
+            f'{fmt} ({fmt_tolerance})' for fmt, fmt_tolerance in failed.items()))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
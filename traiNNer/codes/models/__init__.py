@@ -69,6 +69,11 @@ def create_model(opt, step=0, verbose=True):
     else:
         instance = M(opt)
 
+    # models that don't set it up themselves, get the
+    # trained networks wrapped for distributed training
+    if opt.get('dist') and opt['is_train']:
+        instance.setup_dist()
+
     if verbose:
         # print("model [%s] was created" % type(instance).__name__)
         logger.info(f'Model [{instance.__class__.__name__:s}] created.')
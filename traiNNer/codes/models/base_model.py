@@ -2,7 +2,7 @@ import os
 import logging
 from collections import Counter
 from copy import deepcopy
-from shutil import copyfile
+from functools import partial
 
 import torch
 import torch.nn as nn
@@ -10,6 +10,7 @@ import torch.nn as nn
 from . import optimizers
 from . import schedulers
 from . import swa
+from .gradclip import grad_norm, StreamingPercentile
 from .losses import Adversarial
 
 from models.networks import model_val, cem2normal, define_ext
@@ -17,7 +18,10 @@ from models.modules.architectures.block import SpaceToDepth
 from models.modules.architectures.CEM import CEMnet
 from models.modules.adatarget.atg import AdaTarget
 from dataops.batchaug import BatchAugment
+from dataops.camera import BatchCameraNoise
+from dataops.augmentations import KernelBank, NoisePatchBank
 from dataops.filters import FilterHigh, FilterLow
+from utils.checkpoint import CheckpointWriter, compact_state, is_compact, load_checkpoint
 
 logger = logging.getLogger('base')
 
@@ -29,6 +33,28 @@ else:
     logger.info("AMP library not available")
 
 
+class TracedModule():
+    """Scripted fallback for compiled training steps when
+    `torch.compile` is not available. Lazily traces the network
+    with `torch.jit.trace` for each input shape (static shapes),
+    sharing the parameters with the original network. Calls with
+    extra arguments run the original network.
+    """
+    def __init__(self, net):
+        self.net = net
+        self.traces = {}
+
+    def __call__(self, x, *args, **kwargs):
+        if args or kwargs or not isinstance(x, torch.Tensor):
+            return self.net(x, *args, **kwargs)
+        key = (tuple(x.shape), x.dtype, x.device)
+        traced = self.traces.get(key)
+        if traced is None:
+            traced = torch.jit.trace(self.net, x, check_trace=False)
+            self.traces[key] = traced
+        return traced(x)
+
+
 class nullcast():
     # nullcontext:
     # https://github.com/python/cpython/commit/0784a2e5b174d2dbf7b144d480559e650c5cf64c
@@ -86,12 +112,24 @@ class BaseModel:
         self.optimizers = []
         self.swa = None
         self.swa_start_iter = None
+        self.swa_bn = False
         self.metric = 0  # used for learning rate policy 'plateau'
         self.batchaugment = None
+        self.camera_noise = None
+        self.noise_patches = None
+        self.batch_kernels = None
+        self.hr_keys = None
         self.upsample = False
         self.unshuffle = None
         self.grad_clip = None
-        self.grad_history = []
+        self.grad_tracker = None
+        self.compiled_nets = {}
+        self.infer_cast = nullcast
+        self.infer_precision = 'fp32'
+        self.channels_last = False
+        self.dist_nets = []
+        self.ckpt_writer = CheckpointWriter(
+            async_write=opt.get('logger', {}).get('async_checkpoint', False))
 
     def feed_data(self, data: dict):
         """Unpack input data from the dataloader and perform necessary
@@ -157,11 +195,13 @@ class BaseModel:
             logger.info(s)
         """
 
-    def save(self, iter_step, latest=None, loader=None):
+    def save(self, iter_step, latest=None, loader=None, final=False):
         """
         Save all the networks to disk.
 
         :param iter_step: current iteration; used in the file name '%s_net_%s.pth' % (iter_step, name)
+        :param loader: dataloader to update the SWA model BN statistics.
+        :param final: if it's the final save of the training session.
         """
         for name in self.model_names:
             if isinstance(name, str):
@@ -173,12 +213,7 @@ class BaseModel:
         #     self.save_network(self.netD, 'D', iter_step, latest)
         if self.swa:
             # when training with networks that use BN
-            # # Update bn statistics for the swa_model only at the end of training
-            # if not isinstance(iter_step, int):
-            # TODO: not sure if it should be done only at the end
-            self.swa_model = self.swa_model.cpu()
-            torch.optim.swa_utils.update_bn(loader, self.swa_model)
-            self.swa_model = self.swa_model.cuda()
+            self.update_swa_bn(loader, final)
             # Check swa BN statistics
             # for module in self.swa_model.modules():
             #     if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
@@ -356,23 +391,29 @@ class BaseModel:
         else:
             save_filename = f'{iter_step}_{network_label}.pth'
         save_path = os.path.join(self.opt['path']['models'], save_filename)
-        if os.path.exists(save_path):
-            prev_path = os.path.join(self.opt['path']['models'], f'previous_{network_label}.pth')
-            copyfile(save_path, prev_path)
+        prev_path = os.path.join(self.opt['path']['models'], f'previous_{network_label}.pth')
         if isinstance(network, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
             network = network.module
         state_dict = network.state_dict()
-        for key, param in state_dict.items():
-            state_dict[key] = param.cpu()
-        
+
         # unwrap a CEM model if necessary, keep only original parameters
         if str(list(state_dict.keys())[0]).startswith('generated_image_model'):
             state_dict = cem2normal(state_dict)
 
-        try:  # save model in the pre-1.4.0 non-zipped format
-            torch.save(state_dict, save_path, _use_new_zipfile_serialization=False)
-        except:  # pre 1.4.0, normal torch.save
-            torch.save(state_dict, save_path)
+        if self.opt.get('logger', {}).get('compact_checkpoint', False):
+            # the training checkpoints are used to resume, so they keep
+            # full precision (fp16/bf16 are for export.py 'compact').
+            # Saved in the zipfile format to mmap it on load
+            self.ckpt_writer.save(
+                compact_state(state_dict, 'fp32'), save_path,
+                label=network_label, prev_path=prev_path)
+            return
+
+        # the writer copies the parameters to CPU and saves the model
+        # in the pre-1.4.0 non-zipped format
+        self.ckpt_writer.save(
+            state_dict, save_path, label=network_label,
+            prev_path=prev_path, legacy=True)
 
     def load_network(self, load_path:str, network:nn.Module,
         strict:bool=True, submodule:str=None,
@@ -397,8 +438,13 @@ class BaseModel:
             network = network.__getattr__(submodule)
 
         # load_net = torch.load(load_path)
-        load_net = torch.load(
-            load_path, map_location=lambda storage, loc: storage)
+        load_net = load_checkpoint(load_path)
+
+        # compact checkpoints already have the network's keys and
+        # shapes, load_state_dict() casts them to the network dtype
+        if is_compact(load_net):
+            network.load_state_dict(load_net['state_dict'], strict=strict)
+            return
 
         # to allow loading state_dicts
         if 'state_dict' in load_net:
@@ -471,10 +517,13 @@ class BaseModel:
         else:
             save_filename = f'{iter_step}.state'
         save_path = os.path.join(self.opt['path']['training_state'], save_filename)
-        if os.path.exists(save_path):
-            prev_path = os.path.join(self.opt['path']['training_state'], 'previous.state')
-            copyfile(save_path, prev_path)
-        torch.save(state, save_path)
+        prev_path = os.path.join(self.opt['path']['training_state'], 'previous.state')
+        self.ckpt_writer.save(
+            state, save_path, label='state', prev_path=prev_path)
+
+    def wait_checkpoints(self):
+        """Wait for the pending checkpoint writes to finish."""
+        self.ckpt_writer.wait()
 
     def resume_training(self, resume_state:dict):
         """Resume the optimizers and schedulers for training."""
@@ -626,6 +675,39 @@ class BaseModel:
                     self.upsample = self.opt["scale"]
             logger.info("Batch augmentations enabled")
 
+    def setup_camera_noise(self):
+        train_opt = self.opt['train']
+        if train_opt.get('camera_noise'):
+            z_norm = self.opt['datasets']['train'].get('znorm', False)
+            self.camera_noise = BatchCameraNoise(train_opt, znorm=z_norm)
+            logger.info("Batch camera noise enabled")
+
+    def setup_batch_kernels(self):
+        """Generate the LR batches from the HR batches on device with
+        the realistic ('dataroot_kernels') kernels, a different kernel
+        per image in a single grouped convolution."""
+        train_opt = self.opt['train']
+        if train_opt.get('batch_kernels'):
+            dataset_opt = self.opt['datasets']['train']
+            self.batch_kernels = KernelBank(
+                scale=self.opt['scale'],
+                kernels_path=dataset_opt['dataroot_kernels'],
+                pattern='kernelgan')
+            logger.info(f"Batch kernels downscaling enabled: {self.batch_kernels}")
+
+    def setup_noise_patches(self):
+        """Add noise from the 'noise_data' patches to the LR batches
+        on device, instead of to each image in the dataloader."""
+        train_opt = self.opt['train']
+        if train_opt.get('batch_noise_patches'):
+            dataset_opt = self.opt['datasets']['train']
+            self.noise_patches = NoisePatchBank(
+                dataset_opt['noise_data'],
+                dataset_opt.get('noise_data_size', 256))
+            self.noise_patches_amp = train_opt.get('batch_noise_patches_amp', 1.0)
+            self.noise_patches_p = train_opt.get('batch_noise_patches_p', 1.0)
+            logger.info("Batch noise patches enabled")
+
     def setup_fs(self):
         self.f_low = None
         self.f_high = None
@@ -716,9 +798,29 @@ class BaseModel:
                     self.optimizer_G, self.netG, swa_lr,
                     swa_anneal_epochs, swa_anneal_strategy)
             self.load_swa()  # load swa from resume state
+            self.swa_bn = swa.has_bn(self.netG)
             logger.info("SWA enabled. Starting on iter: "
                         f"{self.swa_start_iter}, lr: {swa_lr}")
 
+    def update_swa_bn(self, loader=None, final=False):
+        """Update the BN statistics of the SWA model. Skipped for
+        networks without BN (like RRDBNet). With the default
+        `swa_bn_update: final`, intermediate saves only use the
+        first `swa_bn_batches` batches of the loader (0 to skip) and
+        the full loader is used for the final save. With
+        `swa_bn_update: every`, the full loader is used every time.
+        """
+        if loader is None or not self.swa_bn:
+            return
+        train_opt = self.opt['train']
+        max_batches = None
+        if train_opt.get('swa_bn_update', 'final') != 'every' and not final:
+            max_batches = train_opt.get('swa_bn_batches', 0)
+            if not max_batches:
+                return
+        swa.update_bn(loader, self.swa_model, device=self.device,
+                      max_batches=max_batches)
+
     def setup_virtual_batch(self):
         train_opt = self.opt['train']
         batch_size = self.opt["datasets"]["train"]["batch_size"]
@@ -743,6 +845,128 @@ class BaseModel:
         else:
             self.cast = nullcast
 
+    def setup_dist(self):
+        """Wrap the trained networks with DistributedDataParallel
+        when launched in distributed mode, so gradients are averaged
+        between processes. Networks without trainable parameters
+        and networks already wrapped are skipped."""
+        if not self.opt.get('dist'):
+            return
+        device_ids = [torch.cuda.current_device()] if self.opt['gpu_ids'] else None
+        find_unused = self.opt.get('find_unused_parameters', False)
+        wrapped = []
+        for name in self.model_names:
+            net = getattr(self, f'net{name}', None)
+            if (net is None or isinstance(net, nn.parallel.DistributedDataParallel)
+                    or not any(p.requires_grad for p in net.parameters())):
+                continue
+            net = nn.parallel.DistributedDataParallel(
+                net, device_ids=device_ids,
+                find_unused_parameters=find_unused)
+            setattr(self, f'net{name}', net)
+            self.dist_nets.append(net)
+            wrapped.append(name)
+        if wrapped:
+            logger.info(f"DistributedDataParallel enabled for: {wrapped}")
+
+    def set_grad_sync(self, step):
+        """With gradient accumulation, only all-reduce the gradients
+        between processes in the iteration that completes the virtual
+        batch (same as DistributedDataParallel.no_sync(), but can be
+        set before the forward pass of the networks)."""
+        sync = step % self.accumulations == 0
+        for net in self.dist_nets:
+            net.require_backward_grad_sync = sync
+
+    def setup_inference(self, precision:str=None, channels_last:bool=None):
+        """Configure the inference precision ('fp32', 'fp16' or
+        'bf16' autocast) and memory layout (channels_last) from
+        the `infer_precision` and `infer_channels_last` options, if
+        not passed directly. The networks are converted once, here.
+        fp16 is not supported on CPU, bf16 is used instead.
+        """
+        if precision is None:
+            precision = self.opt.get('infer_precision', 'fp32')
+        if channels_last is None:
+            channels_last = self.opt.get('infer_channels_last', False)
+        precision = (precision or 'fp32').lower()
+
+        device_type = 'cuda' if str(self.device).startswith('cuda') else 'cpu'
+        self.infer_cast = nullcast
+        if precision in ('fp16', 'bf16'):
+            if not hasattr(torch, 'autocast'):
+                logger.warning('Mixed precision inference requires PyTorch>=1.10, using fp32')
+                precision = 'fp32'
+            elif device_type == 'cpu' and precision == 'fp16':
+                logger.warning('fp16 inference is not supported on CPU, using bf16')
+                precision = 'bf16'
+            elif (device_type == 'cuda' and precision == 'bf16'
+                    and not torch.cuda.is_bf16_supported()):
+                logger.warning('bf16 is not supported by the GPU, using fp16')
+                precision = 'fp16'
+        if precision in ('fp16', 'bf16'):
+            dtype = torch.float16 if precision == 'fp16' else torch.bfloat16
+            self.infer_cast = partial(
+                torch.autocast, device_type=device_type, dtype=dtype)
+
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        for name in self.model_names:
+            net = getattr(self, f'net{name}', None)
+            if net is not None:
+                net.to(memory_format=memory_format)
+
+        self.infer_precision = precision
+        self.channels_last = channels_last
+        logger.info(f'Inference precision: {precision}, channels_last: {channels_last}')
+
+    def infer_input(self, x):
+        """Convert an inference input to the configured layout."""
+        if self.channels_last and x.dim() == 4:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def setup_compile(self):
+        """Compile the forward of the networks used in the training
+        step (G and D), for static input shapes. The losses, backward
+        passes and optimizer steps still run eagerly. Uses
+        `torch.compile` if available
+        (`compile_mode` can be set to 'reduce-overhead' to use
+        CUDA graphs) or a `torch.jit.trace` based fallback, which
+        can also be forced with `use_compile: trace` (not used in
+        distributed training).
+        """
+        use_compile = self.opt.get('use_compile')
+        if not use_compile:
+            return
+        compile_mode = self.opt.get('compile_mode', 'default')
+        for name in self.model_names:
+            net = getattr(self, f'net{name}', None)
+            if net is None:
+                continue
+            if hasattr(torch, 'compile') and use_compile != 'trace':
+                self.compiled_nets[name] = torch.compile(
+                    net, mode=compile_mode, dynamic=False)
+            elif name == 'G':
+                # discriminators can return multiple outputs and
+                # feature maps, only the generator is traced
+                if self.opt.get('dist'):
+                    # tracing the DDP wrapper only runs its Python side
+                    # (prepare_for_backward, buffers broadcast) once
+                    logger.warning('The torch.jit.trace fallback is not '
+                                   'compatible with distributed training, '
+                                   'netG will not be compiled.')
+                    continue
+                self.compiled_nets[name] = TracedModule(net)
+        logger.info(f"Compiled training forward for: {list(self.compiled_nets)}")
+
+    def compiled(self, name:str='G'):
+        """Return the compiled version of network `name` for the
+        training step if available, else the regular network."""
+        net = getattr(self, f'net{name}')
+        if net.training and name in self.compiled_nets:
+            return self.compiled_nets[name]
+        return net
+
     def setup_cem(self):
         train_opt = self.opt['train']
         self.CEM = self.opt.get('use_cem')
@@ -783,6 +1007,10 @@ class BaseModel:
             self.grad_clip_value = train_opt.get(
                 "grad_clip_value", 0.1)
             self.clip_nets = clip_nets
+            if self.grad_clip_value == 'auto':
+                self.grad_tracker = StreamingPercentile(
+                    percentile=10,
+                    size=train_opt.get("grad_clip_history", 1000))
             logger.info(f"{grad_clip} gradient clip enabled. "
                         f"Clip value: {self.grad_clip_value}.")
 
@@ -883,30 +1111,21 @@ class BaseModel:
         return log_dict
 
     def calc_gradnorm(self, net):
-        """Auxiliary function to calculate a network gradient norm."""
-
-        total_norm = 0
-        for p in net.parameters():
-            if p.grad is not None:
-                param_norm = p.grad.data.norm(2)
-                total_norm += param_norm.item() ** 2
-        total_norm = total_norm ** (1. / 2)
-        return total_norm
+        """Auxiliary function to calculate a network gradient norm.
+        Returns a tensor, to avoid synchronizing with the device."""
+        return grad_norm(net.parameters())
 
-    def get_auto_norm(self, clip_percentile=10):
-        """Automatically calculate the norm for gradient clipping."""
+    def get_auto_norm(self):
+        """Automatically calculate the norm for gradient clipping,
+        as the (streaming) 10th percentile of the recent gradient
+        norms."""
 
-        grad_norm = 0
+        total_norm = 0
         for nets in self.clip_nets:
-            grad_norm += self.calc_gradnorm(nets)
-        grad_norm /= len(self.clip_nets)
-        self.grad_history.append(grad_norm)
+            total_norm = total_norm + self.calc_gradnorm(nets)
+        total_norm = total_norm / len(self.clip_nets)
 
-        grad_clip_value = torch.quantile(
-            torch.FloatTensor(self.grad_history),
-            clip_percentile/100)
-        
-        return grad_clip_value
+        return self.grad_tracker.update(total_norm)
 
     def apply_gradclip(self):
         """Apply gradient clipping."""
@@ -10,7 +10,7 @@ import models.networks as networks
 from .base_model import BaseModel
 from . import losses
 from dataops.filters import FilterHigh, FilterLow
-from utils.image_pool import ImagePool
+from utils.image_pool import TensorImagePool
 
 logger = logging.getLogger('base')
 
@@ -115,8 +115,8 @@ class CycleGANModel(BaseModel):
                 assert opt['input_nc'] == opt['output_nc']
 
             # create image buffers to store previously generated images
-            self.fake_A_pool = ImagePool(opt['pool_size'])
-            self.fake_B_pool = ImagePool(opt['pool_size'])
+            self.fake_A_pool = TensorImagePool(opt['pool_size'])
+            self.fake_B_pool = TensorImagePool(opt['pool_size'])
 
             # setup batch augmentations
             self.setup_batchaug()
@@ -0,0 +1,101 @@
+"""Export the generators to TorchScript or ONNX, with dynamic
+spatial (and batch) axes, and helpers to check the parity and
+compare the latency of the exported and the eager models.
+"""
+
+import logging
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+logger = logging.getLogger('base')
+
+
+def bare_model(net: nn.Module) -> nn.Module:
+    """Unwrap DataParallel/DDP and prepare for inference on CPU."""
+    if isinstance(net, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        net = net.module
+    return net.cpu().eval()
+
+
+def export_torchscript(net: nn.Module, example: torch.Tensor, save_path: str):
+    """Trace and freeze the network. The architectures built by
+    define_G (like RRDBNet) don't have shape-dependent control flow,
+    so the traced graph works with any spatial size."""
+    with torch.no_grad():
+        traced = torch.jit.trace(net, example, check_trace=False)
+    if hasattr(torch.jit, 'freeze'):
+        traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, save_path)
+    logger.info(f'TorchScript model saved to [{save_path:s}]')
+    return torch.jit.load(save_path, map_location='cpu')
+
+
+def export_onnx(net: nn.Module, example: torch.Tensor, save_path: str,
+    opset: int = 13):
+    """Export the network to ONNX, with dynamic batch and spatial
+    axes for the input and the output."""
+    dynamic_axes = {0: 'batch', 2: 'height', 3: 'width'}
+    with torch.no_grad():
+        torch.onnx.export(
+            net, example, save_path, opset_version=opset,
+            input_names=['input'], output_names=['output'],
+            dynamic_axes={'input': dynamic_axes, 'output': dynamic_axes})
+    logger.info(f'ONNX model saved to [{save_path:s}]')
+    if onnxruntime is None:
+        logger.warning('onnxruntime is not available, the ONNX model '
+                       'cannot be checked.')
+        return None
+
+    session = onnxruntime.InferenceSession(
+        save_path, providers=['CPUExecutionProvider'])
+
+    def run(x):
+        out = session.run(None, {'input': x.numpy()})[0]
+        return torch.from_numpy(out)
+    return run
+
+
+def check_parity(eager: nn.Module, exported, in_nc: int = 3,
+    sizes=((32, 32), (48, 64)), seed: int = 0):
+    """Run the eager and the exported models on random inputs of
+    different spatial sizes (to check the dynamic axes) and return
+    the maximum absolute error for each size."""
+    generator = torch.Generator().manual_seed(seed)
+    errors = {}
+    with torch.no_grad():
+        for h, w in sizes:
+            x = torch.rand(1, in_nc, h, w, generator=generator)
+            ref = eager(x)
+            out = exported(x)
+            if ref.shape != out.shape:
+                raise ValueError(
+                    f'Output shape mismatch for input {h}x{w}: '
+                    f'{tuple(ref.shape)} vs {tuple(out.shape)}')
+            errors[(h, w)] = (ref - out).abs().max().item()
+    return errors
+
+
+def benchmark(eager: nn.Module, exported, example: torch.Tensor,
+    n_iters: int = 20, warmup: int = 3):
+    """Compare the CPU latency (ms) of the eager and the exported
+    models on the same input."""
+    results = {}
+    with torch.no_grad():
+        for name, fn in (('eager', eager), ('exported', exported)):
+            for _ in range(warmup):
+                fn(example)
+            times = []
+            for _ in range(n_iters):
+                start = time.perf_counter()
+                fn(example)
+                times.append(time.perf_counter() - start)
+            results[name] = float(np.median(times)) * 1000
+    return results
@@ -0,0 +1,62 @@
+import torch
+
+
+def grad_norm(parameters, norm_type: float = 2.0):
+    """Calculate the total gradient norm of the parameters with
+    a single fused (multi-tensor) operation when available. The
+    result is a 0-dim tensor on the parameters' device, so there's
+    no host-device synchronization.
+    """
+    grads = [p.grad.detach() for p in parameters if p.grad is not None]
+    if not grads:
+        return torch.zeros(())
+    if hasattr(torch, '_foreach_norm'):
+        norms = torch._foreach_norm(grads, norm_type)
+    else:
+        norms = [g.norm(norm_type) for g in grads]
+    return torch.stack(norms).norm(norm_type)
+
+
+class StreamingPercentile:
+    """Estimate the percentile of a stream of (0-dim tensor)
+    values, with O(1) cost per update and without leaving the
+    device. The last `size` values are kept in a ring buffer and
+    the estimate is updated in each step with a stochastic
+    approximation (moving it up by `lr * q` or down by
+    `lr * (1 - q)`, relative to its value). It is re-anchored to
+    the exact percentile of the buffer when the number of values
+    is a power of 2 while filling the buffer and then every
+    `size` values, so the exact calculation is amortized.
+    :param percentile: the percentile to estimate, in [0, 100].
+    :param size: size of the ring buffer.
+    :param lr: relative step size of the streaming estimate.
+    """
+    def __init__(self, percentile: float = 10, size: int = 1000,
+        lr: float = 0.01):
+        self.q = percentile / 100
+        self.size = size
+        self.lr = lr
+        self.buffer = None
+        self.estimate = None
+        self.count = 0
+
+    def update(self, value: torch.Tensor) -> torch.Tensor:
+        """Add a new value and return the current estimate."""
+        value = value.detach().float()
+        if self.buffer is None:
+            self.buffer = value.new_zeros(self.size)
+            self.estimate = value.clone()
+
+        self.buffer[self.count % self.size] = value
+        self.count += 1
+
+        count = self.count
+        if ((count <= self.size and count & (count - 1) == 0)
+                or count % self.size == 0):
+            self.estimate = torch.quantile(
+                self.buffer[:min(count, self.size)], self.q)
+        else:
+            below = (value < self.estimate).float()
+            self.estimate = self.estimate + self.lr * self.estimate * (
+                self.q - below)
+        return self.estimate
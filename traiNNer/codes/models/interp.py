@@ -0,0 +1,70 @@
+"""Network interpolation at inference time: keep the weights of two
+networks with the same architecture resident and write
+(1-alpha) * A + alpha * B into the working network on demand,
+instead of saving a new model for every alpha with net_interp.py.
+"""
+
+import logging
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger('base')
+
+
+def float_state(net: nn.Module) -> OrderedDict:
+    """Copy of the floating point parameters and buffers of a
+    network (the ones that can be interpolated)."""
+    if isinstance(net, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        net = net.module
+    return OrderedDict(
+        (k, v.detach().clone()) for k, v in net.state_dict().items()
+        if v.is_floating_point())
+
+
+class NetInterpolator:
+    """Interpolate the weights of a network between two states.
+    :param net: the working network, its weights are overwritten.
+    :param state_A: float_state() of the first network (alpha = 0).
+    :param state_B: float_state() of the second network (alpha = 1).
+    :param cache_size: number of recently used alphas to keep the
+        interpolated weights of, so returning to them is a copy
+        instead of an interpolation. 0 to disable.
+    """
+    def __init__(self, net: nn.Module, state_A: dict, state_B: dict,
+        cache_size: int = 4):
+        if isinstance(net, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            net = net.module
+        self.net = net
+        targets = net.state_dict()
+        missing = set(state_A) ^ set(state_B)
+        if missing:
+            raise ValueError(f'The networks to interpolate have different keys: {sorted(missing)}')
+        self.keys = list(state_A)
+        self.targets = [targets[k] for k in self.keys]
+        self.state_A = [state_A[k].to(t.device) for k, t in zip(self.keys, self.targets)]
+        self.state_B = [state_B[k].to(t.device) for k, t in zip(self.keys, self.targets)]
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.alpha = None
+
+    @torch.no_grad()
+    def set_alpha(self, alpha: float):
+        """Set the working network weights to (1-alpha) * A + alpha * B."""
+        key = round(float(alpha), 6)
+        if key == self.alpha:
+            return
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            for t, v in zip(self.targets, self.cache[key]):
+                t.copy_(v)
+        else:
+            for t, a, b in zip(self.targets, self.state_A, self.state_B):
+                t.copy_(a).lerp_(b, key)
+            if self.cache_size > 0:
+                self.cache[key] = [t.clone() for t in self.targets]
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        self.alpha = key
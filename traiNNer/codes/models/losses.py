@@ -1,5 +1,6 @@
 import os
 import random
+import logging
 import numpy as np
 
 import torch
@@ -17,6 +18,7 @@ from dataops.diffaug import DiffAugment
 
 from dataops.debug import *
 
+logger = logging.getLogger('base')
 
 
 # loss builder
@@ -124,7 +126,8 @@ def get_loss_fn(loss_type=None,
             # if loss_type.split('-')[1][:3] == 'vgg': #if vgg16, vgg19, resnet, etc
             fea_loss_f = get_loss_fn(
                 loss_type.split('-')[2], recurrent=True, reduction='mean', device=device)
-            network = networks.define_F(opt).to(device)
+            if network is None:
+                network = networks.define_F(opt).to(device)
             loss_function = PerceptualLoss(criterion=fea_loss_f, network=network, opt=opt)
     elif loss_type == 'contextual':
         # contextual loss
@@ -132,7 +135,7 @@ def get_loss_fn(loss_type=None,
         z_norm = opt['datasets']['train'].get('znorm', False)
         loss_function = Contextual_Loss(
             layers, max_1d_size=64, distance_type='cosine',
-            calc_type='regular', z_norm=z_norm)
+            calc_type='regular', z_norm=z_norm, feature_net=network)
         # loss_function = Contextual_Loss(layers, max_1d_size=32,
         #     distance_type=0, crop_quarter=True) # for L1, L2
     elif loss_type == 'fft':
@@ -292,7 +295,12 @@ class PerceptualLoss(nn.Module):
                 else:
                     self.w_l_p = w_l_p
 
-    def forward(self, x: torch.Tensor, y: torch.Tensor):
+    def forward(self, x: torch.Tensor, y: torch.Tensor, features=None):
+        """
+        features: optional tuple with the already extracted (x, y)
+            feature dictionaries, to skip the feature network pass.
+            Not used with random rotations or flips.
+        """
         if self.rotations:
             k_rot = random.choice([-1, 0, 1])
             x = torch.rot90(x, k_rot, [2, 3])
@@ -311,8 +319,14 @@ class PerceptualLoss(nn.Module):
             return self.network(x, y, normalize=(not self.znorm)).mean()
 
         # extract features
-        fea_x = self.network(x)
-        fea_y = self.network(y.detach())
+        gram_y = {}
+        if features is not None and not (self.rotations or self.flips):
+            fea_x, fea_y = features[:2]
+            if len(features) > 2:
+                gram_y = features[2]
+        else:
+            fea_x = self.network(x)
+            fea_y = self.network(y.detach())
 
         # calculate perceptual loss
         if self.perceptual_weight > 0:
@@ -331,6 +345,7 @@ class PerceptualLoss(nn.Module):
             for k in self.w_l_s.keys():
                 style_loss += (
                     self.criterion(self.gram_matrix(fea_x[k]),
+                                    gram_y[k] if k in gram_y else
                                     self.gram_matrix(fea_y[k]))
                     *self.w_l_s[k])
             style_loss *= self.style_weight
@@ -604,6 +619,72 @@ class Adversarial(nn.Module):
             netD, fake, real)
 
 
+def merge_rows(cached, new, dtype):
+    """Stack per sample tensors in batch order, taking the rows
+    of `new` in order where `cached` is None."""
+    rows = iter(new)
+    return torch.stack([next(rows) if c is None else c.to(dtype)
+        for c in cached], dim=0)
+
+
+class FeatureTargetCache:
+    """LRU cache for the HR (target) side of the feature losses.
+    For a fixed HR sample the features never change, so they can
+    be reused when the same sample (same image and same paired
+    transformations) is seen again, in other accumulation steps
+    or epochs. Features and Gram matrices are stored per sample
+    in half precision.
+    Args:
+        max_items: maximum number of samples to keep.
+        dtype: storage precision.
+    """
+    def __init__(self, max_items:int=512, dtype=torch.float16):
+        self.max_items = max_items
+        self.dtype = dtype
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if not key:
+            return None
+        entry = self._cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, features:dict, grams:dict=None):
+        if not key:
+            return
+        self._cache[key] = (
+            {k: v.detach().to(self.dtype) for k, v in features.items()},
+            {k: v.detach().to(self.dtype) for k, v in (grams or {}).items()})
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_items:
+            self._cache.popitem(last=False)
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def cx_compatible_features(train_opt: dict) -> bool:
+    """Check if the feature network built by define_F() from the
+    training options matches the default network of Contextual_Loss,
+    so both losses can share it without changing the CX features."""
+    perc_opts = train_opt.get('perceptual_opt')
+    if not perc_opts:
+        return train_opt.get('feature_network', 'vgg19') == 'vgg19'
+    return (perc_opts.get('feature_network', 'vgg19') == 'vgg19'
+            and not perc_opts.get('remove_pooling', False)
+            and not perc_opts.get('change_padding', False)
+            and perc_opts.get('use_input_norm', True)
+            and not perc_opts.get('requires_grad', False)
+            and not perc_opts.get('pretrained_path', None))
+
+
 class GeneratorLoss(nn.Module):
     """Generator loss builder.
     Instantiates all configured losses. Also separately instantiates
@@ -709,6 +790,45 @@ class GeneratorLoss(nn.Module):
         range_weight = train_opt.get('range_weight', 0)
         range_type = 'range'
 
+        # shared feature network for the feature and contextual losses
+        # SR and HR are run through it once, as a single batch, and
+        # the HR features can be reused from the target cache
+        self.netF = None
+        self.shared_cx = False
+        self.target_cache = None
+        if ((feature_weight > 0 or style_weight > 0)
+                and feature_criterion and 'vgg' in feature_criterion):
+            feat_opts = feat_opts or {}
+            shared = (train_opt.get('shared_features', False)
+                and cx_weight > 0 and cx_type == 'contextual')
+            if shared and not cx_compatible_features(train_opt):
+                # Contextual_Loss would use its own default vgg19
+                logger.info('The perceptual_opt feature network differs from '
+                    'the contextual loss one (vgg19 with pooling, default '
+                    'padding and pretrained weights), shared_features disabled.')
+                shared = False
+            cache_size = opt['datasets']['train'].get('target_cache', 0)
+            if ((shared or cache_size) and
+                    (feat_opts.get('rotations') or feat_opts.get('flips'))):
+                logger.warning('Shared features and target cache are not '
+                    'compatible with perceptual_opt rotations or flips, '
+                    'disabled.')
+            else:
+                if cache_size and feat_opts.get('requires_grad'):
+                    logger.warning('Target cache is not compatible with a '
+                        'trainable feature network, disabled.')
+                    cache_size = 0
+                if cache_size:
+                    self.target_cache = FeatureTargetCache(cache_size)
+                extra_layers = None
+                if shared:
+                    extra_layers = list(alt_layers_names(train_opt.get(
+                        'cx_vgg_layers', {"conv3_2": 1.0, "conv4_2": 1.0})))
+                    self.shared_cx = True
+                if shared or cache_size:
+                    self.netF = networks.define_F(
+                        opt, extra_layers=extra_layers).to(device)
+
         # building the loss
         self.loss_list = []
 
@@ -729,7 +849,9 @@ class GeneratorLoss(nn.Module):
 
         if cx_weight > 0 and cx_type:
             cri_cx = get_loss_fn(
-                cx_type, cx_weight, device=device, opt=opt)
+                cx_type, cx_weight,
+                network=self.netF if self.shared_cx else None,
+                device=device, opt=opt)
             self.loss_list.append(cri_cx)
 
         if (feature_weight > 0 or style_weight > 0) and feature_criterion:
@@ -737,11 +859,14 @@ class GeneratorLoss(nn.Module):
             # self.netF = networks.define_F(opt).to(device)
             # cri_fea = get_loss_fn(feature_criterion, 1, network=self.netF, device=device)
             cri_fea = get_loss_fn(
-                feature_criterion, 1, opt=opt, device=device)
+                feature_criterion, 1, network=self.netF, opt=opt,
+                device=device)
             self.loss_list.append(cri_fea)
             self.cri_fea = True  # can use to fetch netF, could use "cri_fea"
+            self.fea_loss = cri_fea['function']
         else:
             self.cri_fea = None
+            self.fea_loss = None
 
         if lpips_weight > 0 and lpips_criterion:
             # return a spatial map of perceptual distance.
@@ -789,6 +914,7 @@ class GeneratorLoss(nn.Module):
 
         # Precise losses
         self.precise_loss_list = []
+        self.selected_losses = {}
 
         if grad_weight > 0 and grad_type:
             cri_grad = get_loss_fn(
@@ -817,6 +943,12 @@ class GeneratorLoss(nn.Module):
             self.precise_loss_list.append(cri_range)
 
     def selector_filter(self, selector=None, precise=False):
+        # the selection only depends on the arguments, reuse it
+        cache_key = (tuple(selector) if isinstance(selector, list)
+            else None, precise)
+        if cache_key in self.selected_losses:
+            return self.selected_losses[cache_key]
+
         if precise:
             losses = self.precise_loss_list
         else:
@@ -833,9 +965,54 @@ class GeneratorLoss(nn.Module):
                         loss_list.append(l)
         else:
             loss_list = losses
+        self.selected_losses[cache_key] = loss_list
         return loss_list
 
-    def calc_losses_regular(self, loss_list, log_dict, sr, hr):
+    def shared_features(self, sr, hr, keys=None):
+        """Run SR and HR through the shared feature network as a
+        single concatenated batch, with the union of the layers
+        needed by all feature losses. If the target cache is
+        enabled, HR samples with cached features (by `keys`) are
+        skipped. Returns the SR and HR feature dictionaries and the
+        HR Gram matrices of the style layers (if cached).
+        """
+        b = sr.shape[0]
+        entries = [None] * b
+        if self.target_cache is not None and keys is not None:
+            entries = [self.target_cache.get(k) for k in keys]
+        missing = [i for i, e in enumerate(entries) if e is None]
+
+        hr = hr.detach()
+        if len(missing) < b:
+            hr = hr[missing]
+        fea = self.netF(torch.cat([sr, hr], dim=0))
+        fea_sr = {k: v[:b] for k, v in fea.items()}
+        fea_hr = {k: v[b:].detach() for k, v in fea.items()}
+
+        gram_hr = {}
+        if self.target_cache is None:
+            return fea_sr, fea_hr, gram_hr
+
+        if self.fea_loss.style_weight > 0:
+            gram_hr = {k: self.fea_loss.gram_matrix(fea_hr[k])
+                for k in self.fea_loss.w_l_s}
+
+        # store the new targets
+        for j, i in enumerate(missing):
+            self.target_cache.put(keys[i] if keys is not None else None,
+                {k: v[j] for k, v in fea_hr.items()},
+                {k: v[j] for k, v in gram_hr.items()})
+
+        if len(missing) < b:
+            # merge cached and new targets in batch order
+            fea_hr = {k: merge_rows([e and e[0][k] for e in entries],
+                v, v.dtype) for k, v in fea_hr.items()}
+            gram_hr = {k: merge_rows([e and e[1][k] for e in entries],
+                v, v.dtype) for k, v in gram_hr.items()}
+        return fea_sr, fea_hr, gram_hr
+
+    def calc_losses_regular(self, loss_list, log_dict, sr, hr,
+        features=None):
         loss_results = []
         for l in loss_list:
             if l['function']:
@@ -848,12 +1025,18 @@ class GeneratorLoss(nn.Module):
                     effective_loss = l['weight']*(1 - l['function'](sr, hr))
                 elif 'fea-vgg' in l['name']:
                     # (fake_H, real_H)
-                    percep_loss, style_loss = l['function'](sr, hr)
+                    percep_loss, style_loss = l['function'](
+                        sr, hr, features=features)
                     effective_loss = 0
                     if percep_loss:
                         effective_loss += l['weight']*percep_loss
                     if style_loss:
                         effective_loss += l['weight']*style_loss
+                elif ('contextual' in l['name'] and features
+                        and self.shared_cx):
+                    # (fake_H, real_H)
+                    effective_loss = l['weight']*l['function'](
+                        sr, hr, features=features)
                 else:
                     # (fake_H, real_H)
                     effective_loss = l['weight']*l['function'](sr, hr)
@@ -862,7 +1045,8 @@ class GeneratorLoss(nn.Module):
                 log_dict[l['name']] = effective_loss.item()
         return loss_results
 
-    def calc_losses_fs(self, loss_list, log_dict, sr, hr, sr_f, hr_f):
+    def calc_losses_fs(self, loss_list, log_dict, sr, hr, sr_f, hr_f,
+        features=None):
         loss_results = []
         for l in loss_list:
             if l['function']:
@@ -884,12 +1068,18 @@ class GeneratorLoss(nn.Module):
                     effective_loss = l['weight']*(1 - l['function'](sr_f, hr_f))
                 elif 'fea-vgg' in l['name']:
                     # (fake_H, real_H)
-                    percep_loss, style_loss = l['function'](sr, hr)
+                    percep_loss, style_loss = l['function'](
+                        sr, hr, features=features)
                     effective_loss = 0
                     if percep_loss:
                         effective_loss += l['weight']*percep_loss
                     if style_loss:
                         effective_loss += l['weight']*style_loss
+                elif ('contextual' in l['name'] and features
+                        and self.shared_cx):
+                    # (fake_H, real_H)
+                    effective_loss = l['weight']*l['function'](
+                        sr, hr, features=features)
                 else:
                     # (fake_H, real_H)
                     effective_loss = l['weight']*l['function'](sr, hr)
@@ -899,7 +1089,7 @@ class GeneratorLoss(nn.Module):
         return loss_results
 
     def get_results(self, sr, hr, log_dict, fsfilter, selector,
-        precise=False):
+        precise=False, keys=None):
         hr_f, sr_f = None, None
         if fsfilter:  # low-pass filter
             hr_f = fsfilter(hr)
@@ -916,12 +1106,19 @@ class GeneratorLoss(nn.Module):
         if not loss_list:
             return [], log_dict
 
+        # one feature network pass for all the feature losses
+        features = None
+        if self.netF is not None and any(
+                'fea-vgg' in l['name'] or 'contextual' in l['name']
+                for l in loss_list):
+            features = self.shared_features(sr, hr, keys)
+
         if fsfilter:
             loss_results = self.calc_losses_fs(
-                loss_list, log_dict, sr, hr, sr_f, hr_f)
+                loss_list, log_dict, sr, hr, sr_f, hr_f, features)
         else:
             loss_results = self.calc_losses_regular(
-                loss_list, log_dict, sr, hr)
+                loss_list, log_dict, sr, hr, features)
 
         return loss_results, log_dict
 
@@ -948,7 +1145,12 @@ class GeneratorLoss(nn.Module):
             sr, hr, log_dict, fsfilter, selector, precise=True)
 
     def forward(self, sr, hr, log_dict, fsfilter=None,
-        selector=None, precise=False):
+        selector=None, precise=False, keys=None):
+        """
+        keys: optional list with an identifier of each HR sample
+            (`HR_key` from the dataset), used with the target
+            features cache. Empty keys are not cached.
+        """
 
         if precise:
             # calculate precise losses
@@ -957,6 +1159,6 @@ class GeneratorLoss(nn.Module):
         else:
             # calculate regular losses
             loss_results, log_dict = self.get_results(
-                sr, hr, log_dict, fsfilter, selector)
+                sr, hr, log_dict, fsfilter, selector, keys=keys)
 
         return loss_results, log_dict
@@ -781,7 +781,7 @@ class Contextual_Loss(nn.Module):
             max_1d_size:int=100, distance_type:str='cosine',
             b=1.0, band_width=0.5, use_vgg:bool=True,
             net:str='vgg19', calc_type:str='regular',
-            z_norm:bool=False):
+            z_norm:bool=False, feature_net=None):
         super(Contextual_Loss, self).__init__()
 
         assert band_width > 0, 'band_width parameter must be positive.'
@@ -802,7 +802,10 @@ class Contextual_Loss(nn.Module):
         self.b = b
         self.band_width = band_width  # self.h = h, #sigma
         
-        if use_vgg:
+        if feature_net is not None:
+            # shared feature extractor, must output the listen_list layers
+            self.vgg_model = feature_net
+        elif use_vgg:
             self.vgg_model = FeatureExtractor(
                 listen_list=listen_list, net=net, z_norm=z_norm)
 
@@ -813,18 +816,26 @@ class Contextual_Loss(nn.Module):
         else:  # if calc_type == 'regular':
             self.calculate_loss = self.calculate_CX_Loss
 
-    def forward(self, images, gt):
+    def forward(self, images, gt, features=None):
+        """
+        features: optional tuple with the already extracted
+            (images, gt) feature dictionaries, to skip the
+            feature network pass.
+        """
         device = images.device
         
-        if hasattr(self, 'vgg_model'):
+        if features is not None or hasattr(self, 'vgg_model'):
             assert images.shape[1] == 3 and gt.shape[1] == 3,\
                 'VGG model takes 3 channel images.'
             
             loss = 0
-            vgg_images = self.vgg_model(images)
-            vgg_images = {k: v.clone().to(device) for k, v in vgg_images.items()}
-            vgg_gt = self.vgg_model(gt)
-            vgg_gt = {k: v.to(device) for k, v in vgg_gt.items()}
+            if features is not None:
+                vgg_images, vgg_gt = features[:2]
+            else:
+                vgg_images = self.vgg_model(images)
+                vgg_gt = self.vgg_model(gt)
+            vgg_images = {k: vgg_images[k].clone().to(device) for k in self.layers_weights}
+            vgg_gt = {k: vgg_gt[k].to(device) for k in self.layers_weights}
 
             for key in self.layers_weights.keys():
                 if self.crop_quarter:
@@ -249,7 +249,9 @@ def get_network(opt, step=0, selector=None):
         # TODO: Note: MRRDB_net initializes the modules during init, no need to initialize again here for now
         init_weights(net, init_type=init_type, scale=init_scale)
 
-    if gpu_ids:
+    # in distributed training, the models wrap the trained
+    # networks with DistributedDataParallel instead
+    if gpu_ids and not opt.get('dist'):
         assert torch.cuda.is_available()
         net = nn.DataParallel(net)
     return net
@@ -313,8 +315,10 @@ def define_D(opt, net_name='D'):
     return define_network(opt=opt, net_name=net_name)
 
 
-def define_F(opt):
+def define_F(opt, extra_layers=None):
     """Create a feature extraction network for feature losses.
+    extra_layers: list of additional layers to extract, to share
+        the network (and the forward pass) with other losses.
     """
     from models.modules.architectures import perceptual
 
@@ -347,6 +351,8 @@ def define_F(opt):
 
     w_l = w_l_p.copy()
     w_l.update(w_l_s)
+    if extra_layers:
+        w_l.update({k: 1 for k in extra_layers})
     listen_list = list(w_l.keys())
 
     if 'resnet' in net:
@@ -362,7 +368,7 @@ def define_F(opt):
             pooling_stride=2, change_padding=change_padding,
             load_path=load_path)
 
-    if gpu_ids:
+    if gpu_ids and not opt.get('dist'):
         assert torch.cuda.is_available()
         netF = nn.DataParallel(netF)
 
@@ -0,0 +1,115 @@
+"""Post-training static int8 quantization of the generators
+(i.e. RRDBNet) for CPU inference, using FX graph mode
+quantization (PyTorch>=1.13). The Conv2d layers are quantized
+with per-channel weights and the activation ranges are calibrated
+with a set of LR images. Conv + ReLU and, if the backend config
+supports the pattern (onednn), conv + LeakyReLU are fused,
+otherwise LeakyReLU runs as a quantized op between the convs.
+The quantized models are saved as TorchScript, so they can be
+loaded without the architecture definition.
+"""
+
+import copy
+import logging
+
+import torch
+import torch.nn as nn
+
+try:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    quant_available = True
+except ImportError:
+    quant_available = False
+
+logger = logging.getLogger('base')
+
+
+BACKEND_CONFIGS = {
+    'x86': 'get_x86_backend_config',
+    'fbgemm': 'get_fbgemm_backend_config',
+    'onednn': 'get_onednn_backend_config',
+    'qnnpack': 'get_qnnpack_backend_config',
+}
+
+
+def get_backend_config(backend: str):
+    """Get the backend config, that defines the fusion patterns,
+    or None to use the default (native) config."""
+    try:
+        from torch.ao.quantization import backend_config
+    except ImportError:
+        return None
+    getter = getattr(backend_config, BACKEND_CONFIGS.get(backend, ''), None)
+    return getter() if getter else None
+
+
+class InputOnly(nn.Module):
+    """Call the network only with the input, so FX tracing
+    uses the default values of the other forward arguments
+    (like `outm`) instead of tracing through them."""
+    def __init__(self, net):
+        super(InputOnly, self).__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net(x)
+
+
+def quantize_static(net: nn.Module, calib_data, backend: str = 'x86'):
+    """Quantize a float network to int8.
+    :param net: the float network, will not be modified.
+    :param calib_data: iterable of LR image tensors (NCHW) to
+        calibrate the activation ranges with.
+    :param backend: quantized engine, 'x86', 'fbgemm', 'onednn'
+        or 'qnnpack' (ARM).
+    Returns the quantized network (GraphModule).
+    """
+    if not quant_available:
+        raise ImportError(
+            'Static quantization requires PyTorch>=1.13 with FX graph mode quantization.')
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError(
+            f'Quantization backend [{backend}] not supported. '
+            f'Available: {torch.backends.quantized.supported_engines}')
+    torch.backends.quantized.engine = backend
+
+    if isinstance(net, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        net = net.module
+    net = InputOnly(copy.deepcopy(net).cpu().eval())
+
+    calib_data = [x.cpu() for x in calib_data]
+    if not calib_data:
+        raise ValueError('No calibration images provided.')
+
+    backend_config = get_backend_config(backend)
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    prepared = prepare_fx(net, qconfig_mapping, (calib_data[0],),
+                          backend_config=backend_config)
+
+    # observe the activation ranges
+    with torch.no_grad():
+        for x in calib_data:
+            prepared(x)
+
+    quantized = convert_fx(prepared, backend_config=backend_config)
+    logger.info(f'Network quantized with the [{backend}] backend, '
+                f'calibrated with {len(calib_data)} images.')
+    return quantized
+
+
+def save_quantized(net: nn.Module, save_path: str, example: torch.Tensor):
+    """Save the quantized network as TorchScript."""
+    with torch.no_grad():
+        traced = torch.jit.trace(net, example.cpu())
+    torch.jit.save(traced, save_path)
+    logger.info(f'Quantized network saved to [{save_path:s}]')
+
+
+def load_quantized(load_path: str, backend: str = None):
+    """Load a quantized TorchScript network, on CPU."""
+    if backend:
+        torch.backends.quantized.engine = backend
+    net = torch.jit.load(load_path, map_location='cpu')
+    net.eval()
+    return net
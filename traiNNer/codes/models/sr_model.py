@@ -9,6 +9,7 @@ import torch.nn as nn
 import models.networks as networks
 from .base_model import BaseModel
 from . import losses
+from . import quantization
 from dataops.common import extract_patches_2d, recompose_tensor
 
 logger = logging.getLogger('base')
@@ -30,7 +31,16 @@ class SRModel(BaseModel):
         self.model_names = ['G']
 
         # define networks and load pretrained models
-        self.netG = networks.define_G(opt, step=step).to(self.device)  # G
+        quant_path = opt['path'].get('quantized_model_G')
+        self.quantized = bool(quant_path) and not self.is_train
+        if self.quantized:
+            # int8 model from quantize.py, only runs on CPU
+            logger.info(f'Loading quantized model for G [{quant_path:s}]')
+            self.netG = quantization.load_quantized(
+                quant_path, backend=opt.get('quantize', {}).get('backend'))
+            self.device = 'cpu'
+        else:
+            self.netG = networks.define_G(opt, step=step).to(self.device)  # G
         if self.is_train:
             self.netG.train()
             opt_G_nets = [self.netG]
@@ -45,7 +55,12 @@ class SRModel(BaseModel):
             self.setup_atg()
             if self.atg:
                 opt_G_nets.append(self.netLoc)
-        self.load()  # load G, D and other networks if needed
+        if not self.quantized:
+            self.load()  # load G, D and other networks if needed
+
+        # configure the inference precision and memory layout
+        if not self.is_train and not self.quantized:
+            self.setup_inference()
 
         self.outm = None
 
@@ -59,6 +74,15 @@ class SRModel(BaseModel):
             # setup batch augmentations
             self.setup_batchaug()
 
+            # setup batched camera RAW noise
+            self.setup_camera_noise()
+
+            # setup batched realistic kernels downscaling
+            self.setup_batch_kernels()
+
+            # setup batched noise patches
+            self.setup_noise_patches()
+
             # setup frequency separation
             self.setup_fs()
 
@@ -108,6 +132,12 @@ class SRModel(BaseModel):
             # setup gradient clipping
             self.setup_gradclip(opt_G_nets)
 
+            # wrap the trained networks for distributed training
+            self.setup_dist()
+
+            # compile the training step networks
+            self.setup_compile()
+
         # print network
         # TODO: pass verbose flag from config file
         self.print_network(verbose=False)
@@ -126,6 +156,8 @@ class SRModel(BaseModel):
             # discriminator references
             input_ref = data.get('ref', data['HR'])
             self.var_ref = input_ref.to(self.device)
+            # HR sample identifiers for the feature targets cache
+            self.hr_keys = data.get('HR_key')
 
     def feed_data_batch(self, data, need_HR=True):
         # LR
@@ -152,12 +184,13 @@ class SRModel(BaseModel):
         elif self.unshuffle is not None:
             self.fake_H = self.netG(self.unshuffle(self.var_L))
         else:
+            netG = self.compiled('G')
             if self.outm:
                 # if the model has the final activation option
-                self.fake_H = self.netG(self.var_L, outm=self.outm)
+                self.fake_H = netG(self.var_L, outm=self.outm)
             else:
                 # regular models without the final activation option
-                self.fake_H = self.netG(self.var_L)  # G(LR)
+                self.fake_H = netG(self.var_L)  # G(LR)
 
     def backward_G(self):
         """Calculate GAN and reconstruction losses for the generator."""
@@ -166,13 +199,14 @@ class SRModel(BaseModel):
         # casts operations to mixed precision if enabled, else nullcontext
             # calculate regular losses
             loss_results, self.log_dict = self.generatorlosses(
-                self.fake_H, self.real_H, self.log_dict, self.f_low)
+                self.fake_H, self.real_H, self.log_dict, self.f_low,
+                keys=self.hr_keys)
             l_g_total += sum(loss_results) / self.accumulations
 
             if self.cri_gan:
                 # adversarial loss
                 l_g_gan = self.adversarial(
-                    self.fake_H, self.var_ref, netD=self.netD,  # (sr, hr)
+                    self.fake_H, self.var_ref, netD=self.compiled('D'),  # (sr, hr)
                     stage='generator', fsfilter=self.f_high)
                 self.log_dict['l_g_gan'] = l_g_gan.item()
                 l_g_total += l_g_gan / self.accumulations
@@ -190,13 +224,16 @@ class SRModel(BaseModel):
     def backward_D(self):
         """Calculate GAN loss for the discriminator."""
         self.log_dict = self.backward_D_Basic(
-            self.netD, self.var_ref, self.fake_H, self.log_dict)
+            self.compiled('D'), self.var_ref, self.fake_H, self.log_dict)
 
     def optimize_parameters(self, step):
         """Calculate losses, gradients, and update network weights;
         called in every training iteration."""
         eff_step = step/self.accumulations
 
+        # only sync DDP gradients when the virtual batch completes
+        self.set_grad_sync(step)
+
         # G
         # freeze discriminator while generator is trained to prevent BP
         if self.cri_gan:
@@ -209,6 +246,24 @@ class SRModel(BaseModel):
             else:
                 self.switch_atg(False)
 
+        # downscale the HR batch with a realistic kernel per image
+        if self.batch_kernels:
+            with torch.no_grad():
+                self.var_L = self.batch_kernels.apply_batch(self.real_H)
+
+        # add noise from the noise patches to the LR batch on device
+        if self.noise_patches:
+            with torch.no_grad():
+                self.var_L = self.noise_patches.add_noise_batch(
+                    self.var_L, noise_amp=self.noise_patches_amp,
+                    p=self.noise_patches_p,
+                    znorm=self.opt['datasets']['train'].get('znorm', False))
+
+        # add camera RAW noise to the LR batch on device
+        if self.camera_noise:
+            with torch.no_grad():
+                self.var_L = self.camera_noise(self.var_L)
+
         # match HR resolution for batchaugment = cutblur
         if self.upsample:
             # TODO: assumes model and process scale == 4x
@@ -218,6 +273,8 @@ class SRModel(BaseModel):
         # batch (mixup) augmentations
         if self.mixup:
             self.real_H, self.var_L = self.batchaugment(self.real_H, self.var_L)
+            # the HR targets are modified, can't use cached features
+            self.hr_keys = None
 
         # network forward, generate SR
         with self.cast():
@@ -272,8 +329,10 @@ class SRModel(BaseModel):
         intermediate steps for backprop are not saved.
         """
         self.netG.eval()
-        with torch.no_grad():
+        with torch.no_grad(), self.infer_cast():
+            self.var_L = self.infer_input(self.var_L)
             self.forward(CEM_net=CEM_net)
+        self.fake_H = self.fake_H.float()
         self.netG.train()
 
     def test_x8(self, CEM_net=None):
@@ -302,8 +361,9 @@ class SRModel(BaseModel):
         lr_list = [self.var_L]
         for tf in 'v', 'h', 't':
             lr_list.extend([_transform(t, tf) for t in lr_list])
-        with torch.no_grad():
-            sr_list = [self.forward(data=aug, CEM_net=CEM_net) for aug in lr_list]
+        with torch.no_grad(), self.infer_cast():
+            sr_list = [self.forward(data=self.infer_input(aug), CEM_net=CEM_net).float()
+                       for aug in lr_list]
         for i in range(len(sr_list)):
             if i > 3:
                 sr_list[i] = _transform(sr_list[i], 't')
@@ -336,12 +396,12 @@ class SRModel(BaseModel):
         highres_patches = []
 
         self.netG.eval()
-        with torch.no_grad():
+        with torch.no_grad(), self.infer_cast():
             for p in range(n_patches):
-                lowres_input = img_patches[p:p + 1]
+                lowres_input = self.infer_input(img_patches[p:p + 1])
                 prediction = self.forward(
                     data=lowres_input, CEM_net=CEM_net)
-                highres_patches.append(prediction)
+                highres_patches.append(prediction.float())
 
         highres_patches = torch.cat(highres_patches, 0)
 
@@ -1,3 +1,5 @@
+import torch
+from torch.nn.modules.batchnorm import _BatchNorm
 from torch.optim.swa_utils import AveragedModel, SWALR
 
 
@@ -21,3 +23,44 @@ def get_swa(optimizer, model, swa_lr=0.005, anneal_epochs=10, anneal_strategy="c
     swa_scheduler = SWALR(optimizer, swa_lr=swa_lr, anneal_epochs=anneal_epochs, anneal_strategy=anneal_strategy)
 
     return swa_scheduler, swa_model
+
+
+def has_bn(model):
+    """Check if the model has BatchNorm layers, that require
+    updating the statistics of the SWA model."""
+    return any(isinstance(m, _BatchNorm) for m in model.modules())
+
+
+@torch.no_grad()
+def update_bn(loader, model, device=None, max_batches=None, key='LR'):
+    """Version of torch.optim.swa_utils.update_bn() that runs on
+    the model's device, uses the `key` images of the dataloader
+    dictionaries as input and can stop after `max_batches`
+    batches instead of using the full loader.
+    """
+    momenta = {}
+    for module in model.modules():
+        if isinstance(module, _BatchNorm):
+            module.reset_running_stats()
+            momenta[module] = module.momentum
+    if not momenta:
+        return
+
+    was_training = model.training
+    model.train()
+    for module in momenta.keys():
+        # cumulative moving average over the batches
+        module.momentum = None
+
+    for n, data in enumerate(loader):
+        if max_batches and n >= max_batches:
+            break
+        if isinstance(data, dict):
+            data = data[key]
+        elif isinstance(data, (list, tuple)):
+            data = data[0]
+        model(data.to(device))
+
+    for module, momentum in momenta.items():
+        module.momentum = momentum
+    model.train(was_training)
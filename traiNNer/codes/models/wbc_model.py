@@ -1,8 +1,12 @@
 from __future__ import absolute_import
 
 import os
+import sys
+import atexit
 import logging
+import multiprocessing as mp
 from collections import OrderedDict
+import numpy as np
 import torch
 import torch.nn as nn
 from joblib import Parallel, delayed, parallel_backend
@@ -14,23 +18,28 @@ from dataops.filters import FilterHigh, FilterLow, GuidedFilter
 from dataops.colors import ColorShift
 from dataops.augmennt.augmennt import transforms
 from dataops.common import tensor2np, np2tensor
-from utils.image_pool import ImagePool
+from utils.image_pool import TensorImagePool
 
 logger = logging.getLogger('base')
 
 
 # TODO: can move to some common module and reuse for other fns
 def batch_superpixel(batch_image: torch.Tensor,
-    superpixel_fn: callable, num_job:int=None) -> torch.Tensor:
+    superpixel_fn: callable, num_job:int=None, pool=None) -> torch.Tensor:
     """ Convert a batch of images to superpixel in parallel.
     Args:
         batch_image: the batch of images. Shape must be [b,c,h,w].
         superpixel_fn: the callable function to apply in parallel.
         num_job: the number of threads to parallelize on. Default: will
             use as many threads as the batch size 'b'.
+        pool: optional SuperpixelPool, to use worker processes
+            instead of threads (superpixel_fn is not used).
     Returns:
         superpixel tensor, shape = [b,c,h,w]
     """
+    if pool is not None:
+        return pool(batch_image)
+
     if not num_job:
         num_job = batch_image.shape[0]
 
@@ -49,13 +58,17 @@ def get_sp_transform(train_opt:dict, znorm:bool=True):
     # 'seeds', 'slic', 'slico', 'mslic', 'sk_slic', 'sk_felzenszwalb'
     algo = train_opt.get('sp_algo', 'sk_felzenszwalb')
     gamma_range = train_opt.get('sp_gamma_range', (100, 120))
+    # size to compute the segmentation at and segmentations LRU cache
+    seg_max_size = train_opt.get('sp_seg_max_size', None)
+    cache_size = train_opt.get('sp_cache_size', 0)
 
     superpixel_fn = transforms.Compose([
         transforms.Lambda(lambda img: tensor2np(img, rgb2bgr=True,
                             denormalize=znorm, remove_batch=False)),
         transforms.Superpixels(
             p_replace=1, n_segments=n_segments, algo=algo,
-            reduction=reduction, max_size=max_size, p=1),
+            reduction=reduction, max_size=max_size,
+            seg_max_size=seg_max_size, cache_size=cache_size, p=1),
         transforms.RandomGamma(gamma_range=gamma_range, gain=1, p=1),
         transforms.Lambda(lambda img: np2tensor(img, bgr2rgb=True,
                             normalize=znorm, add_batch=False))
@@ -63,6 +76,97 @@ def get_sp_transform(train_opt:dict, znorm:bool=True):
     return superpixel_fn
 
 
+# superpixel transform and shared memory buffers of each worker process
+_sp_worker = {'fn': None, 'shm': {}}
+
+
+def _attach_shm(name, shape):
+    from multiprocessing import shared_memory
+    cache = _sp_worker['shm']
+    if name not in cache:
+        # the main process owns (and unlinks) the buffers, the workers
+        # only close their handles. The spawned workers share the main
+        # process resource tracker, where registering again is a no-op
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+        cache[name] = shm
+    return np.ndarray(shape, dtype=np.float32, buffer=cache[name].buf)
+
+
+def _init_sp_worker(train_opt, znorm):
+    torch.set_num_threads(1)
+    _sp_worker['fn'] = get_sp_transform(train_opt, znorm)
+
+
+def _run_sp_worker(args):
+    in_name, out_name, shape, idx = args
+    # drop the buffers of previous batch shapes
+    for name in list(_sp_worker['shm']):
+        if name not in (in_name, out_name):
+            _sp_worker['shm'].pop(name).close()
+    batch_in = _attach_shm(in_name, shape)
+    batch_out = _attach_shm(out_name, shape)
+    out = _sp_worker['fn'](torch.from_numpy(batch_in[idx]))
+    batch_out[idx] = out.numpy()
+
+
+class SuperpixelPool:
+    """Persistent pool of worker processes to calculate the
+    superpixels of a batch, avoiding the GIL contention of the
+    threading backend. The images are passed through reusable
+    shared memory buffers, only their names and the batch index
+    of each image are sent to the workers, which create their own
+    superpixels transform from the training options.
+    """
+    def __init__(self, train_opt:dict, znorm:bool=True, num_workers:int=4):
+        ctx = mp.get_context('spawn')
+        self.pool = ctx.Pool(
+            num_workers, initializer=_init_sp_worker,
+            initargs=(train_opt, znorm))
+        self.shape = None
+        self.shm_in = None
+        self.shm_out = None
+        atexit.register(self.close)
+
+    def _buffers(self, shape):
+        from multiprocessing import shared_memory
+        if shape == self.shape:
+            return
+        self._release()
+        nbytes = int(np.prod(shape)) * 4
+        self.shm_in = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.shm_out = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.shape = shape
+
+    def _release(self):
+        for shm in (self.shm_in, self.shm_out):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.shm_in = self.shm_out = None
+        self.shape = None
+
+    def __call__(self, batch_image: torch.Tensor) -> torch.Tensor:
+        batch = batch_image.detach().float().cpu()
+        shape = tuple(batch.shape)
+        self._buffers(shape)
+        batch_in = np.ndarray(shape, dtype=np.float32, buffer=self.shm_in.buf)
+        batch_out = np.ndarray(shape, dtype=np.float32, buffer=self.shm_out.buf)
+        batch_in[:] = batch.numpy()
+        self.pool.map(_run_sp_worker, [
+            (self.shm_in.name, self.shm_out.name, shape, i)
+            for i in range(shape[0])])
+        return torch.from_numpy(batch_out.copy())
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self._release()
+
+
 class WBCModel(BaseModel):
     """ This class implements the white-box cartoonization (WBC) model,
     for learning image-to-image translation from A (source domain) to B
@@ -132,8 +236,8 @@ class WBCModel(BaseModel):
                 assert opt['input_nc'] == opt['output_nc']
 
             # create image buffers to store previously generated images
-            self.fake_S_pool = ImagePool(opt['pool_size'])
-            self.fake_T_pool = ImagePool(opt['pool_size'])
+            self.fake_S_pool = TensorImagePool(opt['pool_size'])
+            self.fake_T_pool = TensorImagePool(opt['pool_size'])
 
             # setup batch augmentations
             self.setup_batchaug()
@@ -172,6 +276,10 @@ class WBCModel(BaseModel):
             self.guided_filter_surf = GuidedFilter(r=5, eps=2e-1)
             self.sp_transform = get_sp_transform(
                 train_opt, opt['datasets']['train']['znorm'])
+            sp_workers = train_opt.get('sp_workers', 0)
+            self.sp_pool = SuperpixelPool(
+                train_opt, opt['datasets']['train']['znorm'],
+                num_workers=sp_workers) if sp_workers else None
 
             # discriminator loss:
             self.setup_gan()
@@ -244,7 +352,7 @@ class WBCModel(BaseModel):
             self.sp_real = (
                 batch_superpixel(
                     self.fake_B.detach(),  # self.real_A, #
-                    self.sp_transform)
+                    self.sp_transform, pool=self.sp_pool)
                 ).to(self.device)
 
     def backward_D_T(self):
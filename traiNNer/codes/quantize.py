@@ -0,0 +1,130 @@
+"""Quantize a generator to int8 for CPU inference.
+Uses the same options file as test.py, the float model is loaded
+from `pretrain_model_G`, calibrated with the first images of the
+first dataset and then the speed and quality of the float and the
+int8 models are compared on CPU. The saved model can be used in
+test.py with `quantized_model_G`. Example:
+    python quantize.py -opt options/sr/test_sr.yml
+"""
+
+import copy
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from dataops.common import tensor2np
+from models import create_model
+from models import quantization
+from train import parse_options, dir_check, configure_loggers, get_dataloaders
+from utils import util
+from utils.metrics import MetricsDict
+
+
+def get_calib_data(dataloader, n_images=32):
+    """Get the first `n_images` LR images to calibrate with."""
+    calib_data = []
+    for data in dataloader:
+        if len(calib_data) >= n_images:
+            break
+        calib_data.append(data['LR'])
+    return calib_data
+
+
+def compare(float_net, quant_net, dataloader, znorm, opt, max_images=None):
+    """Compare the CPU inference time and metrics of the float and
+    quantized networks. If the dataset has HR images, the metrics
+    of both are calculated against them, else the quantized results
+    are compared against the float results."""
+    logger = util.get_root_logger()
+    need_HR = dataloader.dataset.opt['dataroot_HR'] is not None
+    metrics = opt.get('metrics', None) or 'psnr,ssim'
+    metrics_float = MetricsDict(metrics=metrics)
+    metrics_quant = MetricsDict(metrics=metrics)
+    times = {'float': 0, 'int8': 0}
+
+    def run(net, x, key):
+        start = time.perf_counter()
+        out = net(x)
+        times[key] += time.perf_counter() - start
+        return tensor2np(out.detach()[0].float(), denormalize=znorm)
+
+    count = 0
+    with torch.no_grad():
+        for n, data in enumerate(dataloader):
+            if max_images and n >= max_images:
+                break
+            lr = data['LR'].cpu()
+            if n == 0:
+                # warmup
+                float_net(lr)
+                quant_net(lr)
+            sr_float = run(float_net, lr, 'float')
+            sr_quant = run(quant_net, lr, 'int8')
+            if need_HR:
+                hr_img = tensor2np(data['HR'][0], denormalize=znorm)
+                metrics_float.calculate_metrics(sr_float, hr_img, crop_size=opt['scale'])
+                metrics_quant.calculate_metrics(sr_quant, hr_img, crop_size=opt['scale'])
+            else:
+                metrics_quant.calculate_metrics(sr_quant, sr_float, crop_size=opt['scale'])
+            count += 1
+
+    ips = {k: count / t for k, t in times.items()}
+    logger.info(f"float: {ips['float']:.3f} img/s, int8: {ips['int8']:.3f} img/s, "
+                f"speedup: {ips['int8'] / ips['float']:.2f}x")
+
+    avg_quant = metrics_quant.get_averages()
+    if need_HR:
+        avg_float = metrics_float.get_averages()
+        logger.info('Metrics (float / int8 / drop): ' + ', '.join(
+            f'{m.upper()}: {avg_float[m]:.5g} / {avg_quant[m]:.5g} / {avg_float[m] - avg_quant[m]:+.5g}'
+            for m in avg_quant))
+    else:
+        logger.info('Metrics (int8 against float): ' + ', '.join(
+            f'{m.upper()}: {v:.5g}' for m, v in avg_quant.items()))
+    return ips, avg_quant
+
+
+def main():
+    # parse options, using the test options file
+    opt = parse_options(is_train=False)
+    dir_check(opt)
+    configure_loggers(opt)
+    logger = util.get_root_logger()
+
+    quant_opt = opt.get('quantize', None) or {}
+    backend = quant_opt.get('backend', 'x86')
+    save_path = quant_opt.get('save_path', None) or os.path.join(
+        opt['path']['results_root'], f"{opt['name']}_int8.pt")
+
+    # create dataloaders and the float model
+    dataloaders, data_params = get_dataloaders(opt)
+    model = create_model(opt)
+    if model.quantized:
+        raise ValueError('quantize.py requires the float model in pretrain_model_G, '
+                         'remove quantized_model_G from the options.')
+    float_net = model.netG
+    if isinstance(float_net, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        float_net = float_net.module
+    float_net = quantization.InputOnly(copy.deepcopy(float_net).cpu().eval())
+
+    # calibrate and quantize with the first dataset
+    dataloader = next(iter(dataloaders.values()))
+    znorm = data_params['znorm'][dataloader.dataset.opt['name']]
+    calib_data = get_calib_data(dataloader, quant_opt.get('calib_images', 32))
+    logger.info(f'Calibrating with {len(calib_data)} images of [{dataloader.dataset.opt["name"]}], '
+                f'backend: [{backend}]')
+    quant_net = quantization.quantize_static(float_net, calib_data, backend=backend)
+
+    quantization.save_quantized(quant_net, save_path, calib_data[0])
+    quant_net = quantization.load_quantized(save_path)
+    logger.info(f'Use quantized_model_G: {save_path} to test with the int8 model')
+
+    # report the speedup and quality drop
+    compare(float_net, quant_net, dataloader, znorm, opt,
+            max_images=quant_opt.get('eval_images', None))
+
+
+if __name__ == '__main__':
+    main()
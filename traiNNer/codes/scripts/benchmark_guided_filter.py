@@ -0,0 +1,68 @@
+"""Compare the speed and outputs of the filter2D based guided
+filter, the fused cumsum box filter version and the subsampled
+fast guided filter. Example:
+    python scripts/benchmark_guided_filter.py --size 512 512 --r 5 --device cuda
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataops.filters import guided_filter, fast_guided_filter
+
+
+def timeit(fn, device, n_iters=20, warmup=3):
+    """Median time (ms) of fn()."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(n_iters):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 256], help='image height and width')
+    parser.add_argument('--batch', type=int, default=4, help='batch size')
+    parser.add_argument('--r', type=int, nargs='+', default=[1, 5], help='window radius (one or more)')
+    parser.add_argument('--eps', type=float, default=1e-2, help='regularization')
+    parser.add_argument('--s', type=int, default=4, help='subsampling factor of the fast guided filter')
+    parser.add_argument('--iters', type=int, default=20, help='number of timed iterations')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    x = torch.rand(args.batch, 3, *args.size, device=device)
+    y = torch.rand(args.batch, 3, *args.size, device=device)
+
+    with torch.no_grad():
+        for r in args.r:
+            variants = {
+                'filter2D': lambda: guided_filter(x, y, r=r, eps=args.eps, fused=False),
+                'fused': lambda: guided_filter(x, y, r=r, eps=args.eps, fused=True),
+                f'fast (s={args.s})': lambda: fast_guided_filter(x, y, r=r, eps=args.eps, s=args.s),
+            }
+            ref = variants['filter2D']()
+            base = None
+            print(f'r={r}, input: {tuple(x.shape)}, device: {device}')
+            for name, fn in variants.items():
+                ms = timeit(fn, device, n_iters=args.iters)
+                base = base or ms
+                err = (fn() - ref).abs().max().item()
+                print(f'  {name:>12s}: {ms:8.2f} ms, speedup: {base / ms:5.2f}x, '
+                      f'max abs diff: {err:.2e}')
+
+
+if __name__ == '__main__':
+    main()
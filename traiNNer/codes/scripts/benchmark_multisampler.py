@@ -0,0 +1,53 @@
+"""Time the MultiSampler batches of an epoch for large concatenated
+datasets (only the indices are used, the datasets are not loaded)
+and check the sampled distribution against the weights. Example:
+    python scripts/benchmark_multisampler.py --sizes 700000 300000 --weights 1 1
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.samplers import MultiSampler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[600000, 300000, 100000], help='size of each dataset')
+    parser.add_argument('--weights', type=float, nargs='+', default=[2, 1, 1], help='weight of each dataset')
+    parser.add_argument('--batch', type=int, default=16, help='batch size')
+    parser.add_argument('--epochs', type=int, default=3, help='number of epochs to time')
+    args = parser.parse_args()
+
+    boundaries = np.cumsum(args.sizes).tolist()
+    sampler = MultiSampler(None, boundaries=boundaries, batch_size=args.batch,
+                           weights=args.weights)
+    print(f'{boundaries[-1]} items, {len(args.sizes)} datasets, '
+          f'batch size {args.batch}, {len(sampler)} batches per epoch')
+
+    for epoch in range(args.epochs):
+        start = time.perf_counter()
+        batches = np.array(list(sampler))
+        elapsed = time.perf_counter() - start
+
+        flat = batches.ravel()
+        unique = len(np.unique(flat)) == len(flat)
+        # dataset of each batch (all the indices of a batch share it)
+        datasets = np.searchsorted(boundaries, batches[:, 0], side='right')
+        mixed = np.any(np.searchsorted(boundaries, batches, side='right')
+                       != datasets[:, None])
+        frac = np.bincount(datasets, minlength=len(boundaries)) / len(batches)
+        print(f'epoch {epoch}: {elapsed:.3f} s, {len(batches)} batches, '
+              f'no repeated indices: {unique}, mixed batches: {mixed}, '
+              f'dataset fractions: {np.round(frac, 3).tolist()}')
+
+    target = np.array(args.weights) / np.sum(args.weights)
+    print(f'target fractions (until a dataset is exhausted): {np.round(target, 3).tolist()}')
+
+
+if __name__ == '__main__':
+    main()
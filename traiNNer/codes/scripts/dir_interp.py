@@ -1,12 +1,13 @@
 import random
 import torch
 import argparse
-from collections import OrderedDict
 
 import os
 import os.path
 import sys
 
+from net_merge import stream_merge
+
 
 ####################################################################################################################################
 
@@ -40,30 +41,13 @@ def main(args):
         model_list = _get_paths_from_models(args.intdir)
         #print(model_list)
         
-        net_interp = OrderedDict()
-        i = 0
-        
         for path in model_list:
-            if i == 0:
-                net = torch.load(path)
-                net_interp = net
-                i += 1
-                print(str(path)+" added.")
-                continue
-            net = torch.load(path)
-            
-            for k, v_netA in net.items():
-                if k in net_interp: 
-                    v_netB = net_interp[k]
-                    net_interp[k] = v_netA + v_netB 
-            i += 1
             print(str(path)+" added.")
-        
-        print(str(i)+" models combined")
-        
-        for k, v_net in net_interp.items():
-            net_interp[k] = v_net/i
-        
+
+        # stream the average one key at a time from memory-mapped models
+        net_interp = stream_merge(model_list, [[1.0] * len(model_list)])[0]
+        print(str(len(model_list))+" models combined")
+
         torch.save(net_interp, net_interp_path)
         print('model saved in: ', net_interp_path)
     else:
@@ -2,6 +2,8 @@ import torch
 import argparse
 from collections import OrderedDict
 
+from net_merge import load_lazy
+
 ####################################################################################################################################
 
 # Continuous imagery effect transition via linear interpolation in the parameter space of existing trained networks. 
@@ -27,19 +29,19 @@ parser.add_argument('-interpolate', '-i', type=float, required=False, help='Line
 args = parser.parse_args()
 
 if args.netA:
-    netA = torch.load(args.netA)
+    netA = load_lazy(args.netA)
     print("Loaded model: " + args.netA)
 else:
     netA_path = './models/RRDB_PSNR_x4.pth' #Default just for tests
-    netA = torch.load(netA_path)
+    netA = load_lazy(netA_path)
     print("Loaded default RRDB_PSNR_x4.pth model")
 
 if args.netB:
-    netB = torch.load(args.netB)
+    netB = load_lazy(args.netB)
     print("Loaded model: " + args.netB)
 else:
     netB_path = './models/RRDB_ESRGAN_x4.pth' #Default just for tests
-    netB = torch.load(netB_path)
+    netB = load_lazy(netB_path)
     print("Loaded default RRDB_ESRGAN_x4.pth model")
 
     
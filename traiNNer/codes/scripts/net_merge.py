@@ -0,0 +1,194 @@
+import os
+import os.path
+import zipfile
+import argparse
+from collections import OrderedDict
+
+import torch
+
+
+####################################################################################################################################
+
+# Merge models with the same architecture, streaming the parameters one key at a time from memory-mapped
+# checkpoints and loading the ones that can't be mapped (legacy format) one at a time, so the peak memory stays
+# around the size of the output model(s) plus one input model, regardless of the number of inputs.
+#   average: weighted average of N models (uniform weights by default)
+#   sweep:   interpolate between two models with multiple alphas in a single pass (one output model per alpha)
+#   ema:     exponential moving average of N models, in the order given (i.e. sorted by iteration)
+# Examples:
+#   python net_merge.py average -models a.pth b.pth c.pth -weights 2 1 1 -savepath avg.pth
+#   python net_merge.py average -dir ../../experiments/swa_models/ -savepath avg.pth
+#   python net_merge.py sweep -models psnr.pth esrgan.pth -alphas 0.2 0.4 0.6 0.8 -savepath ./int.pth
+#   python net_merge.py ema -dir ../../experiments/run/models/ -decay 0.9 -savepath ema.pth
+
+####################################################################################################################################
+
+MODEL_EXTENSIONS = ['.pth', '.pt']
+
+
+def is_model_file(filename):
+    return any(filename.endswith(extension) for extension in MODEL_EXTENSIONS)
+
+
+def _get_paths_from_models(path):
+    assert os.path.isdir(path), '{:s} is not a valid directory'.format(path)
+    model_list = []
+    for dirpath, _, fnames in sorted(os.walk(path)):
+        for fname in sorted(fnames):
+            if is_model_file(fname):
+                model_list.append(os.path.join(dirpath, fname))
+    assert model_list, '{:s} has no valid model file'.format(path)
+    return model_list
+
+
+def _unwrap(state_dict):
+    for key in ('params_ema', 'params', 'state_dict'):
+        if isinstance(state_dict, dict) and key in state_dict \
+                and isinstance(state_dict[key], dict):
+            return state_dict[key]
+    return state_dict
+
+
+def load_mmap(path):
+    """Load a state dict memory-mapped, so the tensors are only read
+    from disk when used. Returns None if the checkpoint can't be
+    mapped (PyTorch<2.1 or legacy non-zipfile checkpoints, like the
+    ones saved by default during training)."""
+    if not zipfile.is_zipfile(path):
+        return None
+    try:
+        return _unwrap(torch.load(path, map_location='cpu', mmap=True))
+    except (TypeError, RuntimeError):
+        return None
+
+
+def load_lazy(path):
+    """Load a state dict memory-mapped if possible, else in memory."""
+    state_dict = load_mmap(path)
+    if state_dict is None:
+        print('Memory-mapping not available for {}, loading it in memory'.format(path))
+        state_dict = _unwrap(torch.load(path, map_location='cpu'))
+    return state_dict
+
+
+def stream_merge(paths, weights_list):
+    """Calculate one or more weighted sums of the models in `paths`.
+    `weights_list` has one list of weights (one per model) for each
+    output model. The sums are accumulated in float32: memory-mapped
+    models are streamed one key at a time, the models that can't be
+    mapped are loaded one at a time, added and freed, so the peak
+    memory is the outputs plus one model. The outputs are cast back
+    to the original dtype, other tensors (i.e. BN
+    `num_batches_tracked`) are copied from the first model. If a key
+    is missing in some models, its weights are renormalized over the
+    models that have it.
+    Returns a list of state dicts, one for each set of weights.
+    """
+    mapped = {i: load_mmap(path) for i, path in enumerate(paths)}
+    mapped = {i: net for i, net in mapped.items() if net is not None}
+
+    # the keys, dtypes and non-float values from the first model
+    first = mapped[0] if 0 in mapped else load_lazy(paths[0])
+    outputs = [OrderedDict() for _ in weights_list]
+    sums, present, dtypes = OrderedDict(), {}, {}
+    for k, v in first.items():
+        if torch.is_tensor(v) and v.is_floating_point():
+            sums[k] = [torch.zeros(v.shape, dtype=torch.float32) for _ in weights_list]
+            present[k] = []
+            dtypes[k] = v.dtype
+        for out in outputs:
+            # the float values are set once averaged, keeping the order
+            out[k] = None if k in sums else (
+                v.clone() if torch.is_tensor(v) else v)
+
+    def accumulate(i, k, v):
+        v = v.float()
+        for s, weights in zip(sums[k], weights_list):
+            if weights[i]:
+                s.add_(v, alpha=weights[i])
+        present[k].append(i)
+
+    first = None if 0 in mapped else first
+
+    # models in memory, one at a time
+    for i, path in enumerate(paths):
+        if i in mapped:
+            continue
+        net = first if i == 0 else load_lazy(path)
+        first = None
+        for k in sums:
+            if k in net:
+                accumulate(i, k, net[k])
+        del net
+
+    # memory-mapped models, one key at a time
+    for k in sums:
+        for i, net in mapped.items():
+            if k in net:
+                accumulate(i, k, net[k])
+
+        if len(present[k]) < len(paths):
+            print('{} is missing in {} model(s)'.format(k, len(paths) - len(present[k])))
+        for out, s, weights in zip(outputs, sums[k], weights_list):
+            out[k] = (s / sum(weights[i] for i in present[k])).to(dtypes[k])
+        # free the accumulator of the key
+        sums[k] = None
+
+    return outputs
+
+
+def ema_weights(n, decay):
+    """Weights of each of `n` models in order, equivalent to
+    ema = decay * ema + (1 - decay) * model, initialized with
+    the first model."""
+    weights = [(1 - decay) * decay ** (n - 1 - i) for i in range(n)]
+    weights[0] = decay ** (n - 1)
+    return weights
+
+
+def main(args):
+    if args.dir:
+        model_list = _get_paths_from_models(args.dir)
+    else:
+        model_list = args.models or []
+    if not model_list:
+        print('No models defined, use -models or -dir')
+        return
+
+    if args.mode == 'average':
+        weights = args.weights or [1.0] * len(model_list)
+        assert len(weights) == len(model_list), 'One weight per model is required'
+        weights_list = [weights]
+        save_paths = [args.savepath]
+    elif args.mode == 'ema':
+        weights_list = [ema_weights(len(model_list), args.decay)]
+        save_paths = [args.savepath]
+    elif args.mode == 'sweep':
+        assert len(model_list) == 2, 'Interpolation sweeps require two models'
+        # higher alpha means higher weight from the second model
+        weights_list = [[1 - alpha, alpha] for alpha in args.alphas]
+        root, ext = os.path.splitext(args.savepath)
+        save_paths = ['{}_{:03d}{}'.format(root, int(round(alpha*100)), ext or '.pth')
+                      for alpha in args.alphas]
+
+    for path in model_list:
+        print(str(path) + " added.")
+
+    outputs = stream_merge(model_list, weights_list)
+    for net_merge, save_path in zip(outputs, save_paths):
+        torch.save(net_merge, save_path)
+        print('model saved in: ', save_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', type=str, choices=['average', 'sweep', 'ema'], help='Merge mode')
+    parser.add_argument('-models', '-m', type=str, nargs='+', required=False, help='Paths to the models to merge')
+    parser.add_argument('-dir', type=str, required=False, help='Directory with the models to merge (instead of -models)')
+    parser.add_argument('-weights', '-w', type=float, nargs='+', required=False, help='Weight of each model for average (default: uniform)')
+    parser.add_argument('-alphas', '-a', type=float, nargs='+', default=[0.5], help='Interpolation alphas for sweep (percentage from 0 to 1)')
+    parser.add_argument('-decay', '-d', type=float, default=0.9, help='Decay for ema')
+    parser.add_argument('-savepath', '-p', type=str, default='../../experiments/pretrained_models/merged.pth', help='Path and filename for the new model (sweep adds the alpha to the name)')
+    args = parser.parse_args()
+
+    main(args)
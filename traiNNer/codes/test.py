@@ -10,6 +10,7 @@ import utils.util as util
 from data import create_dataset, create_dataloader
 from dataops.common import bgr2ycbcr, tensor2np
 from models import create_model
+from models.interp import NetInterpolator, float_state
 from utils.metrics import calculate_psnr, calculate_ssim, MetricsDict
 from train import parse_options, dir_check, configure_loggers, get_dataloaders
 
@@ -224,6 +225,101 @@ def test_loop(model, opt, dataloaders, data_params):
                 logger.info('----Y channel, average metrics ----\n\t' + agg_logger_m[:-2])
 
 
+def benchmark(model, opt, dataloaders, data_params, n_images=20):
+    """Compare the inference throughput (images per second) of the
+    precision and memory layout settings and their quality loss
+    against fp32, using the first `n_images` of the first dataset.
+    Reports the average PSNR against the HR images (if available),
+    its delta to fp32 and the PSNR against the fp32 results."""
+    logger = util.get_root_logger()
+    dataloader = next(iter(dataloaders.values()))
+    name = dataloader.dataset.opt['name']
+    znorm = data_params['znorm'][name]
+    need_HR = dataloader.dataset.opt['dataroot_HR'] is not None
+    cuda = torch.cuda.is_available()
+
+    def run(data):
+        model.feed_data(data, need_HR=need_HR)
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        model.test()
+        if cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+
+    settings = [(p, cl) for p in ('fp32', 'fp16', 'bf16') for cl in (False, True)]
+    results = {}
+    base_outs = []
+    for precision, channels_last in settings:
+        model.setup_inference(precision, channels_last)
+        if model.infer_precision != precision:
+            # not supported in this device
+            continue
+
+        elapsed, count, psnrs, psnrs_base = 0, 0, [], []
+        for i, data in enumerate(dataloader):
+            if i >= n_images:
+                break
+            if i == 0:
+                run(data)  # warmup
+            elapsed += run(data)
+            count += 1
+
+            visuals = model.get_current_visuals(need_HR=need_HR)
+            sr_img = tensor2np(visuals['SR'], denormalize=znorm)
+            if need_HR:
+                hr_img = tensor2np(visuals['HR'], denormalize=znorm)
+                psnrs.append(calculate_psnr(sr_img, hr_img, shave=opt['scale']))
+            if precision == 'fp32' and not channels_last:
+                base_outs.append(sr_img)
+            else:
+                psnrs_base.append(calculate_psnr(sr_img, base_outs[i], shave=opt['scale']))
+
+        key = f"{precision}{', channels_last' if channels_last else ''}"
+        results[key] = {'ips': count / elapsed}
+        msg = f'Benchmark [{key}]: {results[key]["ips"]:.3f} img/s'
+        if psnrs:
+            results[key]['psnr'] = sum(psnrs) / len(psnrs)
+            base_psnr = results['fp32']['psnr']
+            msg += f', PSNR: {results[key]["psnr"]:.4f} ({results[key]["psnr"] - base_psnr:+.4f})'
+        if psnrs_base:
+            results[key]['psnr_fp32'] = sum(psnrs_base) / len(psnrs_base)
+            msg += f', PSNR to fp32: {results[key]["psnr_fp32"]:.4f}'
+        logger.info(msg)
+
+    # restore the configured settings
+    model.setup_inference()
+    return results
+
+
+def interp_loop(model, opt, dataloaders, data_params):
+    """Run the test loop for each of the `interp` alphas, with the
+    generator weights interpolated in place between `model_A`
+    (alpha = 0) and `pretrain_model_G` (alpha = 1). The results of
+    each alpha are saved in a `alpha_<value>` subdirectory."""
+    logger = util.get_root_logger()
+    interp_opt = opt['interp']
+
+    # keep both weight sets resident
+    state_B = float_state(model.netG)
+    logger.info(f"Loading model A for interpolation [{interp_opt['model_A']:s}]")
+    model.load_network(interp_opt['model_A'], model.netG,
+                       opt['network_G'].get('strict', None), model_type='G')
+    state_A = float_state(model.netG)
+    interp = NetInterpolator(model.netG, state_A, state_B,
+                             cache_size=interp_opt.get('cache_size', 4))
+
+    for alpha in interp_opt.get('alphas', [0.5]):
+        interp.set_alpha(alpha)
+        logger.info(f'\nInterpolation alpha: {alpha}')
+        # keep the NoneDict type, test_loop reads optional keys
+        alpha_opt = options.NoneDict(opt)
+        alpha_opt['path'] = options.NoneDict(opt['path'], results_root=os.path.join(
+            opt['path']['results_root'], f'alpha_{alpha:.3f}'))
+        test_loop(model, alpha_opt, dataloaders, data_params)
+
+
 def main():
     
     # parse test options
@@ -245,6 +341,16 @@ def main():
     # create and setup model: load and print network; init
     model = create_model(opt)
 
+    # only benchmark the inference settings if needed
+    if opt.get('benchmark_iters'):
+        benchmark(model, opt, dataloaders, data_params, n_images=opt['benchmark_iters'])
+        return
+
+    # interpolate the generator between two models if needed
+    if opt.get('interp', None):
+        interp_loop(model, opt, dataloaders, data_params)
+        return
+
     # start testing loop with configured options
     test_loop(model, opt, dataloaders, data_params)
     
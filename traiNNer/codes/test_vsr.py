@@ -5,7 +5,6 @@ import time
 from collections import OrderedDict
 
 import torch
-from torch.autograd import Variable
 
 import options
 import utils.util as util
@@ -15,45 +14,79 @@ from dataops.common import bgr2ycbcr, tensor2np
 from models import create_model
 
 
-def chop_forward(x, model, scale, shave=16, min_size=5000, nGPUs=1, need_HR=False):
-    # divide into 4 patches
-    b, n, c, h, w = x.size()
-    h_half, w_half = h // 2, w // 2
-    h_size, w_size = h_half + shave, w_half + shave
-    inputlist = [
-        x[:, :, :, 0:h_size, 0:w_size],
-        x[:, :, :, 0:h_size, (w - w_size):w],
-        x[:, :, :, (h - h_size):h, 0:w_size],
-        x[:, :, :, (h - h_size):h, (w - w_size):w]]
-
-    if w_size * h_size < min_size:
-        outputlist = []
-        for i in range(0, 4, nGPUs):
-            input_batch = torch.cat(inputlist[i:(i + nGPUs)], dim=0)
-            model.netG.eval()
-            with torch.no_grad():
-                _, _, _, output_batch = model.netG(input_batch)
-            outputlist.append(output_batch.data)
-    else:
-        outputlist = [
-            chop_forward(patch, model, scale, shave, min_size, nGPUs) \
-            for patch in inputlist]
-
-    h, w = scale * h, scale * w
-    h_half, w_half = scale * h_half, scale * w_half
-    h_size, w_size = scale * h_size, scale * w_size
-    shave *= scale
-
-    # output = Variable(x.data.new(1, 1, h, w), volatile=True) #UserWarning: volatile was removed and now has no effect. Use `with torch.no_grad():` instead.
+def tile_positions(size, tile, overlap):
+    """Start positions of the tiles along one axis, the last tile
+    is aligned to the border."""
+    if size <= tile:
+        return [0]
+    stride = max(tile - overlap, 1)
+    return list(range(0, size - tile, stride)) + [size - tile]
+
+
+class TilePlan:
+    """Overlapping spatial tiles for a (h, w) input, computed once
+    and reused for every frame window of a clip, with the map to
+    average the overlapping areas of the upscaled tiles."""
+    def __init__(self, h, w, tile=64, overlap=8, scale=4):
+        self.th, self.tw = min(tile, h), min(tile, w)
+        self.boxes = [(y, x) for y in tile_positions(h, self.th, overlap)
+                      for x in tile_positions(w, self.tw, overlap)]
+        self.scale = scale
+        count = torch.zeros(1, 1, h * scale, w * scale)
+        for y, x in self.boxes:
+            count[..., y * scale:(y + self.th) * scale,
+                  x * scale:(x + self.tw) * scale] += 1
+        self.count = count
+
+
+def chop_forward(x, model, scale, plans, tile=64, overlap=8, batch_size=16):
+    """Tiled forward for video SR. The frames window `x` [1, t, c, h, w]
+    is split in overlapping tiles, which are processed in batches of
+    `batch_size` tiles per forward pass and then blended back
+    (averaging the overlaps). The tile plan for each frame size is
+    cached in `plans` and reused for all the windows of a clip."""
+    _, _, _, h, w = x.size()
+    plan = plans.get((h, w))
+    if plan is None:
+        plan = TilePlan(h, w, tile, overlap, scale)
+        plans[(h, w)] = plan
+
+    x = x.to(model.device, non_blocking=True)
+    th, tw = plan.th, plan.tw
+    output = None
+    model.netG.eval()
     with torch.no_grad():
-        # output = Variable(x.data.new(1, 1, h, w))
-        output = Variable(x.data.new(1, c, h, w))
-    output[:, :, 0:h_half, 0:w_half] = outputlist[0][:, :, 0:h_half, 0:w_half]
-    output[:, :, 0:h_half, w_half:w] = outputlist[1][:, :, 0:h_half, (w_size - w + w_half):w_size]
-    output[:, :, h_half:h, 0:w_half] = outputlist[2][:, :, (h_size - h + h_half):h_size, 0:w_half]
-    output[:, :, h_half:h, w_half:w] = outputlist[3][:, :, (h_size - h + h_half):h_size, (w_size - w + w_half):w_size]
-
-    return output
+        for i in range(0, len(plan.boxes), batch_size):
+            boxes = plan.boxes[i:i + batch_size]
+            input_batch = torch.cat(
+                [x[..., y:y + th, x0:x0 + tw] for y, x0 in boxes], dim=0)
+            output_batch = model.netG(input_batch)
+            if isinstance(output_batch, (list, tuple)):
+                output_batch = output_batch[-1]
+            if output is None:
+                output = output_batch.new_zeros(
+                    1, output_batch.size(1), h * scale, w * scale)
+            for (y, x0), out in zip(boxes, output_batch):
+                output[0, :, y * scale:(y + th) * scale,
+                       x0 * scale:(x0 + tw) * scale] += out
+
+    return (output / plan.count.to(output.device)).cpu()
+
+
+def prefetch(loader, device):
+    """Iterate the dataloader one batch ahead, starting the copy of
+    the next LR window to the device while the current one is being
+    processed. The copy is only asynchronous if the loader returns
+    pinned memory (create_dataloader sets pin_memory with CUDA)."""
+    prev = None
+    for data in loader:
+        if isinstance(data['LR'], torch.Tensor):
+            data['LR'] = data['LR'].to(device, non_blocking=True)
+        if prev is not None:
+            yield prev
+        prev = data
+    if prev is not None:
+        yield prev
 
 
 def main():
@@ -110,7 +143,10 @@ def main():
         test_results['psnr_y'] = []
         test_results['ssim_y'] = []
 
-        for data in test_loader:
+        # tile plans, reused for all the windows of the clip
+        plans = {}
+
+        for data in prefetch(test_loader, model.device):
             need_HR = False if test_loader.dataset.opt['dataroot_HR'] is None else True
 
             img_path = data['LR_path'][0]
@@ -129,19 +165,18 @@ def main():
                 # print(LR_y_cube.shape)
                 # print(data['LR_bicubic'].shape)
 
-                # crop borders to ensure each patch can be divisible by 2
-                # TODO: this is modcrop, not sure if really needed, check (the dataloader already does modcrop)
                 _, _, _, h, w = LR_y_cube.size()
-                h = int(h // 16) * 16
-                w = int(w // 16) * 16
-                LR_y_cube = LR_y_cube[:, :, :, :h, :w]
                 if isinstance(data['LR_bicubic'], torch.Tensor):
                     # SR_cb = data['LR_bicubic'][:, 1, :, :][:, :, :h * scale, :w * scale]
                     SR_cb = data['LR_bicubic'][:, 1, :h * scale, :w * scale]
                     # SR_cr = data['LR_bicubic'][:, 2, :, :][:, :, :h * scale, :w * scale]
                     SR_cr = data['LR_bicubic'][:, 2, :h * scale, :w * scale]
 
-                SR_y = chop_forward(LR_y_cube, model, scale, need_HR=need_HR).squeeze(0)
+                SR_y = chop_forward(
+                    LR_y_cube, model, scale, plans,
+                    tile=opt.get('chop_tile', 64),
+                    overlap=opt.get('chop_overlap', 8),
+                    batch_size=opt.get('chop_batch', 16)).squeeze(0)
                 # SR_y = np.array(SR_y.data.cpu())
                 if test_loader.dataset.opt.get('srcolors', None):
                     print(SR_y.shape, SR_cb.shape, SR_cr.shape)
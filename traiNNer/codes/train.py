@@ -4,15 +4,16 @@ import logging
 import math
 import os.path
 import random
-# import time
+import time
 
 import torch
+from torch.utils.data.distributed import DistributedSampler
 
 import options
 from data import create_dataloader, create_dataset
 from dataops.common import tensor2np
 from models import create_model
-from utils import util, metrics
+from utils import util, metrics, dist_util
 
 
 def parse_options(is_train=True):
@@ -20,9 +21,29 @@ def parse_options(is_train=True):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-opt', type=str, required=True, help='Path to options file.')
+    parser.add_argument(
+        '-benchmark', type=int, default=0,
+        help='Number of iterations to benchmark the training step with '
+             'eager and compiled network forwards, then exit.')
+    parser.add_argument(
+        '-launcher', choices=['none', 'pytorch'], default='none',
+        help="Use 'pytorch' for distributed training launched with torchrun.")
+    parser.add_argument(
+        '-dist_backend', choices=['nccl', 'gloo'], default=None,
+        help="Distributed backend. Defaults to 'nccl' if CUDA is "
+             "available, else 'gloo'.")
 
     args = parser.parse_args()
     opt = options.parse(args.opt, is_train=is_train)
+    opt['benchmark_iters'] = args.benchmark
+
+    # distributed settings
+    if args.launcher == 'none':
+        opt['dist'] = False
+    else:
+        opt['dist'] = True
+        dist_util.init_dist(args.dist_backend)
+    opt['rank'], opt['world_size'] = dist_util.get_dist_info()
 
     return opt
 
@@ -36,11 +57,17 @@ def dir_check(opt):
                         and 'pretrain_model' not in key and 'resume' not in key))
     else:
         # create testing directory
-        util.mkdirs((path for key, path in opt['path'].items() if not key == 'pretrain_model_G'))
+        util.mkdirs((path for key, path in opt['path'].items()
+                    if key not in ('pretrain_model_G', 'quantized_model_G')))
 
 
 def configure_loggers(opt=None):
     tofile = opt.get('logger', {}).get('save_logfile', True)
+    if opt.get('rank', 0) != 0:
+        # only the rank 0 process logs training information
+        util.get_root_logger(None, level=logging.WARNING, screen=True, tofile=False)
+        opt['use_tb_logger'] = False
+        return {"tb_logger": None}
     if opt['is_train']:
         # config loggers. Before it, the log will not work
         util.get_root_logger(None, opt['path']['log'], 'train', level=logging.INFO, screen=True, tofile=tofile)
@@ -89,7 +116,11 @@ def get_resume_state(opt):
         else:
             resume_state_path = opt['path']['resume_state']
 
-        if opt['gpu_ids']:
+        if opt['gpu_ids'] and opt.get('dist'):
+            device_id = torch.cuda.current_device()
+            resume_state = torch.load(resume_state_path,
+                            map_location=lambda storage, loc: storage.cuda(device_id))
+        elif opt['gpu_ids']:
             resume_state = torch.load(resume_state_path)
         else:
             resume_state = torch.load(resume_state_path,
@@ -112,7 +143,9 @@ def get_random_seed(opt):
         seed = random.randint(1, 10000)
         opt['train']['manual_seed'] = seed
     logger.info('Random seed: {}'.format(seed))
-    util.set_random_seed(seed)
+    # different augmentations in each process, DDP will broadcast
+    # the initial network weights from rank 0
+    util.set_random_seed(seed + opt.get('rank', 0))
     return opt
 
 
@@ -136,7 +169,8 @@ def get_dataloaders(opt):
         if not dataset:
             raise Exception('Dataset "{}" for phase "{}" is empty.'.format(name, phase))
 
-        dataloaders[phase] = create_dataloader(dataset, dataset_opt, gpu_ids)
+        dataloaders[phase] = create_dataloader(
+            dataset, dataset_opt, gpu_ids, dist=opt.get('dist', False))
 
         if opt['is_train'] and phase == 'train':
             batch_size = dataset_opt.get('batch_size', 4)
@@ -193,6 +227,40 @@ def resume_training(opt, model, resume_state, data_params):
     return {"start_epoch": start_epoch, "current_step": current_step, "virtual_step": virtual_step}
 
 
+def benchmark(model, dataloaders, n_iters=20, warmup=3):
+    """Report the training iterations per second with the eager
+    and the compiled (if `use_compile` is set) G and D forwards,
+    using a fixed batch (static shapes). Only the forwards differ,
+    the losses, backward and optimizer steps are eager in both. Note that it updates the
+    networks, so it's not meant to be used to resume training."""
+    logger = util.get_root_logger()
+    train_data = next(iter(dataloaders['train']))
+    compiled_nets = model.compiled_nets
+
+    results = {}
+    for name, nets in (('eager', {}), ('compiled forwards', compiled_nets)):
+        if name == 'compiled forwards' and not nets:
+            continue
+        model.compiled_nets = nets
+        for step in range(1, warmup + n_iters + 1):
+            if step == warmup + 1:
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+            model.feed_data(train_data)
+            model.optimize_parameters(step)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        results[name] = n_iters / (time.perf_counter() - start)
+        logger.info(f'Benchmark [{name}]: {results[name]:.3f} it/s')
+
+    model.compiled_nets = compiled_nets
+    if 'compiled forwards' in results:
+        logger.info('Benchmark speedup (compiled forwards): {:.2f}x'.format(
+            results['compiled forwards'] / results['eager']))
+    return results
+
+
 def fit(model, opt, dataloaders, steps_states, data_params, loggers):
     # read data_params
     batch_size = data_params['batch_size']
@@ -208,6 +276,8 @@ def fit(model, opt, dataloaders, steps_states, data_params, loggers):
     # read loggers
     logger = util.get_root_logger()
     tb_logger = loggers["tb_logger"]
+    is_master = dist_util.is_master()
+    train_sampler = dataloaders['train'].sampler
 
     # training
     logger.info('Start training from epoch: {:d}, iter: {:d}'.format(start_epoch, current_step))
@@ -219,6 +289,9 @@ def fit(model, opt, dataloaders, steps_states, data_params, loggers):
         for epoch in range(start_epoch, (total_epochs * (virtual_batch_size // batch_size))+1):
             timerData.tick()
             timerEpoch.tick()
+            if isinstance(train_sampler, DistributedSampler):
+                # reshuffle the shards every epoch
+                train_sampler.set_epoch(epoch)
 
             # inner iteration loop within one epoch
             for n, train_data in enumerate(dataloaders['train'], start=1):
@@ -280,7 +353,7 @@ def fit(model, opt, dataloaders, steps_states, data_params, loggers):
                         current_step, warmup_iter=opt['train'].get('warmup_iter', -1))
 
                 # save latest models and training states every <save_checkpoint_freq> iterations
-                if current_step % opt['logger']['save_checkpoint_freq'] == 0 and take_step:
+                if current_step % opt['logger']['save_checkpoint_freq'] == 0 and take_step and is_master:
                     if model.swa: 
                         model.save(
                             current_step, opt['logger']['overwrite_chkp'],
@@ -371,9 +444,16 @@ def fit(model, opt, dataloaders, steps_states, data_params, loggers):
                         """
                         val_metrics.calculate_metrics(sr_img, gt_img, crop_size=opt['scale'])  # , only_y=True)
 
+                    val_count = val_metrics.count
                     avg_metrics = val_metrics.get_averages()
                     if nlls:  # srflow
                         avg_nll = sum(nlls) / len(nlls)
+                    if opt.get('dist'):
+                        # every process evaluated a shard of the validation set
+                        avg_metrics = dist_util.reduce_averages(avg_metrics, val_count)
+                        if nlls:
+                            avg_nll = dist_util.reduce_averages(
+                                {'nll': float(avg_nll)}, len(nlls))['nll']
                     del val_metrics
 
                     # for ReduceLROnPlateau scheduler, get metric average value
@@ -407,7 +487,8 @@ def fit(model, opt, dataloaders, steps_states, data_params, loggers):
                         # tb_logger_valid.flush()
 
                 # sampling training data (for image2image translation and others without validation step)
-                if opt['train'].get('display_freq', None) and current_step % opt['train']['display_freq'] == 0 and take_step:
+                if (opt['train'].get('display_freq', None) and current_step % opt['train']['display_freq'] == 0
+                        and take_step and is_master):
                     visuals = model.get_current_visuals()
 
                     img_name = ''
@@ -443,21 +524,26 @@ def fit(model, opt, dataloaders, steps_states, data_params, loggers):
             logger.info('End of epoch {} / {} \t Time Taken: {:.4f} sec'.format(
                 epoch, total_epochs, timerEpoch.get_last_iteration()))
 
-        logger.info('Saving the final model.')
-        if model.swa:
-            model.save('latest', loader=dataloaders['train'])
-        else:
-            model.save('latest')
+        if is_master:
+            logger.info('Saving the final model.')
+            if model.swa:
+                model.save('latest', loader=dataloaders['train'], final=True)
+            else:
+                model.save('latest')
+            model.wait_checkpoints()
         logger.info('End of training.')
 
     except KeyboardInterrupt:
         # catch a KeyboardInterrupt and save the model and state to resume later
+        if not is_master:
+            return
         if model.swa:
             model.save(current_step, True, loader=dataloaders['train'])
         else:
             model.save(current_step, True)
         n = n if 'n' in locals() else 0
         model.save_training_state(epoch + (n >= len(dataloaders['train'])), current_step, True)
+        model.wait_checkpoints()
         logger.info('Training interrupted. Latest models and training states saved at epoch:{:3d}, iter:{:8,d}. '.format(epoch, current_step))
 
 
@@ -466,7 +552,9 @@ def main():
     opt = parse_options()
 
     # create the training directory if needed
-    dir_check(opt)
+    if dist_util.is_master():
+        dir_check(opt)
+    dist_util.barrier()
 
     # configure loggers
     loggers = configure_loggers(opt)
@@ -489,6 +577,11 @@ def main():
     # create and setup model: load and print networks; create schedulers/optimizer; init
     model = create_model(opt, step = 0 if resume_state is None else resume_state['iter'])
 
+    # only benchmark the training step if needed
+    if opt.get('benchmark_iters'):
+        benchmark(model, dataloaders, n_iters=opt['benchmark_iters'])
+        return
+
     # resume training if needed
     steps_states = resume_training(opt, model, resume_state, data_params)
 
@@ -0,0 +1,160 @@
+"""Checkpoint writer that saves to disk in a background thread.
+The state (network `state_dict` or training state) is first
+snapshotted to reusable (pinned, if coming from CUDA) CPU buffers,
+so training can continue while the file is written. Files are
+written to a temporary path and atomically renamed, so a crash or
+interruption never leaves a truncated checkpoint, and the
+`previous_*` copy of a checkpoint is rotated with a hardlink
+instead of copying the file.
+Networks can also be saved in a compact format: the floating point
+weights stored in fp16/bf16 (or fp32) with the keys of the bare
+network, in the zipfile format that can be memory-mapped on load.
+"""
+
+import copy
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def atomic_save(obj, path: str, prev_path: str = None,
+    legacy: bool = False):
+    """Save `obj` with torch.save to a temporary file in the
+    same directory and atomically rename it to `path`. If
+    `prev_path` is set and `path` exists, the old file is kept
+    as `prev_path`.
+    :param legacy: save in the pre-1.4.0 non-zipped format.
+    """
+    tmp_path = f'{path}.tmp'
+    try:
+        torch.save(obj, tmp_path, _use_new_zipfile_serialization=not legacy)
+    except TypeError:  # pre 1.4.0, normal torch.save
+        torch.save(obj, tmp_path)
+    with open(tmp_path, 'r+b') as f:
+        os.fsync(f.fileno())
+
+    if prev_path and os.path.exists(path):
+        prev_tmp = f'{prev_path}.tmp'
+        if os.path.exists(prev_tmp):
+            os.remove(prev_tmp)
+        try:
+            # keeps 'path' available until it's replaced
+            os.link(path, prev_tmp)
+            os.replace(prev_tmp, prev_path)
+        except OSError:
+            # filesystems without hardlinks support
+            os.replace(path, prev_path)
+    os.replace(tmp_path, path)
+
+
+COMPACT_DTYPES = {
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+    'fp32': torch.float32,
+}
+
+
+def compact_state(state_dict: dict, dtype: str = 'fp16') -> dict:
+    """Wrap a network `state_dict` (with the keys already matching
+    the network) in the compact checkpoint format, casting the
+    floating point tensors to `dtype` ('fp16', 'bf16' or 'fp32')."""
+    if dtype not in COMPACT_DTYPES:
+        raise NotImplementedError(f'Compact checkpoint dtype [{dtype}] not recognized.')
+    cast = COMPACT_DTYPES[dtype]
+    return {
+        'compact': dtype,
+        'state_dict': {
+            k: v.detach().to(cast) if v.is_floating_point() else v.detach()
+            for k, v in state_dict.items()},
+    }
+
+
+def is_compact(obj) -> bool:
+    return isinstance(obj, dict) and 'compact' in obj and 'state_dict' in obj
+
+
+def load_checkpoint(path: str):
+    """torch.load a checkpoint on CPU. Files in the zipfile format
+    are memory-mapped when supported (PyTorch>=2.1), so the tensors
+    are read from disk on demand instead of copied in memory."""
+    if zipfile.is_zipfile(path):
+        try:
+            return torch.load(path, map_location='cpu', mmap=True)
+        except TypeError:
+            pass
+    return torch.load(path, map_location=lambda storage, loc: storage)
+
+
+class CheckpointWriter:
+    """Write checkpoints with `atomic_save()`, either in the
+    calling thread or, if `async_write`, in a background thread.
+    Each `label` (i.e. 'G', 'D', 'state') has its own set of CPU
+    buffers that are reused between saves, a new snapshot of a
+    label waits for its previous write to finish.
+    """
+    def __init__(self, async_write: bool = False):
+        self.async_write = async_write
+        self.executor = ThreadPoolExecutor(max_workers=1) if async_write else None
+        self.buffers = {}
+        self.pending = {}
+
+    def snapshot(self, obj, buffers: dict, key: str = ''):
+        """Recursively copy the tensors in `obj` to the CPU
+        buffers, everything else is deep copied."""
+        if isinstance(obj, torch.Tensor):
+            obj = obj.detach()
+            buf = buffers.get(key)
+            if (buf is None or buf.shape != obj.shape
+                    or buf.dtype != obj.dtype):
+                buf = torch.empty(
+                    obj.shape, dtype=obj.dtype,
+                    pin_memory=obj.is_cuda and self.async_write)
+                buffers[key] = buf
+            buf.copy_(obj, non_blocking=obj.is_cuda and self.async_write)
+            return buf
+        if isinstance(obj, dict):
+            # shallow copy to keep the type and attributes, like
+            # the state_dict '_metadata' or Counter milestones
+            new = copy.copy(obj)
+            for k, v in obj.items():
+                new[k] = self.snapshot(v, buffers, f'{key}.{k}')
+            return new
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.snapshot(v, buffers, f'{key}.{i}')
+                             for i, v in enumerate(obj))
+        return copy.deepcopy(obj)
+
+    def save(self, obj, path: str, label: str,
+        prev_path: str = None, legacy: bool = False):
+        """Snapshot `obj` and write it to `path`."""
+        self.wait(label)
+        # the buffers are only kept for reuse with async writes
+        buffers = self.buffers.setdefault(label, {}) if self.async_write else {}
+        state = self.snapshot(obj, buffers)
+        event = None
+        if torch.cuda.is_available() and self.async_write:
+            # the non_blocking copies have to finish before writing
+            event = torch.cuda.Event()
+            event.record()
+
+        if not self.async_write:
+            atomic_save(state, path, prev_path, legacy)
+            return
+
+        def write():
+            if event is not None:
+                event.synchronize()
+            atomic_save(state, path, prev_path, legacy)
+        self.pending[label] = self.executor.submit(write)
+
+    def wait(self, label: str = None):
+        """Block until the pending writes (of `label`, or all if
+        None) are done. Errors in the background writes are raised
+        here."""
+        labels = [label] if label else list(self.pending)
+        for l in labels:
+            future = self.pending.pop(l, None)
+            if future is not None:
+                future.result()
@@ -0,0 +1,82 @@
+"""Helpers for distributed data-parallel (DDP) training.
+Processes are expected to be launched with `torchrun` (or
+`python -m torch.distributed.launch --use_env`), which sets the
+RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT
+environment variables for each process, i.e.:
+    torchrun --nproc_per_node=2 train.py -opt options/sr/train_sr.yml -launcher pytorch
+"""
+
+import functools
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_dist(backend: str = None) -> int:
+    """Initialize the default process group from the environment
+    variables and pin the process to its local GPU if available.
+    :param backend: 'nccl' (GPU) or 'gloo' (CPU or GPU). By default
+        'nccl' is used if CUDA is available, else 'gloo'.
+    Returns the local rank of the process.
+    """
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if not backend:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank % torch.cuda.device_count())
+    dist.init_process_group(backend=backend, init_method='env://')
+    return local_rank
+
+
+def is_dist() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_dist_info():
+    """Return the (rank, world_size) of the current process,
+    (0, 1) if not distributed."""
+    if is_dist():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def is_master() -> bool:
+    return get_dist_info()[0] == 0
+
+
+def master_only(func):
+    """Decorator to only run a function in the rank 0 process."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if is_master():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def barrier():
+    if is_dist():
+        dist.barrier()
+
+
+def comm_device():
+    """'nccl' can only reduce CUDA tensors."""
+    if is_dist() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def reduce_averages(averages: dict, count: int) -> dict:
+    """Combine the per-process averages of a metrics dictionary
+    into the global averages, weighting each process by the number
+    of samples (`count`) it evaluated. All processes get the same
+    results."""
+    if not is_dist():
+        return averages
+    names = list(averages)
+    values = torch.tensor(
+        [averages[n] * count for n in names] + [count],
+        dtype=torch.float64, device=comm_device())
+    dist.all_reduce(values, op=dist.ReduceOp.SUM)
+    total = max(values[-1].item(), 1)
+    return {n: values[i].item() / total for i, n in enumerate(names)}
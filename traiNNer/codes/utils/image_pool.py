@@ -56,3 +56,66 @@ class ImagePool():
         # collect all the images and return
         return_images = torch.cat(return_images, 0)
         return return_images
+
+
+class TensorImagePool():
+    """ImagePool that keeps the history in a preallocated
+    [pool_size+1, C, H, W] tensor on the images' device, replacing
+    and selecting the images of the whole batch with random masks
+    and index operations instead of a Python loop per image. The
+    extra row is a scratch slot, where the images that are not
+    inserted are written to, so the update is a single index_copy_
+    without host-device synchronization. If more than one image of
+    a batch picks the same slot, one of them is stored (instead of
+    chaining the swaps like ImagePool does).
+    """
+
+    def __init__(self, pool_size):
+        """Initialize the TensorImagePool class
+        Parameters:
+            pool_size (int): the size of image buffer, if pool_size=0,
+                no buffer will be created
+        """
+        self.pool_size = pool_size
+        self.num_imgs = 0
+        # allocated with the first query
+        self.images = None
+
+    def query(self, images):
+        """Return images from the pool, with the same behavior as
+        ImagePool.query().
+        Parameters:
+            images: the latest generated images from the generator
+        """
+        if self.pool_size == 0:
+            # if the buffer size is 0, do nothing
+            return images
+
+        images = images.detach()
+        if (self.images is None or self.images.shape[1:] != images.shape[1:]
+                or self.images.device != images.device):
+            # (re)create an empty pool for the images' shape
+            self.images = images.new_empty((self.pool_size + 1, *images.shape[1:]))
+            self.num_imgs = 0
+
+        # if the buffer is not full; keep inserting current images to the buffer
+        n_fill = min(images.shape[0], self.pool_size - self.num_imgs)
+        if n_fill > 0:
+            self.images[self.num_imgs:self.num_imgs + n_fill] = images[:n_fill]
+            self.num_imgs += n_fill
+            if n_fill == images.shape[0]:
+                return images.clone()
+
+        # by 50% chance, return a previously stored image and insert the
+        # current one into the buffer, else return the current image
+        rest = images[n_fill:]
+        n_rest = rest.shape[0]
+        swap = torch.rand(n_rest, device=images.device) > 0.5
+        ids = torch.randint(0, self.pool_size, (n_rest,), device=images.device)
+        stored = self.images.index_select(0, ids)
+        return_images = torch.where(swap.view(-1, 1, 1, 1), stored, rest)
+        self.images.index_copy_(0, ids.masked_fill(~swap, self.pool_size), rest)
+
+        if n_fill > 0:
+            return_images = torch.cat([images[:n_fill], return_images], 0)
+        return return_images